@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+grouped convolution of nets/L_Resnet_E_IR.py: the split implementation (one convolution per group and a concat)
+against the fused one (a depthwise convolution and a sum over the group channels) and the native grouped Conv2D,
+over group counts. forward and forward + backward time and peak memory of a single convolution, and the largest
+difference of the outputs to the split implementation.
+
+every implementation and group count runs in its own process (utils/benchmark.run_config_process), the split one
+first, it writes its output for the others to compare with. the native grouped Conv2D is only implemented by some
+tensorflow builds (cuDNN), elsewhere it is reported as failed.
+
+eg: python benchmark_grouped_conv.py --groups 1 2 4 8 16 32 256 --channels 256 --size 14
+'''
+
+from utils.benchmark import add_benchmark_arguments, session_config, time_runs, median_ms, peak_rss_mb, \
+    run_config_process, write_results
+import argparse
+import tempfile
+import shutil
+import json
+import sys
+import os
+
+import numpy as np
+
+IMPLEMENTATIONS = ['split', 'fused', 'native']
+
+
+def run_config(args):
+    '''time one implementation and group count and print a json result line.'''
+    import tensorflow as tf
+    from nets.L_Resnet_E_IR import convolution
+
+    np.random.seed(0)
+    inputs_value = np.random.uniform(-1., 1., [args.batch_size, args.size, args.size, args.channels]).astype(np.float32)
+    shape = [args.kernel, args.kernel, args.channels // args.group, args.channels]
+    weight_value = np.random.normal(0., 0.1, shape).astype(np.float32)
+    with tf.Graph().as_default():
+        inputs = tf.constant(inputs_value)
+        output = convolution(inputs, group=args.group, shape=shape, strides=[args.stride, args.stride],
+                             padding='SAME', trainable=True, name='conv', grouped=args.implementation)
+        weight = [v for v in tf.trainable_variables() if v.op.name == 'conv_weight'][0]
+        grads = tf.group(*tf.gradients(tf.reduce_sum(tf.square(output)), [inputs, weight]))
+
+        with tf.Session(config=session_config(args.num_threads)) as sess:
+            sess.run(tf.global_variables_initializer())
+            weight.load(weight_value, sess)
+            output_value = sess.run(output)
+            times = {}
+            for name, fetch in [('forward', output), ('forward_backward', grads)]:
+                times[name] = median_ms(time_runs(lambda: sess.run(fetch), args.warmup_runs, args.num_runs))
+
+    result = {'implementation': args.implementation, 'group': args.group, 'channels': args.channels,
+              'size': args.size, 'batch_size': args.batch_size, 'forward_ms': times['forward'],
+              'forward_backward_ms': times['forward_backward'], 'max_abs_diff': None, 'peak_rss_mb': peak_rss_mb()}
+    if args.save_output:
+        np.save(args.save_output, output_value)
+    if args.reference and os.path.exists(args.reference):
+        result['max_abs_diff'] = float(np.max(np.abs(output_value - np.load(args.reference))))
+    print(json.dumps(result))
+
+
+def main(args):
+    results = []
+    reference_dir = tempfile.mkdtemp()
+    try:
+        for group in args.groups:
+            if args.channels % group:
+                print('group %d does not divide %d channels, skipped' % (group, args.channels))
+                continue
+            reference = os.path.join(reference_dir, 'split_%d.npy' % group)
+            # the split outputs are the reference of the others
+            for implementation in sorted(args.implementations, key=lambda name: name != 'split'):
+                config = {'implementation': implementation, 'group': group}
+                extra_args = ['--channels', str(args.channels), '--size', str(args.size), '--kernel', str(args.kernel),
+                              '--stride', str(args.stride), '--batch_size', str(args.batch_size),
+                              '--warmup_runs', str(args.warmup_runs), '--num_runs', str(args.num_runs),
+                              '--num_threads', str(args.num_threads)]
+                extra_args += ['--save_output', reference] if implementation == 'split' else ['--reference', reference]
+                results.append(run_config_process(__file__, config, extra_args))
+    finally:
+        shutil.rmtree(reference_dir)
+
+    print('\n| groups | implementation | forward (ms) | forward + backward (ms) | vs split | max abs diff | peak RSS (MB) |')
+    print('| ------ | -------------- | ------------ | ----------------------- | -------- | ------------ | ------------- |')
+    for result in results:
+        if 'failed' in result:
+            print('| %(group)d | %(implementation)s | failed | failed | - | - | - |' % result)
+            continue
+        base = [r for r in results if r['group'] == result['group'] and r['implementation'] == 'split'
+                and 'failed' not in r]
+        speedup = base[0]['forward_backward_ms'] / result['forward_backward_ms'] if base else float('nan')
+        diff = '%.2e' % result['max_abs_diff'] if result['max_abs_diff'] is not None else '-'
+        print('| %d | %s | %.3f | %.3f | %.2fx | %s | %.1f |' %
+              (result['group'], result['implementation'], result['forward_ms'], result['forward_backward_ms'],
+               speedup, diff, result['peak_rss_mb']))
+    write_results(results, args.output)
+
+
+def parse_arguments(argv):
+    '''benchmark parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--groups', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64, 256],
+                        help='group counts to measure, channels groups is a depthwise convolution')
+    parser.add_argument('--implementations', nargs='+', default=IMPLEMENTATIONS, choices=IMPLEMENTATIONS,
+                        help='grouped convolution implementations to measure')
+    parser.add_argument('--channels', type=int, default=256, help='input and output channels of the convolution')
+    parser.add_argument('--size', type=int, default=14, help='height and width of the input')
+    parser.add_argument('--kernel', type=int, default=3, help='kernel size')
+    parser.add_argument('--stride', type=int, default=1, help='stride')
+    parser.add_argument('--batch_size', type=int, default=32, help='batch size')
+    add_benchmark_arguments(parser, warmup_runs=3, num_runs=20)
+    parser.add_argument('--output', type=str, default='', help='json file of the results, empty to print only')
+    parser.add_argument('--implementation', default='split', choices=IMPLEMENTATIONS,
+                        help='internal, implementation of the single configuration')
+    parser.add_argument('--group', type=int, default=1, help='internal, group count of the single configuration')
+    parser.add_argument('--save_output', type=str, default='', help='internal, .npy file of the convolution output')
+    parser.add_argument('--reference', type=str, default='', help='internal, .npy file of the output to compare with')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+    if args.run_config:
+        run_config(args)
+    else:
+        main(args)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+microbenchmark of the margin-loss heads of losses/face_losses.py alone, on random embeddings and labels.
+for every head, class count and batch size report the forward and backward time and the peak memory of its process
+(utils/benchmark.run_config_process).
+
+eg: python benchmark_losses.py --class_numbers 10000 100000 1000000 2000000 --batch_sizes 64 256 1024
+'''
+
+from utils.benchmark import add_benchmark_arguments, session_config, time_runs, median_ms, peak_rss_mb, \
+    run_config_process, write_results
+import argparse
+import json
+import sys
+
+LOSS_TYPES = ['insightface', 'cosine', 'combine', 'center', 'cos']
+
+
+def build_head(loss_type, embeddings, labels, batch_size, class_number, sample_rate):
+    '''the loss of one head, sample_rate < 1 samples the class centers (Partial-FC) of the margin losses.'''
+    import tensorflow as tf
+    from losses.face_losses import insightface_loss, cosineface_loss, combine_loss, center_loss, cos_loss, sample_classes
+
+    w_init = tf.contrib.layers.xavier_initializer(uniform=False)
+    kwargs = {}
+    if sample_rate < 1.0 and loss_type in ['insightface', 'cosine', 'combine']:
+        num_sample = max(int(class_number * sample_rate), batch_size)
+        kwargs['class_indices'], labels = sample_classes(labels, class_number, num_sample)
+    if loss_type == 'insightface':
+        loss, _ = insightface_loss(embeddings, labels, class_number, w_init, **kwargs)
+    elif loss_type == 'cosine':
+        loss, _ = cosineface_loss(embeddings, labels, class_number, w_init, **kwargs)
+    elif loss_type == 'combine':
+        loss, _ = combine_loss(embeddings, labels, batch_size, class_number, w_init, **kwargs)
+    elif loss_type == 'center':
+        loss, _ = center_loss(embeddings, labels, 0.95, class_number)
+    elif loss_type == 'cos':
+        loss, _ = cos_loss(embeddings, labels, class_number)
+    else:
+        raise ValueError('unknown loss type %s' % loss_type)
+    return loss
+
+
+def run_config(args):
+    '''time one head, class count and batch size and print a json result line.'''
+    import tensorflow as tf
+
+    with tf.Graph().as_default():
+        embeddings = tf.get_variable('embeddings', shape=[args.batch_size, args.embedding_size],
+                                     initializer=tf.random_normal_initializer())
+        labels = tf.random_uniform([args.batch_size], maxval=args.class_number, dtype=tf.int64)
+        loss = build_head(args.loss_type, embeddings, labels, args.batch_size, args.class_number, args.sample_rate)
+        # gradients of the embeddings (what the backbone receives) and of the head weights
+        grads = tf.gradients(loss, tf.trainable_variables())
+        grads = tf.group(*[grad for grad in grads if grad is not None])
+
+        with tf.Session(config=session_config(args.num_threads)) as sess:
+            sess.run(tf.global_variables_initializer())
+            rss_init = peak_rss_mb()
+            times = {}
+            for name, fetch in [('forward', loss), ('forward_backward', grads)]:
+                times[name] = median_ms(time_runs(lambda: sess.run(fetch), args.warmup_runs, args.num_runs))
+
+    result = {'loss_type': args.loss_type, 'class_number': args.class_number, 'batch_size': args.batch_size,
+              'sample_rate': args.sample_rate, 'forward_ms': times['forward'],
+              'backward_ms': times['forward_backward'] - times['forward'], 'forward_backward_ms': times['forward_backward'],
+              'variables_rss_mb': rss_init, 'peak_rss_mb': peak_rss_mb()}
+    print(json.dumps(result))
+
+
+def main(args):
+    results = []
+    for loss_type in args.loss_types:
+        for class_number in args.class_numbers:
+            for batch_size in args.batch_sizes:
+                for sample_rate in args.sample_rates:
+                    if sample_rate < 1.0 and loss_type not in ['insightface', 'cosine', 'combine']:
+                        continue
+                    config = {'loss_type': loss_type, 'class_number': class_number, 'batch_size': batch_size,
+                              'sample_rate': sample_rate}
+                    results.append(run_config_process(__file__, config, [
+                        '--embedding_size', str(args.embedding_size), '--warmup_runs', str(args.warmup_runs),
+                        '--num_runs', str(args.num_runs), '--num_threads', str(args.num_threads)]))
+
+    print('\n| loss | classes | batch | sample rate | forward (ms) | backward (ms) | peak RSS (MB) |')
+    print('| ---- | ------- | ----- | ----------- | ------------ | ------------- | ------------- |')
+    for result in results:
+        if 'failed' in result:
+            print('| %(loss_type)s | %(class_number)d | %(batch_size)d | %(sample_rate)g | failed | failed | - |' % result)
+        else:
+            print('| %(loss_type)s | %(class_number)d | %(batch_size)d | %(sample_rate)g | %(forward_ms).2f | '
+                  '%(backward_ms).2f | %(peak_rss_mb).1f |' % result)
+    write_results(results, args.output)
+
+
+def parse_arguments(argv):
+    '''benchmark parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loss_types', nargs='+', default=LOSS_TYPES, choices=LOSS_TYPES, help='heads to measure')
+    parser.add_argument('--class_numbers', type=int, nargs='+', default=[10000, 100000, 1000000, 2000000],
+                        help='class counts to measure')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 256, 1024], help='batch sizes to measure')
+    parser.add_argument('--sample_rates', type=float, nargs='+', default=[1.0],
+                        help='Partial-FC sample rates of the insightface/cosine/combine heads, 1.0 computes all the classes')
+    parser.add_argument('--embedding_size', type=int, default=128, help='Dimensionality of the embedding.')
+    add_benchmark_arguments(parser, warmup_runs=2, num_runs=10)
+    parser.add_argument('--output', type=str, default='', help='json file of the results, empty to print only')
+    parser.add_argument('--loss_type', default='insightface', choices=LOSS_TYPES, help='internal, head of the single configuration')
+    parser.add_argument('--class_number', type=int, default=85742, help='internal, class count of the single configuration')
+    parser.add_argument('--batch_size', type=int, default=90, help='internal, batch size of the single configuration')
+    parser.add_argument('--sample_rate', type=float, default=1.0, help='internal, sample rate of the single configuration')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+    if args.run_config:
+        run_config(args)
+    else:
+        main(args)
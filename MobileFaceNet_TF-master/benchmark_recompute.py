@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+memory versus step time of activation recomputation (gradient checkpointing) in L_Resnet_E_IR.
+every configuration runs in its own process (utils/benchmark.run_config_process), so the peak resident memory of the
+process is the peak of that configuration.
+'''
+
+from utils.benchmark import add_benchmark_arguments, session_config, time_runs, median_ms, peak_rss_mb, \
+    run_config_process
+import argparse
+import json
+import sys
+
+
+def run_config(args):
+    '''train args.num_runs steps of one configuration on random data and print a json result line.'''
+    import tensorflow as tf
+    from nets.L_Resnet_E_IR import get_resnet
+
+    with tf.Graph().as_default():
+        inputs = tf.random_uniform([args.batch_size, 112, 112, 3], maxval=255.)
+        w_init_method = tf.contrib.layers.xavier_initializer(uniform=False)
+        recompute = None if args.recompute == 'none' else args.recompute
+        embeddings, _ = get_resnet(inputs, w_init_method, args.num_layers, trainable=True, recompute=recompute)
+        loss = tf.reduce_mean(tf.square(embeddings))
+        train_op = tf.train.GradientDescentOptimizer(0.01).minimize(loss)
+
+        with tf.Session(config=session_config(args.num_threads)) as sess:
+            sess.run(tf.global_variables_initializer())
+            step_time_ms = median_ms(time_runs(lambda: sess.run(train_op), args.warmup_runs, args.num_runs))
+
+    result = {'num_layers': args.num_layers, 'recompute': args.recompute, 'batch_size': args.batch_size,
+              'step_time_ms': step_time_ms, 'peak_rss_mb': peak_rss_mb()}
+    print(json.dumps(result))
+
+
+def main(args):
+    results = []
+    for num_layers in args.num_layers_list:
+        for recompute in ['none', 'stage', 'unit']:
+            result = run_config_process(__file__, {'num_layers': num_layers, 'recompute': recompute}, [
+                '--batch_size', str(args.batch_size), '--warmup_runs', str(args.warmup_runs),
+                '--num_runs', str(args.num_runs), '--num_threads', str(args.num_threads)])
+            if 'failed' not in result:
+                results.append(result)
+
+    print('\n| model | recompute | batch | step time (ms) | peak RSS (MB) | time vs none | memory vs none |')
+    print('| ----- | --------- | ----- | -------------- | ------------- | ------------ | -------------- |')
+    for result in results:
+        base = [r for r in results if r['num_layers'] == result['num_layers'] and r['recompute'] == 'none']
+        time_ratio = result['step_time_ms'] / base[0]['step_time_ms'] if base else float('nan')
+        memory_ratio = result['peak_rss_mb'] / base[0]['peak_rss_mb'] if base else float('nan')
+        print('| ResNet-%d | %s | %d | %.1f | %.1f | %.2fx | %.2fx |' %
+              (result['num_layers'], result['recompute'], result['batch_size'], result['step_time_ms'],
+               result['peak_rss_mb'], time_ratio, memory_ratio))
+
+
+def parse_arguments(argv):
+    '''benchmark parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_layers_list', type=int, nargs='+', default=[50, 100], help='resnet depths to measure')
+    parser.add_argument('--batch_size', type=int, default=32, help='batch size of every configuration')
+    add_benchmark_arguments(parser, warmup_runs=2, num_runs=10)
+    parser.add_argument('--num_layers', type=int, default=50, help='internal, depth of the single configuration')
+    parser.add_argument('--recompute', default='none', choices=['none', 'stage', 'unit'],
+                        help='internal, recompute mode of the single configuration')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+    if args.run_config:
+        run_config(args)
+    else:
+        main(args)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+inference latency of L_Resnet_E_IR: the training graph with trainable=False (get_resnet) against the inference
+builder (get_resnet_inference), with the same weights, and the largest difference of their outputs.
+
+the weights come from --ckpt_path (a checkpoint of get_resnet, with unpruned or stripped masks) or are random,
+batch norm moving statistics included. every configuration runs in its own process (utils/benchmark.run_config_process),
+exits with 1 when the outputs of a configuration differ by more than --tolerance (relative to the largest output).
+
+eg: python benchmark_resnet_inference.py --num_layers_list 50 100 --batch_sizes 1 32
+'''
+
+from utils.benchmark import add_benchmark_arguments, session_config, time_runs, median_ms, run_config_process, \
+    write_results
+import argparse
+import tempfile
+import shutil
+import json
+import sys
+import os
+
+import numpy as np
+
+
+def run_config(args):
+    '''measure one depth and batch size and print a json result line.'''
+    import tensorflow as tf
+    from nets.L_Resnet_E_IR import get_resnet, get_resnet_inference
+
+    config = session_config(args.num_threads)
+    images = np.random.uniform(0., 255., [args.batch_size, 112, 112, 3]).astype(np.float32)
+    result = {'num_layers': args.num_layers, 'batch_size': args.batch_size}
+    ckpt_dir = tempfile.mkdtemp()
+    try:
+        ckpt = args.ckpt_path and tf.train.latest_checkpoint(args.ckpt_path)
+        with tf.Graph().as_default() as graph:
+            inputs = tf.placeholder(name='input', shape=[None, 112, 112, 3], dtype=tf.float32)
+            w_init_method = tf.contrib.layers.xavier_initializer(uniform=False)
+            embeddings, _ = get_resnet(inputs, w_init_method, args.num_layers, trainable=False)
+            result['training_graph_ops'] = len(graph.get_operations())
+            with tf.Session(config=config) as sess:
+                sess.run(tf.global_variables_initializer())
+                if ckpt:
+                    print('Restoring %s' % ckpt)
+                    tf.train.Saver([v for v in tf.global_variables() if v.op.name.startswith('ResNet/')]).restore(sess, ckpt)
+                else:
+                    # random moving statistics too, the initial ones (0, 1) would hide a missing batch norm
+                    for v in tf.global_variables():
+                        if v.op.name.endswith('mask') or v.op.name.endswith('threshold'):
+                            continue
+                        value = np.random.normal(0., 0.05, v.get_shape().as_list())
+                        if v.op.name.endswith('_var') or v.op.name.endswith('_scale'):
+                            value = np.random.uniform(0.5, 1.5, v.get_shape().as_list())
+                        v.load(value, sess)
+                saver = tf.train.Saver([v for v in tf.global_variables() if v.op.name.startswith('ResNet/')])
+                saver.save(sess, os.path.join(ckpt_dir, 'model'))
+                expected = sess.run(embeddings, feed_dict={inputs: images})
+                result['training_graph_ms'] = median_ms(time_runs(
+                    lambda: sess.run(embeddings, feed_dict={inputs: images}), args.warmup_runs, args.num_runs))
+
+        with tf.Graph().as_default() as graph:
+            inputs = tf.placeholder(name='input', shape=[None, 112, 112, 3], dtype=tf.float32)
+            embeddings, _ = get_resnet_inference(inputs, args.num_layers)
+            result['inference_graph_ops'] = len(graph.get_operations())
+            with tf.Session(config=config) as sess:
+                tf.train.Saver().restore(sess, os.path.join(ckpt_dir, 'model'))
+                actual = sess.run(embeddings, feed_dict={inputs: images})
+                result['inference_graph_ms'] = median_ms(time_runs(
+                    lambda: sess.run(embeddings, feed_dict={inputs: images}), args.warmup_runs, args.num_runs))
+    finally:
+        shutil.rmtree(ckpt_dir)
+
+    result['max_abs_diff'] = float(np.max(np.abs(actual - expected)))
+    result['max_rel_diff'] = result['max_abs_diff'] / max(float(np.max(np.abs(expected))), 1e-12)
+    print(json.dumps(result))
+
+
+def main(args):
+    results = []
+    failures = []
+    for num_layers in args.num_layers_list:
+        for batch_size in args.batch_sizes:
+            result = run_config_process(__file__, {'num_layers': num_layers, 'batch_size': batch_size}, [
+                '--warmup_runs', str(args.warmup_runs), '--num_runs', str(args.num_runs),
+                '--num_threads', str(args.num_threads), '--ckpt_path', args.ckpt_path])
+            if 'failed' in result:
+                failures.append('ResNet-%d batch %d failed with code %d' % (num_layers, batch_size, result['failed']))
+                continue
+            results.append(result)
+            if result['max_rel_diff'] > args.tolerance:
+                failures.append('ResNet-%d batch %d outputs differ by %.2e' %
+                                (num_layers, batch_size, results[-1]['max_rel_diff']))
+
+    print('\n| model | batch | training graph ops | inference graph ops | training graph (ms) | inference graph (ms) | speedup | max rel diff |')
+    print('| ----- | ----- | ------------------ | ------------------- | ------------------- | -------------------- | ------- | ------------ |')
+    for result in results:
+        print('| ResNet-%d | %d | %d | %d | %.2f | %.2f | %.2fx | %.2e |' %
+              (result['num_layers'], result['batch_size'], result['training_graph_ops'], result['inference_graph_ops'],
+               result['training_graph_ms'], result['inference_graph_ms'],
+               result['training_graph_ms'] / result['inference_graph_ms'], result['max_rel_diff']))
+    write_results(results, args.output)
+    for failure in failures:
+        print('FAIL: %s' % failure)
+    return 1 if failures else 0
+
+
+def parse_arguments(argv):
+    '''benchmark parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_layers_list', type=int, nargs='+', default=[50, 100], help='resnet depths to measure')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32], help='batch sizes to measure')
+    parser.add_argument('--ckpt_path', type=str, default='',
+                        help='checkpoint directory of get_resnet to measure, empty for random weights')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='largest allowed output difference relative to the largest output')
+    add_benchmark_arguments(parser, warmup_runs=5, num_runs=50)
+    parser.add_argument('--output', type=str, default='', help='json file of the results, empty to print only')
+    parser.add_argument('--num_layers', type=int, default=50, help='internal, depth of the single configuration')
+    parser.add_argument('--batch_size', type=int, default=1, help='internal, batch size of the single configuration')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+    if args.run_config:
+        run_config(args)
+    else:
+        sys.exit(main(args))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+measure the multi-tower data parallel scaling of train_nets.py on random in-graph data.
+for n = 1..len(train_devices), train the first n towers and report images/sec and the speedup of every device added.
+'''
+
+from train_nets import build_benchmark_train_op, get_train_devices, get_session_config
+import tensorflow as tf
+import argparse
+import time
+import sys
+
+
+def measure(devices, args):
+    '''train args.num_steps on random data with one tower per device, return images/sec.'''
+    with tf.Graph().as_default():
+        train_op = build_benchmark_train_op(devices, args.train_batch_size, args.class_number, args.embedding_size,
+                                            args.loss_type, args.optimizer)
+
+        with tf.Session(config=get_session_config(devices)) as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(args.warmup_steps):
+                sess.run(train_op)
+            start = time.time()
+            for _ in range(args.num_steps):
+                sess.run(train_op)
+            duration = time.time() - start
+    return args.train_batch_size * args.num_steps / duration
+
+
+def main(args):
+    devices = get_train_devices(args.train_devices)
+    results = []
+    for n in range(1, len(devices) + 1):
+        if args.train_batch_size % n != 0:
+            print('skip %d towers, train_batch_size %d is not divisible' % (n, args.train_batch_size))
+            continue
+        images_per_sec = measure(devices[:n], args)
+        results.append((n, images_per_sec))
+        print('%d towers: %.3f images/sec' % (n, images_per_sec))
+
+    print('\ntowers\timages/sec\tspeedup\tspeedup of the added device\tefficiency')
+    base = results[0][1]
+    previous = base
+    for n, images_per_sec in results:
+        print('%d\t%.3f\t%.3f\t%.3f\t%.3f' % (n, images_per_sec, images_per_sec / base,
+                                             images_per_sec / previous, images_per_sec / base / n))
+        previous = images_per_sec
+
+
+def parse_arguments(argv):
+    '''benchmark parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train_devices', type=str, default='/cpu:0,/cpu:1',
+                        help='comma separated devices, towers are added in this order')
+    parser.add_argument('--class_number', type=int, default=85742, help='class number of the margin loss head')
+    parser.add_argument('--embedding_size', type=int, default=128, help='Dimensionality of the embedding.')
+    parser.add_argument('--train_batch_size', type=int, default=90, help='global batch size, split between the towers')
+    parser.add_argument('--loss_type', default='insightface', help='loss type, choice type are insightface/cosine/combine')
+    parser.add_argument('--optimizer', type=str, choices=['ADAGRAD', 'ADADELTA', 'ADAM', 'RMSPROP', 'MOM'],
+                        help='The optimization algorithm to use', default='ADAM')
+    parser.add_argument('--warmup_steps', type=int, default=5, help='steps run before timing')
+    parser.add_argument('--num_steps', type=int, default=20, help='timed steps for every tower count')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+compare XLA JIT with the default tensorflow executor, for the training step and for the inference latency.
+every configuration runs in its own process (utils/benchmark.run_config_process), TF_XLA_FLAGS is only read once
+per process.
+
+the first run of a graph (or of a new input shape) pays the XLA compilation, it is reported as the compile time,
+the first run time minus the steady run time.
+'''
+
+from utils.benchmark import time_runs, run_config_process, write_results
+import argparse
+import json
+import sys
+
+import numpy as np
+
+
+def first_and_steady_runs(sess, fetch, feed_dict, num_runs):
+    '''first run time and the times of num_runs following runs, in seconds.'''
+    run = lambda: sess.run(fetch, feed_dict=feed_dict)
+    first = time_runs(run, 0, 1)[0]
+    return first, time_runs(run, 0, num_runs)
+
+
+def run_config(args):
+    '''measure one executor (xla or not) and print a json result line.'''
+    import tensorflow as tf
+    from train_nets import build_benchmark_train_op, get_session_config
+    from nets.MobileFaceNet import inference
+    from test_nets import load_model
+
+    config = get_session_config([None], xla=args.xla)
+    if args.num_threads:
+        config.intra_op_parallelism_threads = args.num_threads
+        config.inter_op_parallelism_threads = args.num_threads
+    result = {'xla': args.xla}
+
+    # training step on random in-graph data
+    with tf.Graph().as_default():
+        train_op = build_benchmark_train_op([None], args.train_batch_size, args.class_number, args.embedding_size,
+                                            args.loss_type, args.optimizer)
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            first, times = first_and_steady_runs(sess, train_op, None, args.num_steps)
+    result['train_step_ms'] = np.mean(times) * 1000.
+    result['train_compile_s'] = first - np.median(times)
+
+    # inference of the frozen graph (or of the checkpoint) given by --model, else of randomly initialized weights
+    with tf.Graph().as_default():
+        with tf.Session(config=config) as sess:
+            if args.model:
+                load_model(args.model)
+                inputs = tf.get_default_graph().get_tensor_by_name('input:0')
+                embeddings = tf.get_default_graph().get_tensor_by_name('embeddings:0')
+            else:
+                inputs = tf.placeholder(name='input', shape=[None, 112, 112, 3], dtype=tf.float32)
+                prelogits, _ = inference(inputs, bottleneck_layer_size=args.embedding_size, phase_train=False)
+                embeddings = tf.nn.l2_normalize(prelogits, 1, 1e-10, name='embeddings')
+                sess.run(tf.global_variables_initializer())
+            for batch_size in args.inference_batch_sizes:
+                feed_dict = {inputs: np.random.uniform(-1., 1., [batch_size, 112, 112, 3]).astype(np.float32)}
+                first, times = first_and_steady_runs(sess, embeddings, feed_dict, args.num_runs)
+                result['latency_ms_batch_%d' % batch_size] = np.median(times) * 1000.
+                result['latency_p99_ms_batch_%d' % batch_size] = np.percentile(times, 99) * 1000.
+                result['compile_s_batch_%d' % batch_size] = first - np.median(times)
+    print(json.dumps(result))
+
+
+def main(args):
+    results = []
+    for xla in [False, True]:
+        result = run_config_process(__file__, {'xla': xla}, sys.argv[1:])
+        if 'failed' not in result:
+            results.append(result)
+
+    rows = [('train step (ms), batch %d' % args.train_batch_size, 'train_step_ms'),
+            ('train compile (s)', 'train_compile_s')]
+    for batch_size in args.inference_batch_sizes:
+        rows += [('inference latency p50 (ms), batch %d' % batch_size, 'latency_ms_batch_%d' % batch_size),
+                 ('inference latency p99 (ms), batch %d' % batch_size, 'latency_p99_ms_batch_%d' % batch_size),
+                 ('inference compile (s), batch %d' % batch_size, 'compile_s_batch_%d' % batch_size)]
+    default = [r for r in results if not r['xla']]
+    xla = [r for r in results if r['xla']]
+    print('\n| metric | default | xla | xla vs default |')
+    print('| ------ | ------- | --- | -------------- |')
+    for name, key in rows:
+        default_value = default[0][key] if default else float('nan')
+        xla_value = xla[0][key] if xla else float('nan')
+        ratio = xla_value / default_value if 'compile' not in key and default_value else float('nan')
+        print('| %s | %.3f | %.3f | %s |' % (name, default_value, xla_value, '%.2fx' % ratio if ratio == ratio else '-'))
+    write_results(results, args.output)
+
+
+def parse_arguments(argv):
+    '''benchmark parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='',
+                        help='frozen .pb file or ckpt directory for the inference latency, empty for random weights')
+    parser.add_argument('--class_number', type=int, default=85742, help='class number of the margin loss head')
+    parser.add_argument('--embedding_size', type=int, default=128, help='Dimensionality of the embedding.')
+    parser.add_argument('--train_batch_size', type=int, default=90, help='batch size of the training step')
+    parser.add_argument('--loss_type', default='insightface', help='loss type, choice type are insightface/cosine/combine')
+    parser.add_argument('--optimizer', type=str, choices=['ADAGRAD', 'ADADELTA', 'ADAM', 'RMSPROP', 'MOM'],
+                        help='The optimization algorithm to use', default='ADAM')
+    parser.add_argument('--inference_batch_sizes', type=int, nargs='+', default=[1, 32], help='inference batch sizes')
+    parser.add_argument('--num_steps', type=int, default=20, help='timed training steps')
+    parser.add_argument('--num_runs', type=int, default=100, help='timed inference runs of every batch size')
+    parser.add_argument('--num_threads', type=int, default=0, help='intra/inter op threads, 0 lets tensorflow choose')
+    parser.add_argument('--output', type=str, default='', help='json file of the results, empty to print only')
+    parser.add_argument('--run_config', action='store_true', help='internal, run a single configuration')
+    parser.add_argument('--xla', action='store_true', help='internal, the single configuration uses XLA JIT')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+    if args.run_config:
+        run_config(args)
+    else:
+        main(args)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+startup time check of the command line entry points, with python -X importtime.
+
+every module is imported in a fresh interpreter, the report lists the total import time and the slowest
+top-level packages. the check fails when a module imports one of the --forbidden packages (mxnet, cv2 and
+sklearn are only needed by the code paths that use them) or takes longer than --max_seconds.
+
+eg: python check_startup.py train_nets test_nets --max_seconds 10
+'''
+
+import subprocess
+import argparse
+import json
+import sys
+import os
+
+
+def import_times(module):
+    '''{package: cumulative import time in seconds} of the packages imported by "import module".'''
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import %s' % module]
+    output = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if output.returncode != 0:
+        raise RuntimeError('import %s failed:\n%s' % (module, output.stderr))
+    times = {}
+    for line in output.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # drop the separator space, keep the indentation of the nested packages
+        times[name[1:].rstrip()] = int(cumulative) / 1e6
+    return times
+
+
+def check_module(module, forbidden, max_seconds, top):
+    '''print the import time of module, return the list of failures and the report.'''
+    times = import_times(module)
+    # the nested packages are indented by two spaces per level
+    top_level = {name.strip(): value for name, value in times.items() if not name.startswith(' ')}
+    total = sum(top_level.values())
+    slowest = sorted(top_level.items(), key=lambda item: -item[1])[:top]
+    print('import %s: %.3fs' % (module, total))
+    for name, value in slowest:
+        print('  %8.3fs  %s' % (value, name))
+
+    failures = []
+    imported = set(name.strip().split('.')[0] for name in times)
+    for package in forbidden:
+        if package in imported:
+            failures.append('%s imports %s' % (module, package))
+    if max_seconds and total > max_seconds:
+        failures.append('%s takes %.3fs to import, more than %.3fs' % (module, total, max_seconds))
+    return failures, {'module': module, 'seconds': total, 'top': dict(slowest)}
+
+
+def main(args):
+    failures = []
+    results = []
+    for module in args.modules:
+        module_failures, result = check_module(module, args.forbidden, args.max_seconds, args.top)
+        failures += module_failures
+        results.append(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    for failure in failures:
+        print('FAIL: %s' % failure)
+    return 1 if failures else 0
+
+
+def parse_arguments(argv):
+    '''check parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='*', default=['train_nets', 'test_nets'], help='modules to import')
+    parser.add_argument('--forbidden', nargs='*', default=['mxnet', 'cv2', 'sklearn'],
+                        help='packages that must not be imported at startup')
+    parser.add_argument('--max_seconds', type=float, default=0., help='import time budget of every module, 0 to disable')
+    parser.add_argument('--top', type=int, default=10, help='number of the slowest packages to report')
+    parser.add_argument('--output', type=str, default='', help='json file of the report, empty to print only')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    sys.exit(main(parse_arguments(sys.argv[1:])))
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+convert the dense E-output head of a trained L_Resnet_E_IR checkpoint to the low rank head (get_resnet(head='lowrank')).
+the [7x7x512, 512] kernel is factorized by SVD, W = U S V', into dense_u = U_r sqrt(S_r) and dense_v = sqrt(S_r) V_r',
+the bias moves to dense_v, the other variables are copied and the optimizer slots of the dense layer are dropped.
+fine-tune the converted checkpoint a little to recover the accuracy lost by the truncation.
+
+--rank sets the rank, or --energy the smallest rank keeping that fraction of the squared singular values.
+
+eg: python convert_resnet_head.py --ckpt_path ./output/resnet/ckpt --output ./output/resnet_lowrank/ckpt/model --energy 0.95
+'''
+
+from utils.checkpoint import read_checkpoint, write_checkpoint
+import tensorflow as tf
+import numpy as np
+import argparse
+import sys
+import os
+
+
+def factorize(kernel, rank=None, energy=None):
+    '''dense_u, dense_v and the kept squared singular value fraction of the SVD of kernel truncated to rank, or to the
+    smallest rank keeping the energy fraction.'''
+    u, s, vt = np.linalg.svd(kernel.astype(np.float64), full_matrices=False)
+    kept = np.cumsum(s ** 2) / np.sum(s ** 2)
+    if rank is None:
+        rank = int(np.searchsorted(kept, energy) + 1)
+    rank = min(rank, len(s))
+    root = np.sqrt(s[:rank])
+    dense_u = (u[:, :rank] * root).astype(kernel.dtype)
+    dense_v = (root[:, None] * vt[:rank]).astype(kernel.dtype)
+    return dense_u, dense_v, float(kept[rank - 1])
+
+
+def main(args):
+    ckpt = tf.train.latest_checkpoint(args.ckpt_path) if os.path.isdir(args.ckpt_path) else args.ckpt_path
+    print('Reading %s' % ckpt)
+    values = read_checkpoint(ckpt)
+    kernel_name = args.scope + '/dense/kernel'
+    bias_name = args.scope + '/dense/bias'
+    if kernel_name not in values:
+        raise ValueError('%s has no dense E-output head (%s)' % (ckpt, kernel_name))
+
+    kernel = values[kernel_name]
+    dense_u, dense_v, kept = factorize(kernel, args.rank, args.energy)
+    rank = dense_u.shape[1]
+    error = np.linalg.norm(kernel - np.dot(dense_u, dense_v)) / np.linalg.norm(kernel)
+
+    converted = {}
+    dropped = []
+    for name, value in values.items():
+        if name.startswith(args.scope + '/dense/'):
+            if name not in (kernel_name, bias_name):
+                dropped.append(name)
+            continue
+        converted[name] = value
+    converted[args.scope + '/dense_u/kernel'] = dense_u
+    converted[args.scope + '/dense_v/kernel'] = dense_v
+    converted[args.scope + '/dense_v/bias'] = values[bias_name]
+
+    directory = os.path.dirname(args.output)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    path = write_checkpoint(converted, args.output)
+
+    print('rank %d of %d, %.4f of the energy kept, relative reconstruction error %.4f' %
+          (rank, min(kernel.shape), kept, error))
+    print('head parameters %d -> %d (%.1fx smaller)' %
+          (kernel.size, dense_u.size + dense_v.size, float(kernel.size) / (dense_u.size + dense_v.size)))
+    if dropped:
+        print('dropped the optimizer slots %s' % ', '.join(sorted(dropped)))
+    print('written %s, build it with get_resnet(..., head=\'lowrank\', head_rank=%d)' % (path, rank))
+
+
+def parse_arguments(argv):
+    '''conversion parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt_path', type=str, required=True, help='checkpoint file or directory of the dense head model')
+    parser.add_argument('--output', type=str, required=True, help='path of the converted checkpoint')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--rank', type=int, help='rank of the factorized head')
+    group.add_argument('--energy', type=float, help='fraction of the squared singular values to keep, sets the rank')
+    parser.add_argument('--scope', type=str, default='ResNet', help='variable scope of the network')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+fine-tune the pretrained MobileFaceNet to a small dataset (eg: the employees of one company) with a frozen backbone.
+
+1. extract: run the frozen backbone once over the dataset, cache the GDConv (or prelogits) features of every image
+   and of its horizontal flip to disk.
+2. train: train only the embedding projection (MobileFaceNet/Logits/LinearConv1x1, gdconv features) and the margin
+   loss head from the cache, every epoch is a matrix multiply instead of a CNN pass.
+3. export: merge the fine-tuned projection into the pretrained backbone and save a checkpoint with its meta graph,
+   ready for test_nets.py and utils/freeze_graph.py.
+'''
+
+from losses.face_losses import insightface_loss, cosineface_loss, combine_loss
+from nets.MobileFaceNet import inference, mobilenet_v2_arg_scope
+from utils.checkpoint import backbone_variables
+from utils.data_process import parse_function, get_train_dataset
+from utils.common import train
+import tensorflow as tf
+import numpy as np
+import argparse
+import time
+import sys
+import os
+
+slim = tf.contrib.slim
+
+PROJECTION_SCOPE = 'MobileFaceNet/Logits/LinearConv1x1'
+
+
+def restore_pretrained(sess, var_list, pretrained_model):
+    ckpt = tf.train.get_checkpoint_state(os.path.expanduser(pretrained_model))
+    print('Restoring pretrained model: %s' % ckpt.model_checkpoint_path)
+    tf.train.Saver(var_list).restore(sess, ckpt.model_checkpoint_path)
+
+
+def extract_features(args):
+    '''cache the frozen backbone features of every image and of its flip, shape (N, 2, D).'''
+    with tf.Graph().as_default():
+        dataset = get_train_dataset(args.tfrecords_file_path)
+        dataset = dataset.map(lambda example: parse_function(example, random_flip=False))
+        dataset = dataset.batch(args.batch_size)
+        images, labels = dataset.make_one_shot_iterator().get_next()
+        # the flipped copy goes through the same batch, so one pass gives both views
+        inputs = tf.concat([images, tf.reverse(images, axis=[2])], axis=0)
+        prelogits, net_points = inference(inputs, bottleneck_layer_size=args.embedding_size, phase_train=False)
+        if args.feature_type == 'gdconv':
+            features = tf.squeeze(net_points['GDConv'], [1, 2])
+        else:
+            features = prelogits
+        features = tf.stack(tf.split(features, 2), axis=1)
+
+        features_list = []
+        labels_list = []
+        with tf.Session() as sess:
+            restore_pretrained(sess, backbone_variables(), args.pretrained_model)
+            start = time.time()
+            while True:
+                try:
+                    features_val, labels_val = sess.run([features, labels])
+                except tf.errors.OutOfRangeError:
+                    break
+                features_list.append(features_val)
+                labels_list.append(labels_val)
+                if len(features_list) % 100 == 0:
+                    print('%d images extracted' % (len(features_list) * args.batch_size))
+
+    features = np.concatenate(features_list).astype(np.float32)
+    labels = np.concatenate(labels_list)
+    print('%d images extracted in %.3fs, feature size %d' % (features.shape[0], time.time() - start, features.shape[-1]))
+    if not os.path.exists(args.cache_path):
+        os.makedirs(args.cache_path)
+    np.save(os.path.join(args.cache_path, args.feature_type + '_features.npy'), features)
+    np.save(os.path.join(args.cache_path, args.feature_type + '_labels.npy'), labels)
+
+
+def build_head(features, labels, args, phase_train):
+    '''the embedding projection (gdconv features only) and the margin loss head.'''
+    if args.feature_type == 'gdconv':
+        # same variable names as MobileFaceNet, so the projection merges back into the full model
+        arg_scope = mobilenet_v2_arg_scope(is_training=phase_train, weight_decay=args.weight_decay)
+        with slim.arg_scope(arg_scope), tf.variable_scope('MobileFaceNet/Logits'):
+            net = tf.reshape(features, [-1, 1, 1, features.get_shape().as_list()[-1]])
+            prelogits = slim.conv2d(net, args.embedding_size, kernel_size=[1, 1], stride=1, activation_fn=None,
+                                    scope='LinearConv1x1')
+            prelogits = tf.squeeze(prelogits, [1, 2])
+    else:
+        prelogits = features
+    embeddings = tf.nn.l2_normalize(prelogits, 1, 1e-10, name='embeddings')
+
+    w_init_method = slim.initializers.xavier_initializer()
+    if args.loss_type == 'insightface':
+        inference_loss, logit = insightface_loss(embeddings, labels, args.class_number, w_init_method)
+    elif args.loss_type == 'cosine':
+        inference_loss, logit = cosineface_loss(embeddings, labels, args.class_number, w_init_method)
+    elif args.loss_type == 'combine':
+        inference_loss, logit = combine_loss(embeddings, labels, args.batch_size, args.class_number, w_init_method)
+    else:
+        assert 0, 'loss type error, choice item just one of [insightface, cosine, combine], please check!'
+    return inference_loss, logit
+
+
+def train_head(args):
+    '''train the projection and the margin head for max_epoch epochs over the cached features.'''
+    features_cache = np.load(os.path.join(args.cache_path, args.feature_type + '_features.npy'))
+    labels_cache = np.load(os.path.join(args.cache_path, args.feature_type + '_labels.npy'))
+    nrof_images = features_cache.shape[0]
+    print('train on %d cached features of %d classes' % (nrof_images, args.class_number))
+
+    with tf.Graph().as_default():
+        global_step = tf.Variable(name='global_step', initial_value=0, trainable=False)
+        features = tf.placeholder(name='features', shape=[args.batch_size, features_cache.shape[-1]], dtype=tf.float32)
+        labels = tf.placeholder(name='labels', shape=[args.batch_size], dtype=tf.int64)
+        learning_rate = tf.placeholder(name='learning_rate', shape=[], dtype=tf.float32)
+        inference_loss, logit = build_head(features, labels, args, phase_train=True)
+        tf.add_to_collection('losses', inference_loss)
+        regularization_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
+        total_loss = tf.add_n([inference_loss] + regularization_losses, name='total_loss')
+        train_op, _ = train(total_loss, global_step, args.optimizer, learning_rate, args.moving_average_decay,
+                            tf.trainable_variables(), [], log_histograms=False)
+        accuracy = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(logit, 1), labels), tf.float32))
+        saver = tf.train.Saver(tf.trainable_variables())
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            if args.feature_type == 'gdconv':
+                # start the projection from the pretrained one
+                restore_pretrained(sess, [v for v in tf.trainable_variables() if v.op.name.startswith(PROJECTION_SCOPE)],
+                                   args.pretrained_model)
+            for epoch in range(args.max_epoch):
+                lr = args.learning_rate * 0.1 ** sum(epoch >= boundary for boundary in args.lr_schedule)
+                start = time.time()
+                index = np.random.permutation(nrof_images)
+                # one of the two cached views, like random_flip_left_right
+                views = np.random.randint(0, 2, nrof_images)
+                losses = []
+                accuracies = []
+                for b in range(nrof_images // args.batch_size):
+                    batch = index[b * args.batch_size:(b + 1) * args.batch_size]
+                    feed_dict = {features: features_cache[batch, views[batch]], labels: labels_cache[batch],
+                                 learning_rate: lr}
+                    _, loss_val, acc_val = sess.run([train_op, total_loss, accuracy], feed_dict=feed_dict)
+                    losses.append(loss_val)
+                    accuracies.append(acc_val)
+                print('epoch %d, lr %g, total loss is %.4f, training accuracy is %.6f, time %.3fs' %
+                      (epoch, lr, np.mean(losses), np.mean(accuracies), time.time() - start))
+
+            if not os.path.exists(args.finetune_path):
+                os.makedirs(args.finetune_path)
+            saver.save(sess, os.path.join(args.finetune_path, 'head.ckpt'))
+
+
+def export(args):
+    '''pretrained backbone + fine-tuned projection, saved with the inference meta graph.'''
+    with tf.Graph().as_default():
+        inputs = tf.placeholder(name='img_inputs', shape=[None, 112, 112, 3], dtype=tf.float32)
+        inputs = tf.identity(inputs, 'input')
+        prelogits, _ = inference(inputs, bottleneck_layer_size=args.embedding_size, phase_train=False)
+        tf.nn.l2_normalize(prelogits, 1, 1e-10, name='embeddings')
+
+        backbone_vars = backbone_variables()
+        projection_vars = [v for v in backbone_vars if v.op.name.startswith(PROJECTION_SCOPE)]
+        with tf.Session() as sess:
+            restore_pretrained(sess, [v for v in backbone_vars if v not in projection_vars], args.pretrained_model)
+            if args.feature_type == 'gdconv':
+                tf.train.Saver(projection_vars).restore(sess, os.path.join(args.finetune_path, 'head.ckpt'))
+            else:
+                restore_pretrained(sess, projection_vars, args.pretrained_model)
+            export_path = os.path.join(args.finetune_path, 'export')
+            if not os.path.exists(export_path):
+                os.makedirs(export_path)
+            filename = tf.train.Saver(backbone_vars).save(sess, os.path.join(export_path, 'MobileFaceNet_finetune.ckpt'))
+            print('export fine-tuned model to %s' % filename)
+
+
+def main(args):
+    features_path = os.path.join(args.cache_path, args.feature_type + '_features.npy')
+    if args.refresh_cache or not os.path.exists(features_path):
+        extract_features(args)
+    train_head(args)
+    export(args)
+
+
+def parse_arguments(argv):
+    '''fine-tune parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrained_model', type=str, default='./arch/pretrained_model',
+                        help='directory of the pretrained MobileFaceNet checkpoint')
+    parser.add_argument('--tfrecords_file_path', type=str, required=True,
+                        help='directory of the tran*.tfrecords files of the fine-tune dataset, same format as utils/data_process.py')
+    parser.add_argument('--class_number', type=int, required=True, help='class number of the fine-tune dataset')
+    parser.add_argument('--feature_type', default='gdconv', choices=['gdconv', 'prelogits'],
+                        help='gdconv trains the embedding projection and the margin head, prelogits only the margin head')
+    parser.add_argument('--embedding_size', type=int, help='Dimensionality of the embedding.', default=128)
+    parser.add_argument('--cache_path', default='./output/finetune_cache', help='the feature cache path')
+    parser.add_argument('--refresh_cache', action='store_true', help='extract the features again even if the cache exists')
+    parser.add_argument('--finetune_path', default='./output/finetune', help='the fine-tuned ckpt file save path')
+    parser.add_argument('--max_epoch', type=int, default=100, help='epoch to train the head')
+    parser.add_argument('--batch_size', type=int, default=90, help='batch size of the extraction and of the head training')
+    parser.add_argument('--learning_rate', type=float, default=0.01, help='initial learning rate')
+    parser.add_argument('--lr_schedule', type=int, nargs='+', default=[40, 70, 90],
+                        help='epochs at which the learning rate is divided by 10')
+    parser.add_argument('--weight_decay', type=float, default=5e-5, help='L2 weight regularization.')
+    parser.add_argument('--optimizer', type=str, choices=['ADAGRAD', 'ADADELTA', 'ADAM', 'RMSPROP', 'MOM'],
+                        help='The optimization algorithm to use', default='ADAM')
+    parser.add_argument('--moving_average_decay', type=float,
+                        help='Exponential decay for tracking of training parameters.', default=0.999)
+    parser.add_argument('--loss_type', default='insightface', help='loss type, choice type are insightface/cosine/combine')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -1,63 +1,120 @@
 import tensorflow as tf
 import math
 
+# the class weights gathered by the sampled heads, with the variable and the class indices they are gathered
+# from, in the same order, see select_classes
+SAMPLED_WEIGHTS = 'sampled_class_weights'
+SAMPLED_WEIGHTS_VARIABLES = 'sampled_class_weights_variables'
+SAMPLED_WEIGHTS_INDICES = 'sampled_class_weights_indices'
 
-def insightface_loss(embedding, labels, out_num, w_init=None, s=64., m=0.5):
+
+def sample_classes(labels, out_num, num_sample, name='sample_classes'):
+    '''
+    Partial-FC class sampling, the classes of the batch plus random negative classes, num_sample classes in total.
+    only O(out_num) scalars are touched, the weights of the unsampled classes are never read.
+    :param labels: the input labels, the shape should be eg: (batch_size,)
+    :param out_num: output class num
+    :param num_sample: number of sampled classes, at least the number of distinct classes of the batch
+    :return: the sampled class indices (num_sample,), the labels as indices into the sampled classes
+    '''
+    with tf.name_scope(name):
+        # the batch classes score in [1, 2), the other classes in [0, 1), so top_k keeps all of the batch classes
+        positive = tf.minimum(tf.unsorted_segment_sum(tf.ones_like(labels, dtype=tf.float32), labels, out_num), 1.)
+        scores = tf.random_uniform([out_num]) + positive
+        check = tf.assert_less_equal(tf.size(tf.unique(labels)[0]), num_sample,
+                                     message='num_sample is smaller than the number of classes of the batch')
+        with tf.control_dependencies([check]):
+            _, class_indices = tf.nn.top_k(scores, k=num_sample, sorted=False)
+        positions = tf.scatter_nd(tf.expand_dims(class_indices, 1), tf.range(num_sample), [out_num])
+        sampled_labels = tf.cast(tf.gather(positions, labels), tf.int64)
+    return class_indices, sampled_labels
+
+
+def select_classes(weights, class_indices, out_num):
+    '''
+    the weight columns the logits are computed for.
+    :param weights: the class weights, shape (embedding_size, out_num)
+    :param class_indices: the class indices, eg: from sample_classes, None for all of the out_num classes
+    :return: the selected weights, the number of selected classes
+    '''
+    if class_indices is None:
+        return weights, out_num
+    sampled_weights = tf.gather(weights, class_indices, axis=1, name='sampled_weights')
+    tf.add_to_collection(SAMPLED_WEIGHTS, sampled_weights)
+    tf.add_to_collection(SAMPLED_WEIGHTS_VARIABLES, weights)
+    tf.add_to_collection(SAMPLED_WEIGHTS_INDICES, class_indices)
+    return sampled_weights, class_indices.get_shape().as_list()[0]
+
+
+def scatter_add(tensor, indices, updates):
+    '''
+    tensor plus updates at indices, without a dense tensor of the updates next to tensor and the sum.
+    tf.tensor_scatter_nd_add (tensorflow >= 1.14) can reuse the buffer of tensor, older versions add a SparseTensor.
+    :param tensor: the dense tensor, eg: the logits (batch_size, out_num)
+    :param indices: int64 indices into tensor, shape (n, rank)
+    :param updates: the values added at indices, shape (n,)
+    :return: the sum, same shape as tensor
+    '''
+    if hasattr(tf, 'tensor_scatter_nd_add'):
+        return tf.tensor_scatter_nd_add(tensor, indices, updates)
+    return tf.sparse_add(tensor, tf.SparseTensor(indices, updates, tf.shape(tensor, out_type=tf.int64)))
+
+
+def apply_target_margin(zy, labels, new_cos_t_fn, s):
+    '''
+    replace the target logit of every row by its margin version, without [batch_size, out_num] masks.
+    only the batch_size target logits are gathered, changed and added back with scatter_add, the logits are the
+    only [batch_size, out_num] tensor next to zy.
+    :param zy: the scaled cosines s * cos_t, shape (batch_size, out_num)
+    :param labels: the input labels, shape (batch_size,)
+    :param new_cos_t_fn: the margin applied to the target cosines, eg: lambda cos_t: target_margin(cos_t, ...)
+    :param s: scalar value
+    :return: the logits
+    '''
+    ordinal = tf.range(tf.shape(labels, out_type=tf.int64)[0], dtype=tf.int64)
+    ordinal_y = tf.stack([ordinal, tf.cast(labels, tf.int64)], axis=1)
+    sel_zy = tf.gather_nd(zy, ordinal_y)
+    new_zy = s * new_cos_t_fn(sel_zy / s)
+    return scatter_add(zy, ordinal_y, tf.subtract(new_zy, sel_zy))
+
+
+def insightface_loss(embedding, labels, out_num, w_init=None, s=64., m=0.5, class_indices=None):
     '''
     :param embedding: the input embedding vectors
     :param labels:  the input labels, the shape should be eg: (batch_size, 1)
     :param s: scalar value default is 64
     :param out_num: output class num
     :param m: the margin value, default is 0.5
+    :param class_indices: the classes the logits are computed for (Partial-FC), labels index into them, None for all
     :return: the final cacualted output, this output is send into the tf.nn.softmax directly
     '''
-    cos_m = math.cos(m)
-    sin_m = math.sin(m)
-    mm = sin_m * m  # issue 1
-    threshold = math.cos(math.pi - m)
     with tf.variable_scope('insightface_loss'):
         # inputs and weights norm
         embedding_norm = tf.norm(embedding, axis=1, keepdims=True)
         embedding = tf.div(embedding, embedding_norm, name='norm_embedding')
         weights = tf.get_variable(name='embedding_weights', shape=(embedding.get_shape().as_list()[-1], out_num),
                                   initializer=w_init, dtype=tf.float32)
+        weights, _ = select_classes(weights, class_indices, out_num)
         weights_norm = tf.norm(weights, axis=0, keepdims=True)
         weights = tf.div(weights, weights_norm, name='norm_weights')
-        # cos(theta+m)
-        cos_t = tf.matmul(embedding, weights, name='cos_t')
-        cos_t2 = tf.square(cos_t, name='cos_2')
-        sin_t2 = tf.subtract(1., cos_t2, name='sin_2')
-        sin_t = tf.sqrt(sin_t2, name='sin_t')
-        cos_mt = s * tf.subtract(tf.multiply(cos_t, cos_m), tf.multiply(sin_t, sin_m), name='cos_mt')
-
-        # this condition controls the theta+m should in range [0, pi]
-        #      0<=theta+m<=pi
-        #     -m<=theta<=pi-m
-        cond_v = cos_t - threshold
-        cond = tf.cast(tf.nn.relu(cond_v, name='if_else'), dtype=tf.bool)
-
-        keep_val = s*(cos_t - mm)
-        cos_mt_temp = tf.where(cond, cos_mt, keep_val)
-
-        mask = tf.one_hot(labels, depth=out_num, name='one_hot_mask')
-        # mask = tf.squeeze(mask, 1)
-        inv_mask = tf.subtract(1., mask, name='inverse_mask')
-
-        s_cos_t = tf.multiply(s, cos_t, name='scalar_cos_t')
-
-        logit = tf.add(tf.multiply(s_cos_t, inv_mask), tf.multiply(cos_mt_temp, mask), name='arcface_loss_output')
+        # s * cos(theta), the scale is applied to the embedding, not to the logit matrix
+        s_cos_t = tf.matmul(s * embedding, weights, name='scalar_cos_t')
+        # cos(theta+m) for the target classes only, see target_margin for the range condition of theta+m
+        logit = apply_target_margin(s_cos_t, labels, lambda cos_t: target_margin(cos_t, 'insightface', m), s)
+        logit = tf.identity(logit, name='arcface_loss_output')
         inference_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logit, labels=labels))
 
     return inference_loss, logit
 
 
-def cosineface_loss(embedding, labels, out_num, w_init=None, s=30., m=0.4):
+def cosineface_loss(embedding, labels, out_num, w_init=None, s=30., m=0.4, class_indices=None):
     '''
     :param embedding: the input embedding vectors
     :param labels:  the input labels, the shape should be eg: (batch_size, 1)
     :param s: scalar value, default is 30
     :param out_num: output class num
     :param m: the margin value, default is 0.4
+    :param class_indices: the classes the logits are computed for (Partial-FC), labels index into them, None for all
     :return: the final cacualted output, this output is send into the tf.nn.softmax directly
     '''
     with tf.variable_scope('cosineface_loss'):
@@ -66,59 +123,45 @@ def cosineface_loss(embedding, labels, out_num, w_init=None, s=30., m=0.4):
         embedding = tf.div(embedding, embedding_norm, name='norm_embedding')
         weights = tf.get_variable(name='embedding_weights', shape=(embedding.get_shape().as_list()[-1], out_num),
                                   initializer=w_init, dtype=tf.float32)
+        weights, _ = select_classes(weights, class_indices, out_num)
         weights_norm = tf.norm(weights, axis=0, keep_dims=True)
         weights = tf.div(weights, weights_norm, name='norm_weights')
-        # cos_theta - m
-        cos_t = tf.matmul(embedding, weights, name='cos_t')
-        cos_t_m = tf.subtract(cos_t, m, name='cos_t_m')
-
-        mask = tf.one_hot(labels, depth=out_num, name='one_hot_mask')
-        inv_mask = tf.subtract(1., mask, name='inverse_mask')
-
-        logit = tf.add(s * tf.multiply(cos_t, inv_mask), s * tf.multiply(cos_t_m, mask), name='cosineface_loss_output')
+        # s * cos_theta, then s * (cos_theta - m) for the target classes only
+        s_cos_t = tf.matmul(s * embedding, weights, name='scalar_cos_t')
+        logit = apply_target_margin(s_cos_t, labels, lambda cos_t: target_margin(cos_t, 'cosine', m), s)
+        logit = tf.identity(logit, name='cosineface_loss_output')
         inference_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logit, labels=labels))
 
     return inference_loss, logit
 
 
-def combine_loss(embedding, labels, batch_size, out_num, w_init, margin_a=1., margin_m=0.3, margin_b=0.2, s=64.):
+def combine_loss(embedding, labels, batch_size, out_num, w_init, margin_a=1., margin_m=0.3, margin_b=0.2, s=64.,
+                 class_indices=None):
     '''
     This code is contributed by RogerLo. Thanks for you contribution.
 
     :param embedding: the input embedding vectors
     :param labels:  the input labels, the shape should be eg: (batch_size, 1)
     :param s: scalar value default is 64
-    :param batch_size: input batch size
+    :param batch_size: input batch size, unused, apply_target_margin reads it from labels
     :param out_num: output class num
     :param m: the margin value, default is 0.5
+    :param class_indices: the classes the logits are computed for (Partial-FC), labels index into them, None for all
     :return: the final cacualted output, this output is send into the tf.nn.softmax directly
     '''
     with tf.variable_scope('combine_loss'):
         weights = tf.get_variable(name='embedding_weights', shape=(embedding.get_shape().as_list()[-1], out_num),
                                   initializer=w_init, dtype=tf.float32)
+        weights, _ = select_classes(weights, class_indices, out_num)
         weights_unit = tf.nn.l2_normalize(weights, axis=0)
         embedding_unit = tf.nn.l2_normalize(embedding, axis=1)
         cos_t = tf.matmul(embedding_unit, weights_unit)
-        ordinal = tf.constant(list(range(0, batch_size)), tf.int64)
-        ordinal_y = tf.stack([ordinal, labels], axis=1)
         zy = cos_t * s
-        sel_cos_t = tf.gather_nd(zy, ordinal_y)
+        updated_logits = zy
+        # the margins of target_margin for the target classes only, the plain scaled cosines without margins
         if margin_a != 1.0 or margin_m != 0.0 or margin_b != 0.0:
-            if margin_a == 1.0 and margin_m == 0.0:
-                s_m = s * margin_b
-                new_zy = sel_cos_t - s_m
-            else:
-                cos_value = sel_cos_t / s
-                t = tf.acos(cos_value)
-                if margin_a != 1.0:
-                    t = t * margin_a
-                if margin_m > 0.0:
-                    t = t + margin_m
-                body = tf.cos(t)
-                if margin_b > 0.0:
-                    body = body - margin_b
-                new_zy = body * s
-        updated_logits = tf.add(zy, tf.scatter_nd(ordinal_y, tf.subtract(new_zy, sel_cos_t), (batch_size, out_num)))
+            updated_logits = apply_target_margin(
+                zy, labels, lambda cos_t: target_margin(cos_t, 'combine', margin_m, margin_a, margin_b), s)
         loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels, logits=updated_logits))
         # predict_cls = tf.argmax(updated_logits, 1)
         # accuracy = tf.reduce_mean(tf.cast(tf.equal(tf.cast(predict_cls, tf.int64), tf.cast(labels, tf.int64)), 'float'))
@@ -128,6 +171,92 @@ def combine_loss(embedding, labels, batch_size, out_num, w_init, margin_a=1., ma
 
     return loss, updated_logits
 
+def target_margin(cos_t, loss_type, m, margin_a=1., margin_b=0.2):
+    '''
+    the margin applied to the cosine of the target class, same as insightface_loss, cosineface_loss and combine_loss.
+    :param cos_t: the cosines between the embeddings and the weights of their own class, shape (n,)
+    :param loss_type: insightface/cosine/combine
+    :param m: the margin value, the margin_m of combine
+    :return: the cosines with margin, shape (n,)
+    '''
+    if loss_type == 'insightface':
+        # cos(theta+m) while 0<=theta+m<=pi
+        sin_t = tf.sqrt(tf.subtract(1., tf.square(cos_t)), name='sin_t')
+        cos_mt = tf.subtract(cos_t * math.cos(m), sin_t * math.sin(m), name='cos_mt')
+        return tf.where(cos_t > math.cos(math.pi - m), cos_mt, cos_t - math.sin(m) * m)
+    elif loss_type == 'cosine':
+        return tf.subtract(cos_t, m, name='cos_t_m')
+    elif loss_type == 'combine':
+        if margin_a == 1.0 and m == 0.0:
+            return cos_t - margin_b
+        t = tf.acos(cos_t)
+        if margin_a != 1.0:
+            t = t * margin_a
+        if m > 0.0:
+            t = t + m
+        body = tf.cos(t)
+        if margin_b > 0.0:
+            body = body - margin_b
+        return body
+    raise ValueError('loss type error, choice item just one of [insightface, cosine, combine], please check!')
+
+
+def sharded_margin_loss(embedding, labels, out_num, devices, w_init=None, loss_type='insightface', s=None, m=None,
+                        margin_a=1., margin_b=0.2):
+    '''
+    model parallel margin loss, the class weights are split by class ranges across devices.
+    every shard computes its local logits, the margin of its own target classes, its max, argmax and sum of exp,
+    only those (batch_size,) vectors are combined into the softmax normalizer and the predictions on the first device,
+    the logits of all classes are never gathered.
+    :param embedding: the input embedding vectors
+    :param labels:  the input labels, the shape should be eg: (batch_size,)
+    :param out_num: output class num
+    :param devices: the devices of the shards, eg: ['/cpu:0', '/cpu:1'], shard i holds the variable embedding_weights_i
+    :param loss_type: insightface/cosine/combine, the margin of the loss
+    :param s: scalar value, None for the default of the loss
+    :param m: the margin value, None for the default of the loss
+    :return: the loss, the predicted class of every row (argmax of the logits with margin, for the training accuracy)
+    '''
+    # variable scope, s and m of the unsharded losses
+    defaults = {'insightface': ('insightface_loss', 64., 0.5), 'cosine': ('cosineface_loss', 30., 0.4),
+                'combine': ('combine_loss', 64., 0.3)}
+    scope = defaults[loss_type][0]
+    s = defaults[loss_type][1] if s is None else s
+    m = defaults[loss_type][2] if m is None else m
+    num_shards = len(devices)
+    bounds = [out_num * i // num_shards for i in range(num_shards + 1)]
+    with tf.variable_scope(scope):
+        embedding_unit = tf.nn.l2_normalize(embedding, axis=1)
+        batch = tf.shape(labels, out_type=tf.int64)[0]
+        maxes, argmaxes, sums, targets = [], [], [], []
+        for i, device in enumerate(devices):
+            with tf.device(device), tf.name_scope('shard_%d' % i):
+                weights = tf.get_variable(name='embedding_weights_%d' % i, initializer=w_init, dtype=tf.float32,
+                                          shape=(embedding.get_shape().as_list()[-1], bounds[i + 1] - bounds[i]))
+                cos_t = tf.matmul(embedding_unit, tf.nn.l2_normalize(weights, axis=0), name='cos_t')
+                # the rows whose target class is in this shard
+                rows = tf.where(tf.logical_and(labels >= bounds[i], labels < bounds[i + 1]))[:, 0]
+                index = tf.stack([rows, tf.gather(labels, rows) - bounds[i]], axis=1)
+                sel_cos_t = tf.gather_nd(cos_t, index)
+                new_cos_t = target_margin(sel_cos_t, loss_type, m, margin_a, margin_b)
+                logit = scatter_add(s * cos_t, index, s * (new_cos_t - sel_cos_t))
+                local_max = tf.stop_gradient(tf.reduce_max(logit, axis=1))
+                maxes.append(local_max)
+                argmaxes.append(tf.argmax(logit, axis=1) + bounds[i])
+                sums.append(tf.reduce_sum(tf.exp(logit - tf.expand_dims(local_max, 1)), axis=1))
+                targets.append(tf.scatter_nd(tf.expand_dims(rows, 1), s * new_cos_t, tf.expand_dims(batch, 0)))
+        with tf.device(devices[0]):
+            stacked_maxes = tf.stack(maxes, axis=1)
+            global_max = tf.reduce_max(stacked_maxes, axis=1)
+            normalizer = tf.add_n([local_sum * tf.exp(local_max - global_max) for local_sum, local_max in zip(sums, maxes)])
+            log_normalizer = global_max + tf.log(normalizer)
+            inference_loss = tf.reduce_mean(log_normalizer - tf.add_n(targets), name='inference_loss')
+            # the argmax of the shard with the largest max, the first one on ties like an argmax over all classes
+            best_shard = tf.stack([tf.range(batch), tf.argmax(stacked_maxes, axis=1)], axis=1)
+            predictions = tf.gather_nd(tf.stack(argmaxes, axis=1), best_shard, name='sharded_predictions')
+    return inference_loss, predictions
+
+
 def center_loss(features, label, alfa, nrof_classes):
     """Center loss based on the paper "A Discriminative Feature Learning Approach for Deep Face Recognition"
        (http://ydwen.github.io/papers/WenECCV16.pdf)
@@ -172,10 +301,8 @@ def cos_loss(x, y, num_cls, reuse=False, alpha=0.35, scale=64, name='cos_loss'):
     # substract the marigin and scale it
     # value = coco_func(xw_norm,y,alpha) * scale
 
-    # implemented by tf api
-    margin_xw_norm = xw_norm - alpha
-    label_onehot = tf.one_hot(y, num_cls)
-    value = scale * tf.where(tf.equal(label_onehot, 1), margin_xw_norm, xw_norm)
+    # implemented by tf api, the margin is only computed for the target classes
+    value = apply_target_margin(scale * xw_norm, y, lambda cos_t: cos_t - alpha, scale)
 
     # compute the loss as softmax loss
     cos_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=y, logits=value))
@@ -36,7 +36,7 @@ import sys
 
 variable_scope = 'ResNet'
 
-def residual_unit_v3(data, out_filter, stride, dim_match, trainable, name):
+def residual_unit_v3(data, out_filter, stride, dim_match, trainable, name, mid_filter=None):
     """Return ResNet Unit symbol for building ResNet
     Parameters
     ----------
@@ -52,11 +52,13 @@ def residual_unit_v3(data, out_filter, stride, dim_match, trainable, name):
         trainning or testing, True is trainning, otherwise is testing.
     name : str
         Base name of the operators
+    mid_filter : int
+        Number of channels between the two 3x3 convolutions, out_filter when None (channel pruned units are narrower)
     """
     shape = [3, 3]
     in_filter= data.get_shape().as_list()[-1]
     shape.append(int(in_filter))
-    shape.append((out_filter))
+    shape.append((mid_filter or out_filter))
 
     # print(name)
 
@@ -67,6 +69,7 @@ def residual_unit_v3(data, out_filter, stride, dim_match, trainable, name):
     relu1 = prelu(bn2, trainable=trainable, name=name + '_relu1')
     relu1_pad = tf.pad(relu1, paddings=[[0, 0], [1, 1], [1, 1], [0, 0]])
     shape[-2] = relu1_pad.get_shape().as_list()[-1]
+    shape[-1] = out_filter
     conv2 = convolution(relu1_pad, group=1, shape=shape, strides=stride, padding='VALID', trainable=trainable, name=name + '_conv2')
     bn3 = batch_normalization(conv2, variance_epsilon=2e-5, trainable=trainable, name=name + '_bn3')
 
@@ -85,7 +88,9 @@ def residual_unit_v3(data, out_filter, stride, dim_match, trainable, name):
 
 
 def residual_unit(data, out_filter, stride, dim_match, trainable, name, **kwargs):
-    return residual_unit_v3(data, out_filter, stride, dim_match, trainable, name=name, **kwargs)
+    # ops of the unit under its own name scope (per layer profiles), the variable names are unchanged
+    with tf.name_scope(name):
+        return residual_unit_v3(data, out_filter, stride, dim_match, trainable, name=name, **kwargs)
 
 def prelu(input, trainable, name):
     gamma = tf.get_variable(initializer=tf.constant(0.25,dtype=tf.float32,shape=[input.get_shape()[-1]]), trainable=trainable, name=name + "_gamma")
@@ -122,23 +127,116 @@ def batch_normalization(input, trainable, name, **kwargs):
 
     return tf.nn.batch_normalization(input, mean, variance, offset, scale, name=name, **kwargs)
 
-def convolution(input, group, shape, trainable, name, **kwargs):
+GROUPED_CONVOLUTIONS = ('fused', 'native', 'split')
+
+def grouped_convolution(input, w, group, strides=(1, 1), padding='VALID', dilation_rate=(1, 1), name=None):
+    """Grouped convolution without splitting the input, w is [h, w, in_channels / group, out_channels].
+
+    A depthwise convolution with a channel multiplier of out_channels / group computes the products of every
+    input channel with the weights of its group, the in_channels / group products of an output are then summed.
+    With one input channel per group (depthwise) it is a single DepthwiseConv2dNative. With more, the depthwise
+    output before the sum is in_channels / group times larger than the output (eg: 128x for 256 channels in 2
+    groups), more memory and time than the split convolutions.
+    """
+    kernel_h, kernel_w, group_channels, out_channels = w.get_shape().as_list()
+    multiplier = out_channels // group
+    # [h, w, group_channels, group, multiplier] -> [h, w, group * group_channels, multiplier]
+    w = tf.reshape(w, [kernel_h, kernel_w, group_channels, group, multiplier])
+    w = tf.reshape(tf.transpose(w, [0, 1, 3, 2, 4]), [kernel_h, kernel_w, group * group_channels, multiplier])
+    layer = tf.nn.depthwise_conv2d(input, w, strides=[1] + list(strides) + [1], padding=padding,
+                                   rate=list(dilation_rate), name=name if group_channels == 1 else None)
+    if group_channels == 1:
+        return layer
+    shape = tf.shape(layer)
+    layer = tf.reshape(layer, tf.concat([shape[:3], [group, group_channels, multiplier]], axis=0))
+    layer = tf.reduce_sum(layer, axis=4)
+    return tf.reshape(layer, tf.concat([shape[:3], [out_channels]], axis=0), name=name)
+
+def convolution(input, group, shape, trainable, name, grouped=None, **kwargs):
+    """grouped: how a convolution with group > 1 runs, 'fused' as a depthwise convolution (grouped_convolution),
+    'native' as a single Conv2D with the grouped weights (only the tensorflow builds with grouped Conv2D kernels,
+    cuDNN), 'split' as one convolution per group concatenated. None is 'fused' for the depthwise convolutions (one
+    input channel per group, a single op) and 'split' for the others, see benchmark_grouped_conv.py.
+    """
     w = tf.get_variable(initializer=tf.truncated_normal(shape, stddev=0.1), trainable=trainable, name=name + "_weight")
+    if grouped is None:
+        grouped = 'fused' if shape[2] == 1 else 'split'
     if group == 1:
         layer = tf.nn.convolution(input, pruning.apply_mask(w, name + "_weight"), **kwargs)
-    else:
-        weight_groups = tf.split(w, num_or_size_splits=group, axis=-1)
+    elif grouped == 'fused':
+        layer = grouped_convolution(input, pruning.apply_mask(w, name + "_weight"), group, **kwargs)
+    elif grouped == 'native':
+        strides = kwargs.get('strides', (1, 1))
+        dilations = kwargs.get('dilation_rate', (1, 1))
+        layer = tf.nn.conv2d(input, pruning.apply_mask(w, name + "_weight"), strides=[1] + list(strides) + [1],
+                             padding=kwargs.get('padding', 'VALID'), dilations=[1] + list(dilations) + [1])
+    elif grouped == 'split':
+        weight_groups = tf.split(pruning.apply_mask(w, name + "_weight"), num_or_size_splits=group, axis=-1)
         xs = tf.split(input, num_or_size_splits=group, axis=-1)
-        convolved = [tf.nn.convolution(x, pruning.apply_mask(weight, name + "_weight_groups"), **kwargs) for
-                     (x, weight) in zip(xs, weight_groups)]
+        convolved = [tf.nn.convolution(x, weight, **kwargs) for (x, weight) in zip(xs, weight_groups)]
         layer = tf.concat(convolved, axis=-1)
+    else:
+        raise ValueError('grouped must be one of %s' % ', '.join(GROUPED_CONVOLUTIONS))
 
     if name.endswith('_sc'):
         b = tf.get_variable(initializer=tf.truncated_normal(input.get_shape().as_list()[-1::], stddev=0.1), trainable=trainable, name=name + "_bias")
         layer = layer + b
     return layer
 
-def resnet(inputs, w_init, units, num_stages, filter_list, trainable, reuse=False):
+def recompute_grad(fn):
+    """Wrap fn so that its activations are recomputed in the backward pass
+    instead of being kept from the forward pass, only the inputs of fn are kept.
+
+    the recomputation builds fn a second time, the moving average update ops it
+    creates are left out of UPDATE_OPS_COLLECTION so the statistics are updated once.
+    """
+    calls = [0]
+
+    def fn_once(*args):
+        calls[0] += 1
+        if calls[0] == 1:
+            return fn(*args)
+        update_ops = tf.get_collection_ref(UPDATE_OPS_COLLECTION)
+        saved_update_ops = list(update_ops)
+        outputs = fn(*args)
+        update_ops[:] = saved_update_ops
+        return outputs
+
+    return tf.contrib.layers.recompute_grad(fn_once)
+
+HEADS = ('dense', 'lowrank', 'gdconv')
+
+def output_head(bn1, w_init, trainable, head='dense', head_rank=128, batch_norm=None):
+    """pre_fc1 of the E-output from the bn1 feature map.
+    'dense': flatten and a dense layer of 512 units (7x7x512x512, 12.8M parameters).
+    'lowrank': the dense layer factorized in two, flatten x [7x7x512, head_rank] (dense_u) x [head_rank, 512] (dense_v),
+    convert_resnet_head.py initializes the factors from a trained dense layer by SVD.
+    'gdconv': a global depthwise convolution over the feature map (gdconv_weight), its batch norm and a dense layer of
+    512 units (gdconv_dense) on the 512 channels, as the embedding of MobileFaceNet.
+    """
+    if batch_norm is None:
+        batch_norm = lambda x, name: batch_normalization(x, variance_epsilon=2e-5, trainable=trainable, name=name)
+    bn1_shape = bn1.get_shape().as_list()
+    if head == 'gdconv':
+        w = tf.get_variable('gdconv_weight', shape=bn1_shape[1:3] + [bn1_shape[3], 1], initializer=w_init,
+                            trainable=trainable)
+        net = tf.nn.depthwise_conv2d(bn1, w, strides=[1, 1, 1, 1], padding='VALID')
+        net = batch_norm(net, 'gdconv_bn')
+        net = tf.reshape(net, shape=[-1, bn1_shape[3]], name='E_Reshapelayer')
+        return tf.layers.dense(net, units=512, kernel_initializer=w_init, use_bias=True, trainable=trainable,
+                               name='gdconv_dense')
+    bn1 = tf.reshape(bn1, shape=[-1, bn1_shape[1] * bn1_shape[2] * bn1_shape[3]], name='E_Reshapelayer')
+    if head == 'dense':
+        return tf.layers.dense(bn1, units=512, kernel_initializer=w_init, use_bias=True, trainable=trainable)
+    if head == 'lowrank':
+        net = tf.layers.dense(bn1, units=head_rank, kernel_initializer=w_init, use_bias=False, trainable=trainable,
+                              name='dense_u')
+        return tf.layers.dense(net, units=512, kernel_initializer=w_init, use_bias=True, trainable=trainable,
+                               name='dense_v')
+    raise ValueError('head must be one of %s' % ', '.join(HEADS))
+
+def resnet(inputs, w_init, units, num_stages, filter_list, trainable, reuse=False, recompute=None, head='dense',
+           head_rank=128, inner_widths=None):
     """Return ResNet symbol of
     Parameters
     ----------
@@ -152,6 +250,14 @@ def resnet(inputs, w_init, units, num_stages, filter_list, trainable, reuse=Fals
         Ouput size of symbol
     dataset : str
         Dataset type, only cifar10 and imagenet supports
+    recompute : str
+        None keeps every activation for backprop, 'stage' keeps only the stage boundaries and
+        'unit' only the residual unit boundaries, the rest is recomputed in the backward pass
+    head : str
+        E-output head, 'dense', 'lowrank' (of rank head_rank) or 'gdconv', see output_head()
+    inner_widths : dict
+        {unit name: channels between its two 3x3 convolutions} of the channel pruned units, the others keep the
+        width of their stage
     """
     #version_se = kwargs.get('version_se', 1)
     #version_input = kwargs.get('version_input', 1)
@@ -164,32 +270,46 @@ def resnet(inputs, w_init, units, num_stages, filter_list, trainable, reuse=Fals
     inputs = inputs - 127.5
     inputs = inputs * 0.0078125
 
-    with tf.variable_scope(variable_scope, reuse=reuse):
-        net = tf.pad(inputs, paddings=[[0, 0], [1, 1], [1, 1], [0, 0]])
-        net = convolution(net, group=1, strides=[1, 1], shape=[3, 3, 3, 64], padding='VALID', trainable=trainable, name='conv0')
-        net = batch_normalization(net, variance_epsilon=2e-5, trainable=trainable, name='bn0')
-        net = prelu(net, trainable=trainable, name='relu0')
+    assert recompute in (None, 'stage', 'unit'), 'recompute must be one of None, stage, unit'
+
+    # recompute_grad tracks the variables it reads, that requires resource variables
+    with tf.variable_scope(variable_scope, reuse=reuse, use_resource=True if recompute else None):
+        with tf.name_scope('input_layer'):
+            net = tf.pad(inputs, paddings=[[0, 0], [1, 1], [1, 1], [0, 0]])
+            net = convolution(net, group=1, strides=[1, 1], shape=[3, 3, 3, 64], padding='VALID', trainable=trainable, name='conv0')
+            net = batch_normalization(net, variance_epsilon=2e-5, trainable=trainable, name='bn0')
+            net = prelu(net, trainable=trainable, name='relu0')
+
+        def unit(body, out_filter, stride, dim_match, name):
+            fn = lambda x: residual_unit(x, out_filter, stride, dim_match, trainable=trainable, name=name,
+                                         mid_filter=(inner_widths or {}).get(name))
+            if recompute == 'unit':
+                fn = recompute_grad(fn)
+            return fn(body)
 
         body = net
         for i in range(num_stages):
-            body = residual_unit(body, filter_list[i + 1], (2, 2), False, trainable=trainable, name='stage%d_unit%d' % (i + 1, 1))
-            for j in range(units[i] - 1):
-                body = residual_unit(body, filter_list[i + 1], (1, 1), True, trainable=trainable, name='stage%d_unit%d' % (i + 1, j + 2))
-
-        bn1 = batch_normalization(body, variance_epsilon=2e-5, trainable=trainable, name='bn1')
-        bn1_shape = bn1.get_shape().as_list()
-        bn1 = tf.reshape(bn1, shape=[-1, bn1_shape[1] * bn1_shape[2] * bn1_shape[3]], name='E_Reshapelayer')
-        pre_fc1 = tf.layers.dense(bn1, units=512, kernel_initializer=w_init, use_bias=True)
-        fc1 = batch_normalization(pre_fc1, variance_epsilon=2e-5, trainable=trainable, name='fc1')
+            def stage(body, i=i):
+                body = unit(body, filter_list[i + 1], (2, 2), False, name='stage%d_unit%d' % (i + 1, 1))
+                for j in range(units[i] - 1):
+                    body = unit(body, filter_list[i + 1], (1, 1), True, name='stage%d_unit%d' % (i + 1, j + 2))
+                return body
+
+            if recompute == 'stage':
+                body = recompute_grad(stage)(body)
+            else:
+                body = stage(body)
+
+        with tf.name_scope('output_layer'):
+            bn1 = batch_normalization(body, variance_epsilon=2e-5, trainable=trainable, name='bn1')
+            pre_fc1 = output_head(bn1, w_init, trainable, head, head_rank)
+            fc1 = batch_normalization(pre_fc1, variance_epsilon=2e-5, trainable=trainable, name='fc1')
 
     return fc1, pre_fc1
 
 
-def get_resnet(inputs, w_init, num_layers, trainable, reuse=False):
-    """
-    Adapted from https://github.com/tornadomeet/ResNet/blob/master/train_resnet.py
-    Original author Wei Wu
-    """
+def resnet_config(num_layers):
+    """units, num_stages and filter_list of the resnet of num_layers layers."""
     if num_layers >= 101:
         filter_list = [64, 256, 512, 1024, 2048]
         bottle_neck = True
@@ -222,13 +342,109 @@ def get_resnet(inputs, w_init, num_layers, trainable, reuse=False):
     else:
         raise ValueError("no experiments done on num_layers {}, you can do it yourself".format(num_layers))
 
+    return units, num_stages, filter_list
+
+
+def get_resnet(inputs, w_init, num_layers, trainable, reuse=False, recompute=None, head='dense', head_rank=128,
+               inner_widths=None):
+    """
+    Adapted from https://github.com/tornadomeet/ResNet/blob/master/train_resnet.py
+    Original author Wei Wu
+
+    recompute: None, 'stage' or 'unit', activation recomputation (gradient checkpointing) granularity,
+    see resnet().
+    head: 'dense', 'lowrank' or 'gdconv' E-output head, see output_head().
+    inner_widths: {unit name: inner channels} of a channel pruned network (utils/channel_pruning.py), see resnet().
+    """
+    units, num_stages, filter_list = resnet_config(num_layers)
     return resnet(inputs=inputs,
                   w_init=w_init,
                   units=units,
                   num_stages=num_stages,
                   filter_list=filter_list,
                   trainable=trainable,
-                  reuse=reuse)
+                  reuse=reuse,
+                  recompute=recompute,
+                  head=head,
+                  head_rank=head_rank,
+                  inner_widths=inner_widths)
+
+
+def inference_convolution(input, shape, name, strides=(1, 1), padding='SAME'):
+    w = tf.get_variable(name + "_weight", shape=shape, trainable=False)
+    return tf.nn.conv2d(input, w, strides=[1] + list(strides) + [1], padding=padding)
+
+def inference_batch_normalization(input, name, variance_epsilon):
+    """batch_normalization with the moving statistics only, a scale and an offset per channel that the graph
+    transforms (fold_batch_norms, fold_constants) merge into the convolution before it."""
+    shape = input.get_shape().as_list()[-1::]
+    moving_mean = tf.get_variable(name + "_mean", shape=shape, trainable=False)
+    moving_variance = tf.get_variable(name + "_var", shape=shape, trainable=False)
+    offset = tf.get_variable(name + "_bias", shape=shape, trainable=False)
+    scale = tf.get_variable(name + "_scale", shape=shape, trainable=False) if name != 'fc1' else None
+    return tf.nn.batch_normalization(input, moving_mean, moving_variance, offset, scale, variance_epsilon, name=name)
+
+def inference_residual_unit(data, out_filter, stride, dim_match, name, mid_filter=None):
+    """residual_unit_v3 for inference, the padding of the stride 1 convolutions is merged into them (SAME).
+    a stride 2 SAME convolution of an even input pads only the bottom and right side, the explicit pad of the
+    training graph is kept before it."""
+    in_filter = data.get_shape().as_list()[-1]
+    mid_filter = mid_filter or out_filter
+    with tf.name_scope(name):
+        bn1 = inference_batch_normalization(data, name + '_bn1', 2e-5)
+        conv1 = inference_convolution(bn1, [3, 3, in_filter, mid_filter], name + '_conv1')
+        bn2 = inference_batch_normalization(conv1, name + '_bn2', 2e-5)
+        relu1 = prelu(bn2, trainable=False, name=name + '_relu1')
+        if tuple(stride) == (1, 1):
+            conv2 = inference_convolution(relu1, [3, 3, mid_filter, out_filter], name + '_conv2')
+        else:
+            relu1_pad = tf.pad(relu1, paddings=[[0, 0], [1, 1], [1, 1], [0, 0]])
+            conv2 = inference_convolution(relu1_pad, [3, 3, mid_filter, out_filter], name + '_conv2', strides=stride,
+                                          padding='VALID')
+        bn3 = inference_batch_normalization(conv2, name + '_bn3', 2e-5)
+
+        if dim_match:
+            shortcut = data
+        else:
+            conv1sc = inference_convolution(data, [1, 1, in_filter, out_filter], name + '_conv1sc', strides=stride,
+                                            padding='VALID')
+            shortcut = inference_batch_normalization(conv1sc, name + '_sc', 2e-5)
+        return bn3 + shortcut
+
+def get_resnet_inference(inputs, num_layers, reuse=False, head='dense', head_rank=128, inner_widths=None):
+    """
+    inference graph of get_resnet(trainable=False), same variables (the checkpoints of get_resnet restore into it)
+    and same output, without the batch statistics, the moving average updates, the cond between them, the pads of
+    the stride 1 convolutions and the pruning masks. the weights of a pruned checkpoint must have their masks
+    applied first (tf.contrib.model_pruning strip_pruning_vars). head and inner_widths as get_resnet, returns (fc1, pre_fc1) like get_resnet.
+    """
+    units, num_stages, filter_list = resnet_config(num_layers)
+    inputs = inputs - 127.5
+    inputs = inputs * 0.0078125
+
+    with tf.variable_scope(variable_scope, reuse=reuse):
+        with tf.name_scope('input_layer'):
+            net = inference_convolution(inputs, [3, 3, 3, filter_list[0]], 'conv0')
+            net = inference_batch_normalization(net, 'bn0', 2e-5)
+            net = prelu(net, trainable=False, name='relu0')
+
+        inner_widths = inner_widths or {}
+        for i in range(num_stages):
+            name = 'stage%d_unit%d' % (i + 1, 1)
+            net = inference_residual_unit(net, filter_list[i + 1], (2, 2), False, name=name,
+                                          mid_filter=inner_widths.get(name))
+            for j in range(units[i] - 1):
+                name = 'stage%d_unit%d' % (i + 1, j + 2)
+                net = inference_residual_unit(net, filter_list[i + 1], (1, 1), True, name=name,
+                                              mid_filter=inner_widths.get(name))
+
+        with tf.name_scope('output_layer'):
+            bn1 = inference_batch_normalization(net, 'bn1', 2e-5)
+            pre_fc1 = output_head(bn1, None, False, head, head_rank,
+                                  batch_norm=lambda x, name: inference_batch_normalization(x, name, 2e-5))
+            fc1 = inference_batch_normalization(pre_fc1, 'fc1', 2e-5)
+
+    return fc1, pre_fc1
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
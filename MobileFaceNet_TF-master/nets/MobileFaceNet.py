@@ -62,12 +62,25 @@ _CONV_DEFS = [
     Conv(kernel=[1, 1], stride=1, depth=512, ratio=1),
 ]
 
-def inverted_block(net, input_filters, output_filters, expand_ratio, stride, scope=None):
+def conv_defs_to_json(conv_defs):
+    '''conv_defs as a list of dicts, eg: for the json files written by search_arch.py.'''
+    return [dict(conv_def._asdict(), type=type(conv_def).__name__) for conv_def in conv_defs]
+
+def conv_defs_from_json(items):
+    '''inverse of conv_defs_to_json.'''
+    types = {'Conv': Conv, 'DepthwiseConv': DepthwiseConv, 'InvResBlock': InvResBlock}
+    conv_defs = []
+    for item in items:
+        item = dict(item)
+        conv_defs.append(types[item.pop('type')](**item))
+    return conv_defs
+
+def inverted_block(net, input_filters, output_filters, expand_ratio, stride, scope=None, kernel=[3, 3]):
     '''fundamental network struture of inverted residual block'''
     with tf.name_scope(scope):
         res_block = slim.conv2d(inputs=net, num_outputs=input_filters * expand_ratio, kernel_size=[1, 1])
         # depthwise conv2d
-        res_block = slim.separable_conv2d(inputs=res_block, num_outputs=None, kernel_size=[3, 3], stride=stride, depth_multiplier=1.0, normalizer_fn=slim.batch_norm)
+        res_block = slim.separable_conv2d(inputs=res_block, num_outputs=None, kernel_size=kernel, stride=stride, depth_multiplier=1.0, normalizer_fn=slim.batch_norm)
         res_block = slim.conv2d(inputs=res_block, num_outputs=output_filters, kernel_size=[1, 1], activation_fn=None)
         # stride 2 blocks
         if stride == 2:
@@ -81,6 +94,7 @@ def inverted_block(net, input_filters, output_filters, expand_ratio, stride, sco
 def mobilenet_v2_base(inputs,
                       final_endpoint='Conv2d_7',
                       min_depth=8,
+                      depth_multiplier=1.0,
                       conv_defs=None,
                       scope=None):
   """Mobilenet v2.
@@ -95,6 +109,10 @@ def mobilenet_v2_base(inputs,
       'Conv2d_6_InvResBlock', 'Conv2d_7_InvResBlock', 'Conv2d_8'].
     min_depth: Minimum depth value (number of channels) for all convolution ops.
       Enforced output depth to min_depth.
+    depth_multiplier: Float multiplier for the depth (number of channels)
+      for all convolution ops. The value must be greater than zero. Typical
+      usage will be to set this value in (0, 1) to reduce the number of
+      parameters or computation cost of the model.
     conv_defs: A list of ConvDef namedtuples specifying the net architecture.
     scope: Optional variable_scope.
 
@@ -104,10 +122,12 @@ def mobilenet_v2_base(inputs,
                 losses.
 
   Raises:
-    ValueError: if final_endpoint is not set to one of the predefined values
-                is not allowed.
+    ValueError: if final_endpoint is not set to one of the predefined values,
+                or depth_multiplier <= 0.
   """
-  depth = lambda d: max(int(d), min_depth)
+  if depth_multiplier <= 0:
+    raise ValueError('depth_multiplier is not greater than zero.')
+  depth = lambda d: max(int(d * depth_multiplier), min_depth)
   end_points = {}
 
   if conv_defs is None:
@@ -135,7 +155,7 @@ def mobilenet_v2_base(inputs,
             # depthwise conv2d
             net = slim.separable_conv2d(inputs=net, num_outputs=None, kernel_size=conv_def.kernel, stride=conv_def.stride,
                                         depth_multiplier=1.0, normalizer_fn=slim.batch_norm)
-            net = slim.conv2d(inputs=net, num_outputs=conv_def.depth, kernel_size=[1, 1], activation_fn=None)
+            net = slim.conv2d(inputs=net, num_outputs=depth(conv_def.depth), kernel_size=[1, 1], activation_fn=None)
             end_points[end_point] = net
             if end_point == final_endpoint:
                 return net, end_points
@@ -145,10 +165,12 @@ def mobilenet_v2_base(inputs,
           # inverted bottleneck blocks
           input_filters = net.shape[3].value
           # first layer needs to consider stride
-          net = inverted_block(net, input_filters, depth(conv_def.depth), conv_def.ratio, conv_def.stride, end_point+'_0')
+          net = inverted_block(net, input_filters, depth(conv_def.depth), conv_def.ratio, conv_def.stride, end_point+'_0',
+                               kernel=conv_def.kernel)
           for index in range(1, conv_def.repeate):
               suffix = '_' + str(index)
-              net = inverted_block(net, input_filters, depth(conv_def.depth), conv_def.ratio, 1, end_point+suffix)
+              net = inverted_block(net, input_filters, depth(conv_def.depth), conv_def.ratio, 1, end_point+suffix,
+                                   kernel=conv_def.kernel)
 
           end_points[end_point] = net
           if end_point == final_endpoint:
@@ -164,6 +186,8 @@ def mobilenet_v2(inputs,
                  bottleneck_layer_size=128,
                  is_training=False,
                  min_depth=8,
+                 depth_multiplier=1.0,
+                 resolution_multiplier=1.0,
                  conv_defs=None,
                  spatial_squeeze=True,
                  reuse=None,
@@ -179,6 +203,10 @@ def mobilenet_v2(inputs,
     is_training: whether is training or not.
     min_depth: Minimum depth value (number of channels) for all convolution ops.
       Enforced output depth to min_depth..
+    depth_multiplier: Float multiplier for the depth (number of channels)
+      for all convolution ops, the GDConv included.
+    resolution_multiplier: Float multiplier of the input resolution, the images
+      are resized by it in the graph so the input size of the model is unchanged.
     conv_defs: A list of ConvDef namedtuples specifying the net architecture.
     spatial_squeeze: if True, logits is of shape is [B, C], if false logits is
         of shape [B, 1, 1, C], where B is batch_size and C is number of classes.
@@ -198,16 +226,21 @@ def mobilenet_v2(inputs,
       activation.
 
   Raises:
-    ValueError: Input rank is invalid.
+    ValueError: Input rank is invalid, or resolution_multiplier <= 0.
   """
   input_shape = inputs.get_shape().as_list()
   if len(input_shape) != 4:
     raise ValueError('Invalid input tensor rank, expected 4, was: %d' %
                      len(input_shape))
+  if resolution_multiplier <= 0:
+    raise ValueError('resolution_multiplier is not greater than zero.')
 
   with tf.variable_scope(scope, 'MobileFaceNet', [inputs], reuse=reuse) as scope:
     with slim.arg_scope([slim.batch_norm, slim.dropout], is_training=is_training):
-      net, end_points = mobilenet_v2_base(inputs, scope=scope, min_depth=min_depth, conv_defs=conv_defs)
+      if resolution_multiplier != 1.0:
+        inputs = _scaled_inputs(inputs, resolution_multiplier)
+      net, end_points = mobilenet_v2_base(inputs, scope=scope, min_depth=min_depth,
+                                          depth_multiplier=depth_multiplier, conv_defs=conv_defs)
 
       with tf.variable_scope('Logits'):
         if global_pool:
@@ -217,11 +250,18 @@ def mobilenet_v2(inputs,
         else:
           # Pooling with a fixed kernel size.
           kernel_size = _reduced_kernel_size_for_small_input(net, [7, 7])
+          shape = net.get_shape().as_list()
+          if shape[1] is None or shape[2] is None:
+            # Input resolution unknown at graph construction time (progressive resolution
+            # training), center pad or crop the feature map to the kernel size so the same
+            # GDConv weights give a 1x1 output for every input size.
+            net = tf.image.resize_image_with_crop_or_pad(net, kernel_size[0], kernel_size[1])
 
           # Global depthwise conv2d
           net = slim.separable_conv2d(inputs=net, num_outputs=None, kernel_size=kernel_size, stride=1,
                                       depth_multiplier=1.0, activation_fn=None, padding='VALID')
-          net = slim.conv2d(inputs=net, num_outputs=512, kernel_size=[1, 1], stride=1, activation_fn=None, padding='VALID')
+          net = slim.conv2d(inputs=net, num_outputs=max(int(512 * depth_multiplier), min_depth), kernel_size=[1, 1],
+                            stride=1, activation_fn=None, padding='VALID')
           end_points['GDConv'] = net
 
         if not bottleneck_layer_size:
@@ -244,6 +284,26 @@ def wrapped_partial(func, *args, **kwargs):
   functools.update_wrapper(partial_func, func)
   return partial_func
 
+def _scaled_inputs(inputs, resolution_multiplier):
+  """Resize the input images by resolution_multiplier.
+
+  The static size is kept when it is known, so the GDConv kernel still matches
+  the last feature map.
+
+  Args:
+    inputs: a tensor of shape [batch_size, height, width, channels].
+    resolution_multiplier: Float multiplier of the height and width.
+
+  Returns:
+    the resized images.
+  """
+  shape = inputs.get_shape().as_list()
+  if shape[1] is None or shape[2] is None:
+    size = tf.cast(tf.round(tf.cast(tf.shape(inputs)[1:3], tf.float32) * resolution_multiplier), tf.int32)
+  else:
+    size = [int(round(shape[1] * resolution_multiplier)), int(round(shape[2] * resolution_multiplier))]
+  return tf.image.resize_bilinear(inputs, size, name='ResolutionMultiplier')
+
 def _reduced_kernel_size_for_small_input(input_tensor, kernel_size):
   """Define kernel size which is automatically reduced for small input.
 
@@ -315,7 +375,7 @@ def mobilenet_v2_arg_scope(is_training=True,
           return sc
 
 def inference(images, bottleneck_layer_size=128, phase_train=False,
-              weight_decay=0.00005, reuse=False):
+              weight_decay=0.00005, reuse=False, depth_multiplier=1.0, resolution_multiplier=1.0, conv_defs=None):
     '''build a mobilenet_v2 graph to training or inference.
 
     Args:
@@ -327,6 +387,9 @@ def inference(images, bottleneck_layer_size=128, phase_train=False,
         weight_decay: The weight decay to use for regularizing the model.
         reuse: whether or not the network and its variables should be reused. To be
           able to reuse 'scope' must be given.
+        depth_multiplier: Float multiplier for the number of channels of every layer.
+        resolution_multiplier: Float multiplier of the input resolution the network runs at.
+        conv_defs: A list of ConvDef namedtuples specifying the net architecture, default is _CONV_DEFS.
 
     Returns:
         net: a 2D Tensor with the logits (pre-softmax activations) if bottleneck_layer_size
@@ -340,4 +403,6 @@ def inference(images, bottleneck_layer_size=128, phase_train=False,
     '''
     arg_scope = mobilenet_v2_arg_scope(is_training=phase_train, weight_decay=weight_decay)
     with slim.arg_scope(arg_scope):
-        return mobilenet_v2(images, bottleneck_layer_size=bottleneck_layer_size, is_training=phase_train, reuse=reuse)
\ No newline at end of file
+        return mobilenet_v2(images, bottleneck_layer_size=bottleneck_layer_size, is_training=phase_train, reuse=reuse,
+                            depth_multiplier=depth_multiplier, resolution_multiplier=resolution_multiplier,
+                            conv_defs=conv_defs)
\ No newline at end of file
@@ -18,12 +18,18 @@
 """
 Implementation of paper Searching for MobileNetV3, https://arxiv.org/abs/1905.02244
 author: aiboy.wei@outlook.com
+
+the small_face and large_face specs are the face embedding variants: 112x112 input, the last stride 2 bneck
+runs at stride 1 so the last feature map is 7x7 as in MobileFaceNet, and the pooling/classifier tail is replaced
+by a GDConv head (global depthwise conv, linear 1x1 conv to the embedding size).
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import weakref
+
 import tensorflow as tf
 
 MobileNetV3_Small_Spec = [
@@ -70,6 +76,46 @@ MobileNetV3_Large_Spec = [
     [ "ConvNBnAct", 1,   False, 1000,  False, "None",   1 ],
 ]
 
+MobileNetV3_Small_Face_Spec = [
+    # Op            k    exp    out    SE     NL        s
+    [ "ConvBnAct",  3,   False, 16,    False, "hswish", 2 ],
+    [ "bneck",      3,   16,    16,    True,  "relu",   2 ],
+    [ "bneck",      3,   72,    24,    False, "relu",   2 ],
+    [ "bneck",      3,   88,    24,    False, "relu",   1 ],
+    [ "bneck",      5,   96,    40,    True,  "hswish", 2 ],
+    [ "bneck",      5,   240,   40,    True,  "hswish", 1 ],
+    [ "bneck",      5,   240,   40,    True,  "hswish", 1 ],
+    [ "bneck",      5,   120,   48,    True,  "hswish", 1 ],
+    [ "bneck",      5,   144,   48,    True,  "hswish", 1 ],
+    [ "bneck",      5,   288,   96,    True,  "hswish", 1 ],
+    [ "bneck",      5,   576,   96,    True,  "hswish", 1 ],
+    [ "bneck",      5,   576,   96,    True,  "hswish", 1 ],
+    [ "ConvBnAct",  1,   False, 576,   True,  "hswish", 1 ],
+    [ "gdconv",     7,   False, 128,   False, "None",   1 ],
+]
+
+MobileNetV3_Large_Face_Spec = [
+    # Op            k    exp    out    SE     NL        s
+    [ "ConvBnAct",  3,   False, 16,    False, "hswish", 2 ],
+    [ "bneck",      3,   16,    16,    False, "relu",   1 ],
+    [ "bneck",      3,   64,    24,    False, "relu",   2 ],
+    [ "bneck",      3,   72,    24,    False, "relu",   1 ],
+    [ "bneck",      5,   72,    40,    True,  "relu",   2 ],
+    [ "bneck",      5,   120,   40,    True,  "relu",   1 ],
+    [ "bneck",      5,   120,   40,    True,  "relu",   1 ],
+    [ "bneck",      3,   240,   80,    False, "hswish", 2 ],
+    [ "bneck",      3,   200,   80,    False, "hswish", 1 ],
+    [ "bneck",      3,   184,   80,    False, "hswish", 1 ],
+    [ "bneck",      3,   184,   80,    False, "hswish", 1 ],
+    [ "bneck",      3,   480,   112,   True,  "hswish", 1 ],
+    [ "bneck",      3,   672,   112,   True,  "hswish", 1 ],
+    [ "bneck",      5,   672,   160,   True,  "hswish", 1 ],
+    [ "bneck",      5,   960,   160,   True,  "hswish", 1 ],
+    [ "bneck",      5,   960,   160,   True,  "hswish", 1 ],
+    [ "ConvBnAct",  1,   False, 960,   False, "hswish", 1 ],
+    [ "gdconv",     7,   False, 128,   False, "None",   1 ],
+]
+
 def _make_divisible(v, divisor, min_value=None):
     if min_value is None:
         min_value = divisor
@@ -120,13 +166,13 @@ class SENet(tf.keras.layers.Layer):
         self.l2_reg = l2
 
     def build(self, input_shape):
-        _, h, w, c = input_shape
+        _, h, w, c = [int(d) for d in input_shape]
         self.gap = tf.keras.layers.GlobalAveragePooling2D(name=f'AvgPool{h}x{w}')
         self.fc1 = tf.keras.layers.Dense(units=c//self.reduction, activation="relu", use_bias=False,
                                          kernel_regularizer=tf.keras.regularizers.l2(self.l2_reg), name="Squeeze")
         self.fc2 = tf.keras.layers.Dense(units=c, activation=HardSigmoid(), use_bias=False,
                                          kernel_regularizer=tf.keras.regularizers.l2(self.l2_reg), name="Excite")
-        self.reshape = tf.keras.layers.Reshape((1, 1, c), name=f'Reshape(-1, 1, 1, {c})')
+        self.reshape = tf.keras.layers.Reshape((1, 1, c), name=f'Reshape1x1x{c}')
 
         super().build(input_shape)
 
@@ -145,9 +191,9 @@ class ConvBnAct(tf.keras.layers.Layer):
         self.bn = tf.keras.layers.BatchNormalization(momentum=0.99, name="BatchNormalization")
         self.act = _available_activation[NL]
 
-    def call(self, input):
+    def call(self, input, training=None):
         output = self.conv2d(input)
-        output = self.bn(output)
+        output = self.bn(output, training=training)
         output = self.act(output)
         return output
 
@@ -158,7 +204,7 @@ class ConvNBnAct(tf.keras.layers.Layer):
         self.fn = tf.keras.layers.Conv2D(filters=out, kernel_size=k, strides=s, activation=self.act, padding="same",
                                          kernel_regularizer=tf.keras.regularizers.l2(l2),name="conv2d")
 
-    def call(self, input):
+    def call(self, input, training=None):
         output = self.fn(input)
         return output
 
@@ -167,7 +213,7 @@ class Pool(tf.keras.layers.Layer):
         super(Pool, self).__init__(name=name)
         self.gap = tf.keras.layers.AveragePooling2D(pool_size=(k, k), strides=1, name=f'AvgPool{k}x{k}')
 
-    def call(self, input):
+    def call(self, input, training=None):
         output = self.gap(input)
         return output
 
@@ -197,30 +243,53 @@ class BottleNeck(tf.keras.layers.Layer):
             name=f'Pointwise1x1',
         )
         self.bn = tf.keras.layers.BatchNormalization(momentum=0.99, name="BatchNormalization")
+        # the pointwise output has out_ch channels, it needs its own statistics
+        self.pointwise_bn = tf.keras.layers.BatchNormalization(momentum=0.99, name="PointwiseBatchNormalization")
 
         if self.use_se:
             self.se = SENet(name="SEBottleneck",)
 
         self.act = _available_activation[NL]
 
-    def call(self, input):
-        output = self.expand(input)
+    def call(self, input, training=None):
+        output = self.expand(input, training=training)
         output = self.depthwise(output)
-        output = self.bn(output)
+        output = self.bn(output, training=training)
         if self.use_se:
             output = self.se(output)
         output = self.act(output)
         output = self.pointwise(output)
-        output = self.bn(output)
+        output = self.pointwise_bn(output, training=training)
 
-        if self.stride == 1 and self.exp_ch == self.out_ch:
+        if self.stride == 1 and input.get_shape().as_list()[-1] == self.out_ch:
             return input + output
         else:
             return output
 
+class GDConv(tf.keras.layers.Layer):
+    """global depthwise conv over the whole feature map, then a linear 1x1 conv to the embedding, see MobileFaceNet."""
+    def __init__(self, k, exp, out, SE, NL, s, l2, name="GDConv"):
+        super(GDConv, self).__init__(name=name)
+        self.depthwise = tf.keras.layers.DepthwiseConv2D(kernel_size=k, strides=1, padding="valid", use_bias=False,
+                                                         name=f'GDConv{k}x{k}')
+        self.bn = tf.keras.layers.BatchNormalization(momentum=0.99, name="BatchNormalization")
+        self.linear = tf.keras.layers.Conv2D(filters=out, kernel_size=1, strides=1, use_bias=False,
+                                             kernel_regularizer=tf.keras.regularizers.l2(l2), name="LinearConv1x1")
+        self.linear_bn = tf.keras.layers.BatchNormalization(momentum=0.99, name="LinearBatchNormalization")
+        self.flatten = tf.keras.layers.Flatten(name="Flatten")
+
+    def call(self, input, training=None):
+        output = self.depthwise(input)
+        output = self.bn(output, training=training)
+        output = self.linear(output)
+        output = self.linear_bn(output, training=training)
+        return self.flatten(output)
+
 _available_mobilenetv3_spec = {
             "small": MobileNetV3_Small_Spec,
             "large": MobileNetV3_Large_Spec,
+            "small_face": MobileNetV3_Small_Face_Spec,
+            "large_face": MobileNetV3_Large_Face_Spec,
         }
 
 _available_operation = {
@@ -228,13 +297,15 @@ _available_operation = {
             "bneck":      BottleNeck,
             "pool":       Pool,
             "ConvNBnAct": ConvNBnAct,
+            "gdconv":     GDConv,
         }
 
 class MobileNetV3(tf.keras.Model):
     def __init__(self, type="large", classes_numbers=1000, width_multiplier=1.0, divisible_by=8,
                  l2_reg=2e-5, dropout_rate=0.2, name="MobileNetV3"):
         super(MobileNetV3, self).__init__()
-        self.spec = _available_mobilenetv3_spec[type]
+        # a copy, the module level specs are shared by every model
+        self.spec = [list(params) for params in _available_mobilenetv3_spec[type]]
         self.spec[-1][3] = classes_numbers # bottlenet layer size or class numbers
         self._name = name+"_"+type
         self.backbone = tf.keras.Sequential(name="arch")
@@ -246,7 +317,10 @@ class MobileNetV3(tf.keras.Model):
                 exp_ch = _make_divisible(exp * width_multiplier, divisible_by)
             else:
                 exp_ch = None
-            if isinstance(out, int):
+            if Op == "gdconv":
+                # the embedding size is not scaled
+                out_ch = out
+            elif isinstance(out, int):
                 out_ch = _make_divisible(out * width_multiplier, divisible_by)
             else:
                 out_ch = None
@@ -257,11 +331,77 @@ class MobileNetV3(tf.keras.Model):
                 self.dropout = tf.keras.layers.Dropout(rate=dropout_rate, name=f'{self._name}/Dropout')
                 self.backbone.add(self.dropout)
 
-    def call(self, input):
-        output = self.backbone(input)
+    def call(self, input, training=None):
+        output = self.backbone(input, training=training)
         return output
 
 
+def _call_layers(model, images, phase_train):
+    '''the layers of the model one by one, to keep their outputs.'''
+    end_points = {}
+    with tf.name_scope(model.name):
+        net = images
+        for layer in model.backbone.layers:
+            net = layer(net, training=phase_train)
+            end_points[layer.name] = net
+    end_points['Logits'] = net
+    return net, end_points
+
+
+# face variant models of every graph, inference(reuse=True) calls the same model again to share its weights
+_face_models = weakref.WeakKeyDictionary()
+
+def inference(images, bottleneck_layer_size=128, phase_train=False, weight_decay=0.00005, reuse=False,
+              type="large_face", width_multiplier=1.0):
+    '''build a MobileNetV3 face embedding graph to training or inference, same interface as MobileFaceNet.inference.
+
+    Args:
+        images: a tensor of shape [batch_size, 112, 112, channels].
+        bottleneck_layer_size: embedding size.
+        phase_train: Whether or not we're training the model, a python bool or a bool tensor.
+        weight_decay: The weight decay to use for regularizing the model.
+        reuse: call the model built before in this graph again instead of a new one.
+        type: small_face or large_face.
+        width_multiplier: multiplier of the channels of every layer but the embedding.
+
+    Returns:
+        net: the 2D embedding tensor before normalization.
+        end_points: a dictionary from the layer names to their outputs.
+    '''
+    graph = tf.get_default_graph()
+    models = _face_models.setdefault(graph, {})
+    model = models.get(type) if reuse else None
+    if model is None:
+        model = MobileNetV3(type=type, classes_numbers=bottleneck_layer_size, width_multiplier=width_multiplier,
+                            l2_reg=weight_decay)
+        models[type] = model
+        first_call = True
+    else:
+        first_call = False
+
+    updates_before = set(model.updates)
+    if first_call:
+        # the keras weights are named after the name scope of the first call, keep them out of the tower scopes
+        with tf.name_scope(None):
+            net, end_points = _call_layers(model, images, phase_train)
+    else:
+        net, end_points = _call_layers(model, images, phase_train)
+
+    # the batch norm updates and the weight regularization go to the collections the training code reads
+    for update in model.updates:
+        if update not in updates_before:
+            tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, update)
+    if first_call:
+        for loss in model.losses:
+            tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, loss)
+        # the moving statistics are saved with the trainable variables, like mobilenet_v2_arg_scope does
+        trainable = set(tf.trainable_variables())
+        for variable in model.non_trainable_weights:
+            if variable not in trainable:
+                tf.add_to_collection(tf.GraphKeys.TRAINABLE_VARIABLES, variable)
+    return net, end_points
+
+
 if __name__ == "__main__":
     import numpy as np
 
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+per layer profile of the inference graph of MobileFaceNet, MobileNetV3 or L_Resnet_E_IR: multiply-adds, parameters
+(batch norm statistics included), activation bytes and the CPU time of the layer ops measured from traced runs,
+as a csv and a json table.
+
+the layers are the name scopes of the ops under the common scope of the network (eg: MobileFaceNet/Conv2d_2_InvResBlock_0,
+ResNet/stage1_unit1), --group_depth 2 splits them one level further. the ops run by tensorflow in parallel (inter op
+threads) overlap, so the sum of the layer times can exceed the wall time of a run, --num_threads 1 avoids it.
+
+eg: python profile_layers.py --model resnet --num_layers 50 --output ./output/profile/resnet50 --sort_by time_ms
+'''
+
+from nets.MobileFaceNet import inference, conv_defs_from_json
+from nets.L_Resnet_E_IR import get_resnet
+from nets.MobileNetV3 import MobileNetV3
+from nets.MobileNetV3 import inference as mobilenetv3_inference
+from collections import OrderedDict
+import tensorflow as tf
+import numpy as np
+import argparse
+import json
+import time
+import csv
+import sys
+import os
+
+VARIABLE_TYPES = ('VariableV2', 'Variable', 'VarHandleOp')
+# ops that only forward a variable to its users
+READ_TYPES = ('Identity', 'ReadVariableOp')
+COLUMNS = ['layer', 'ops', 'macs', 'params', 'activation_bytes', 'output_shape', 'output_bytes', 'time_ms', 'time_pct']
+
+
+def build_model(args, inputs):
+    '''output tensor of the network chosen by args.model.'''
+    if args.model == 'mobilefacenet':
+        conv_defs = None
+        if args.conv_defs:
+            with open(args.conv_defs) as f:
+                conv_defs = conv_defs_from_json(json.load(f))
+        prelogits, _ = inference(inputs, bottleneck_layer_size=args.embedding_size, phase_train=False,
+                                 depth_multiplier=args.depth_multiplier, conv_defs=conv_defs)
+        return prelogits
+    if args.model == 'mobilenetv3':
+        if args.mobilenetv3_type.endswith('_face'):
+            prelogits, _ = mobilenetv3_inference(inputs, bottleneck_layer_size=args.embedding_size, phase_train=False,
+                                                 type=args.mobilenetv3_type, width_multiplier=args.depth_multiplier)
+            return prelogits
+        return MobileNetV3(type=args.mobilenetv3_type, classes_numbers=args.embedding_size)(inputs)
+    w_init_method = tf.contrib.layers.xavier_initializer(uniform=False)
+    embeddings, _ = get_resnet(inputs, w_init_method, args.num_layers, trainable=False, head=args.resnet_head,
+                               head_rank=args.resnet_head_rank)
+    return embeddings
+
+
+def variable_of(op):
+    '''the variable op read by op through identities, None if op does not read a variable.'''
+    while op.type in READ_TYPES and op.inputs:
+        op = op.inputs[0].op
+    return op if op.type in VARIABLE_TYPES else None
+
+
+def forward_ops(output):
+    '''ops computing output from the placeholders, {consumer op name: [variable ops]} of the variables they read.'''
+    ops = []
+    reads = {}
+    visited = set()
+    stack = [output.op]
+    while stack:
+        op = stack.pop()
+        if op.name in visited:
+            continue
+        visited.add(op.name)
+        if op.type in ('Placeholder', 'Const'):
+            continue
+        ops.append(op)
+        for tensor in op.inputs:
+            variable = variable_of(tensor.op)
+            if variable is not None:
+                reads.setdefault(op.name, []).append(variable)
+            else:
+                stack.append(tensor.op)
+    # in graph creation order
+    order = dict((op.name, index) for index, op in enumerate(output.graph.get_operations()))
+    return sorted(ops, key=lambda op: order[op.name]), reads
+
+
+def common_scope(names):
+    scopes = [name.split('/')[:-1] for name in names]
+    prefix = scopes[0]
+    for scope in scopes[1:]:
+        length = 0
+        while length < min(len(prefix), len(scope)) and prefix[length] == scope[length]:
+            length += 1
+        prefix = prefix[:length]
+    return prefix
+
+
+def tensor_bytes(tensor):
+    shape = tensor.get_shape()
+    if not shape.is_fully_defined():
+        return 0
+    return int(np.prod(shape.as_list())) * tensor.dtype.size
+
+
+def op_macs(op):
+    '''multiply-adds of the convolutions and matrix multiplies, the other ops are not counted.'''
+    if op.type in ('Conv2D', 'DepthwiseConv2dNative'):
+        kernel = op.inputs[1].get_shape().as_list()
+        output = op.outputs[0].get_shape().as_list()
+        if None in kernel or None in output:
+            return 0
+        # the output elements of a depthwise conv already count the channel multiplier
+        per_output = kernel[0] * kernel[1] * (kernel[2] if op.type == 'Conv2D' else 1)
+        return int(np.prod(output)) * per_output
+    if op.type == 'MatMul':
+        a = op.inputs[0].get_shape().as_list()
+        output = op.outputs[0].get_shape().as_list()
+        if None in a or None in output:
+            return 0
+        inner = a[0] if op.get_attr('transpose_a') else a[1]
+        return output[0] * output[1] * inner
+    return 0
+
+
+def profile(args):
+    '''rows of the layer table.'''
+    config = tf.ConfigProto()
+    config.intra_op_parallelism_threads = args.num_threads
+    config.inter_op_parallelism_threads = args.num_threads
+    with tf.Graph().as_default():
+        inputs = tf.placeholder(name='input', shape=[args.batch_size, args.input_size, args.input_size, 3],
+                                dtype=tf.float32)
+        output = build_model(args, inputs)
+        ops, reads = forward_ops(output)
+
+        prefix = common_scope([op.name for op in ops])
+        def layer_of(name):
+            parts = name.split('/')[len(prefix):]
+            return '/'.join(prefix + parts[:min(args.group_depth, len(parts) - 1) or 1])
+
+        layers = OrderedDict()
+        layer_by_op = {}
+        counted_variables = set()
+        for op in ops:
+            layer = layer_of(op.name)
+            layer_by_op[op.name] = layer
+            row = layers.setdefault(layer, {'layer': layer, 'ops': 0, 'macs': 0, 'params': 0, 'activation_bytes': 0,
+                                            'output_shape': '', 'output_bytes': 0, 'time_ms': 0.})
+            row['ops'] += 1
+            row['macs'] += op_macs(op)
+            for variable in reads.get(op.name, []):
+                if variable.name not in counted_variables:
+                    counted_variables.add(variable.name)
+                    row['params'] += int(np.prod(variable.outputs[0].get_shape().as_list()))
+            for tensor in op.outputs:
+                row['activation_bytes'] += tensor_bytes(tensor)
+            if op.outputs:
+                # the last op of the layer gives its output
+                row['output_shape'] = 'x'.join(str(d) for d in op.outputs[0].get_shape().as_list())
+                row['output_bytes'] = tensor_bytes(op.outputs[0])
+
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            feed_dict = {inputs: np.random.uniform(-1., 1., inputs.get_shape().as_list())}
+            for _ in range(args.warmup_runs):
+                sess.run(output, feed_dict=feed_dict)
+            wall_times = []
+            other_ms = 0.
+            run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            for _ in range(args.trace_runs):
+                run_metadata = tf.RunMetadata()
+                start = time.time()
+                sess.run(output, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+                wall_times.append(time.time() - start)
+                for device in run_metadata.step_stats.dev_stats:
+                    for node in device.node_stats:
+                        ms = node.all_end_rel_micros / 1000. / args.trace_runs
+                        name = node.node_name.split(':')[0]
+                        if name in layer_by_op:
+                            layers[layer_by_op[name]]['time_ms'] += ms
+                        else:
+                            other_ms += ms
+
+    rows = list(layers.values())
+    if other_ms > 0:
+        rows.append({'layer': '(other ops)', 'ops': 0, 'macs': 0, 'params': 0, 'activation_bytes': 0,
+                     'output_shape': '', 'output_bytes': 0, 'time_ms': other_ms})
+    total_ms = sum(row['time_ms'] for row in rows)
+    for row in rows:
+        row['time_pct'] = 100. * row['time_ms'] / total_ms if total_ms else 0.
+    print('traced run wall time %.3fms (median of %d), sum of the op times %.3fms' %
+          (np.median(wall_times) * 1000., args.trace_runs, total_ms))
+    return rows
+
+
+def main(args):
+    rows = profile(args)
+    if args.sort_by:
+        rows = sorted(rows, key=lambda row: row[args.sort_by], reverse=True)
+
+    print('\n| layer | ops | MMACs | params | activation (KB) | output | time (ms) | time (%) |')
+    print('| ----- | --- | ----- | ------ | --------------- | ------ | --------- | -------- |')
+    for row in rows:
+        print('| %s | %d | %.2f | %d | %.1f | %s | %.3f | %.1f |' %
+              (row['layer'], row['ops'], row['macs'] / 1e6, row['params'], row['activation_bytes'] / 1024.,
+               row['output_shape'], row['time_ms'], row['time_pct']))
+    print('| total | %d | %.2f | %d | %.1f | | %.3f | 100.0 |' %
+          (sum(row['ops'] for row in rows), sum(row['macs'] for row in rows) / 1e6, sum(row['params'] for row in rows),
+           sum(row['activation_bytes'] for row in rows) / 1024., sum(row['time_ms'] for row in rows)))
+
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(args.output + '.csv', 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        with open(args.output + '.json', 'w') as f:
+            json.dump(rows, f, indent=2)
+        print('written %s.csv and %s.json' % (args.output, args.output))
+
+
+def parse_arguments(argv):
+    '''profile parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='mobilefacenet', choices=['mobilefacenet', 'mobilenetv3', 'resnet'],
+                        help='network to profile, resnet is L_Resnet_E_IR')
+    parser.add_argument('--num_layers', type=int, default=50, help='L_Resnet_E_IR depth')
+    parser.add_argument('--resnet_head', default='dense', choices=['dense', 'lowrank', 'gdconv'], help='L_Resnet_E_IR E-output head')
+    parser.add_argument('--resnet_head_rank', type=int, default=128, help='rank of the lowrank L_Resnet_E_IR head')
+    parser.add_argument('--mobilenetv3_type', default='large_face', choices=['small_face', 'large_face', 'small', 'large'],
+                        help='MobileNetV3 variant, small and large are the 224x224 ImageNet classifiers')
+    parser.add_argument('--depth_multiplier', type=float, default=1.0, help='MobileFaceNet or MobileNetV3 width multiplier')
+    parser.add_argument('--conv_defs', type=str, default='', help='json file of the MobileFaceNet architecture')
+    parser.add_argument('--embedding_size', type=int, default=128, help='Dimensionality of the embedding.')
+    parser.add_argument('--input_size', type=int, default=112,
+                        help='input image size, the ImageNet MobileNetV3 expects 224')
+    parser.add_argument('--batch_size', type=int, default=1, help='batch size of the profiled runs')
+    parser.add_argument('--num_threads', type=int, default=1, help='intra/inter op threads, 0 lets tensorflow choose')
+    parser.add_argument('--warmup_runs', type=int, default=5, help='runs before tracing')
+    parser.add_argument('--trace_runs', type=int, default=20, help='traced runs, the op times are averaged over them')
+    parser.add_argument('--group_depth', type=int, default=1, help='name scope levels of a layer below the network scope')
+    parser.add_argument('--sort_by', default='', choices=['', 'ops', 'macs', 'params', 'activation_bytes', 'output_bytes', 'time_ms'],
+                        help='sort the table by this column, descending, empty keeps the network order')
+    parser.add_argument('--output', type=str, default='',
+                        help='path prefix of the <output>.csv and <output>.json tables, empty to print only')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+structured channel pruning of L_Resnet_E_IR. at every sparsity of the schedule the inner channels of every residual
+unit (the outputs of conv1 that conv2 reads, the residual widths stay) are ranked by importance (--criterion l1: L1 norm
+of the conv1 filters, bn: gain of the batch norm after conv1), the least important are removed from the checkpoint,
+the narrower network is fine-tuned for --finetune_steps, exported as a frozen inference graph and measured:
+parameters, CPU latency and LFW accuracy. the sparsities are applied one after the other, each one prunes the
+fine-tuned network of the previous one.
+
+the weights of a checkpoint trained with pruning masks must have them applied first (strip_pruning_vars), the masks
+are not read. the lfw cache is the one of utils/data_process.cache_data (sweep.py, sweep_size.py).
+
+eg: python prune_resnet.py --ckpt_path ./output/resnet/ckpt --tfrecords_file_path ./datasets/faces_ms1m_112x112/tfrecords/tran.tfrecords --class_number 85742 --sparsities 0.25 0.5 0.75
+'''
+
+from losses.face_losses import insightface_loss, cosineface_loss, combine_loss
+from nets.L_Resnet_E_IR import get_resnet, get_resnet_inference, resnet_config, UPDATE_OPS_COLLECTION
+from utils.channel_pruning import inner_widths, select_channels, prune_channels, CRITERIA
+from utils.checkpoint import read_checkpoint, write_checkpoint
+from utils.data_process import parse_function, load_data_cache
+from utils.freeze_graph import freeze_graph_def
+from utils.common import train
+from verification import evaluate
+import tensorflow as tf
+import numpy as np
+import argparse
+import json
+import time
+import sys
+import os
+
+
+def get_session_config(args):
+    '''threads of the latency measurement, the fine-tuning lets tensorflow choose.'''
+    config = tf.ConfigProto()
+    if args.num_threads:
+        config.intra_op_parallelism_threads = args.num_threads
+        config.inter_op_parallelism_threads = args.num_threads
+    return config
+
+
+def finetune(args, init_ckpt, widths, output_dir):
+    '''fine-tune the network of inner widths from init_ckpt for args.finetune_steps, returns the checkpoint path.'''
+    with tf.Graph().as_default():
+        global_step = tf.Variable(name='global_step', initial_value=0, trainable=False)
+        dataset = tf.data.TFRecordDataset(args.tfrecords_file_path)
+        dataset = dataset.map(parse_function)
+        dataset = dataset.shuffle(buffer_size=args.buffer_size).repeat().batch(args.batch_size, drop_remainder=True)
+        images, labels = dataset.make_one_shot_iterator().get_next()
+        # get_resnet normalizes the 0..255 pixels itself
+        images = images / 0.0078125 + 127.5
+
+        w_init_method = tf.contrib.layers.xavier_initializer(uniform=False)
+        prelogits, _ = get_resnet(images, w_init_method, args.num_layers, trainable=True, head=args.head,
+                                  head_rank=args.head_rank, inner_widths=widths)
+        embeddings = tf.nn.l2_normalize(prelogits, 1, 1e-10, name='embeddings')
+        if args.loss_type == 'insightface':
+            inference_loss, logit = insightface_loss(embeddings, labels, args.class_number, w_init_method)
+        elif args.loss_type == 'cosine':
+            inference_loss, logit = cosineface_loss(embeddings, labels, args.class_number, w_init_method)
+        elif args.loss_type == 'combine':
+            inference_loss, logit = combine_loss(embeddings, labels, args.batch_size, args.class_number, w_init_method)
+        else:
+            assert 0, 'loss type error, choice item just one of [insightface, cosine, combine], please check!'
+        regularization_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
+        total_loss = tf.add_n([inference_loss] + regularization_losses, name='total_loss')
+        # the batch norm moving averages of L_Resnet_E_IR run with the update
+        for update_op in tf.get_collection(UPDATE_OPS_COLLECTION):
+            tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, update_op)
+        train_op, _ = train(total_loss, global_step, args.optimizer, args.learning_rate, args.moving_average_decay,
+                            tf.trainable_variables(), [], log_histograms=False)
+        accuracy = tf.reduce_mean(tf.cast(tf.equal(tf.argmax(logit, 1), labels), tf.float32))
+
+        # the pruned checkpoint has every variable of the narrower network, the margin head too when it was saved
+        shapes = tf.train.NewCheckpointReader(init_ckpt).get_variable_to_shape_map()
+        restore_vars = [v for v in tf.global_variables()
+                        if shapes.get(v.op.name) == v.get_shape().as_list() and v is not global_step]
+        saver = tf.train.Saver(tf.global_variables(), max_to_keep=1)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            tf.train.Saver(restore_vars).restore(sess, init_ckpt)
+            print('restored %d of %d variables from %s' % (len(restore_vars), len(tf.global_variables()), init_ckpt))
+            start = time.time()
+            for step in range(args.finetune_steps):
+                _, loss_val, acc_val = sess.run([train_op, total_loss, accuracy])
+                if (step + 1) % args.show_info_interval == 0:
+                    print('fine-tune step %d, total loss is %.4f, training accuracy is %.6f, %.3f s/step' %
+                          (step + 1, loss_val, acc_val, (time.time() - start) / (step + 1)))
+            return saver.save(sess, os.path.join(output_dir, 'ckpt', 'model'), write_meta_graph=False)
+
+
+def measure(args, ckpt, widths, output_dir):
+    '''parameters, latency and lfw accuracy of the network of inner widths restored from ckpt, exported to
+    output_dir/resnet_pruned.pb.'''
+    result = {}
+    with tf.Graph().as_default() as graph:
+        inputs = tf.placeholder(name='input', shape=[None, 112, 112, 3], dtype=tf.float32)
+        prelogits, _ = get_resnet_inference(inputs, args.num_layers, head=args.head, head_rank=args.head_rank,
+                                            inner_widths=widths)
+        embeddings = tf.nn.l2_normalize(prelogits, 1, 1e-10, name='embeddings')
+        # the batch norm moving statistics are not parameters
+        result['params'] = int(sum(np.prod(v.get_shape().as_list()) for v in tf.global_variables()
+                                   if not v.op.name.endswith('_mean') and not v.op.name.endswith('_var')))
+        with tf.Session(config=get_session_config(args)) as sess:
+            tf.train.Saver().restore(sess, ckpt)
+
+            feed_dict = {inputs: np.random.uniform(0., 255., [1, 112, 112, 3]).astype(np.float32)}
+            for _ in range(args.warmup_runs):
+                sess.run(embeddings, feed_dict=feed_dict)
+            times = []
+            for _ in range(args.num_runs):
+                start = time.time()
+                sess.run(embeddings, feed_dict=feed_dict)
+                times.append(time.time() - start)
+            result['latency_ms'] = np.median(times) * 1000.
+            result['latency_p99_ms'] = np.percentile(times, 99) * 1000.
+
+            result['lfw_acc'] = None
+            if os.path.exists(os.path.join(args.eval_cache_path, 'lfw_images.npy')):
+                data_sets, issame_list = load_data_cache('lfw', args.eval_cache_path)
+                emb_array = np.zeros((data_sets.shape[0], prelogits.get_shape().as_list()[-1]))
+                for start_index in range(0, data_sets.shape[0], args.test_batch_size):
+                    end_index = min(start_index + args.test_batch_size, data_sets.shape[0])
+                    # uint8 pixels, get_resnet_inference normalizes them
+                    feed_dict = {inputs: data_sets[start_index:end_index].astype(np.float32)}
+                    emb_array[start_index:end_index, :] = sess.run(embeddings, feed_dict=feed_dict)
+                _, _, accuracy, _, _, _ = evaluate(emb_array, issame_list, nrof_folds=args.eval_nrof_folds)
+                result['lfw_acc'] = float(np.mean(accuracy))
+
+            output_graph_def = freeze_graph_def(sess, graph.as_graph_def(), 'embeddings')
+    result['pb_path'] = os.path.join(output_dir, 'resnet_pruned.pb')
+    with tf.gfile.GFile(result['pb_path'], 'wb') as f:
+        f.write(output_graph_def.SerializeToString())
+    with open(os.path.join(output_dir, 'inner_widths.json'), 'w') as f:
+        json.dump(widths, f, indent=2)
+    return result
+
+
+def main(args):
+    ckpt = tf.train.latest_checkpoint(args.ckpt_path) if os.path.isdir(args.ckpt_path) else args.ckpt_path
+    print('Reading %s' % ckpt)
+    values = read_checkpoint(ckpt)
+    units, num_stages, filter_list = resnet_config(args.num_layers)
+    full_widths = {}
+    for i in range(num_stages):
+        for j in range(units[i]):
+            full_widths['stage%d_unit%d' % (i + 1, j + 1)] = filter_list[i + 1]
+    full_channels = sum(full_widths.values())
+
+    results = []
+    sparsities = [0.] + sorted(s for s in args.sparsities if s > 0.)
+    for sparsity in sparsities:
+        output_dir = os.path.join(args.prune_path, 'sparsity_%g' % sparsity)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        if sparsity > 0.:
+            widths = dict((unit, max(args.min_channels, int(round(width * (1. - sparsity)))))
+                          for unit, width in full_widths.items())
+            keep = select_channels(values, units, widths, args.criterion)
+            pruned_ckpt = write_checkpoint(prune_channels(values, keep), os.path.join(output_dir, 'pruned', 'model'))
+            print('sparsity %g: %d of %d inner channels kept' % (sparsity, sum(widths.values()), full_channels))
+            ckpt = finetune(args, pruned_ckpt, widths, output_dir) if args.finetune_steps > 0 else pruned_ckpt
+            values = read_checkpoint(ckpt)
+        widths = inner_widths(values, units)
+        result = {'sparsity': sparsity, 'inner_channels': sum(widths.values()), 'ckpt': ckpt}
+        result.update(measure(args, ckpt, widths, output_dir))
+        results.append(result)
+        print(result)
+
+    print('\n| sparsity | inner channels | params (M) | latency p50 (ms) | latency p99 (ms) | speedup | LFW acc |')
+    print('| -------- | -------------- | ---------- | ---------------- | ---------------- | ------- | ------- |')
+    for result in results:
+        acc = '%.4f' % result['lfw_acc'] if result['lfw_acc'] is not None else '-'
+        print('| %g | %d | %.3f | %.2f | %.2f | %.2fx | %s |' %
+              (result['sparsity'], result['inner_channels'], result['params'] / 1e6, result['latency_ms'],
+               result['latency_p99_ms'], results[0]['latency_ms'] / result['latency_ms'], acc))
+    with open(os.path.join(args.prune_path, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def parse_arguments(argv):
+    '''pruning parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt_path', type=str, required=True, help='checkpoint file or directory of the get_resnet model')
+    parser.add_argument('--num_layers', type=int, default=50, help='L_Resnet_E_IR depth')
+    parser.add_argument('--head', default='dense', choices=['dense', 'lowrank', 'gdconv'], help='E-output head of the model')
+    parser.add_argument('--head_rank', type=int, default=128, help='rank of the lowrank head')
+    parser.add_argument('--sparsities', type=float, nargs='+', default=[0.25, 0.5, 0.75],
+                        help='fractions of the inner channels of every unit to remove, applied in increasing order')
+    parser.add_argument('--criterion', default='l1', choices=CRITERIA, help='filter importance')
+    parser.add_argument('--min_channels', type=int, default=8, help='inner channels every unit keeps at least')
+    parser.add_argument('--prune_path', default='./output/resnet_pruning',
+                        help='output of the sparsities, sparsity_<s>/{pruned,ckpt,resnet_pruned.pb}, and results.json')
+    parser.add_argument('--tfrecords_file_path', type=str, default='./datasets/faces_ms1m_112x112/tfrecords/tran.tfrecords',
+                        help='tfrecords file of the fine-tune dataset')
+    parser.add_argument('--class_number', type=int, default=85742, help='class number of the fine-tune dataset')
+    parser.add_argument('--loss_type', default='insightface', help='loss type, choice type are insightface/cosine/combine')
+    parser.add_argument('--finetune_steps', type=int, default=10000, help='fine-tune steps after every sparsity, 0 to skip')
+    parser.add_argument('--batch_size', type=int, default=32, help='fine-tune batch size')
+    parser.add_argument('--buffer_size', type=int, default=10000, help='tf dataset api buffer size')
+    parser.add_argument('--learning_rate', type=float, default=0.001, help='fine-tune learning rate')
+    parser.add_argument('--optimizer', type=str, choices=['ADAGRAD', 'ADADELTA', 'ADAM', 'RMSPROP', 'MOM'],
+                        help='The optimization algorithm to use', default='MOM')
+    parser.add_argument('--moving_average_decay', type=float,
+                        help='Exponential decay for tracking of training parameters.', default=0.999)
+    parser.add_argument('--show_info_interval', type=int, default=100, help='intervals to show the fine-tune loss')
+    parser.add_argument('--eval_cache_path', default='./output/sweep_cache', help='decoded lfw images of cache_data')
+    parser.add_argument('--eval_nrof_folds', type=int, default=10, help='Number of folds to use for cross validation.')
+    parser.add_argument('--test_batch_size', type=int, default=100, help='batch size of the lfw evaluation')
+    parser.add_argument('--num_threads', type=int, default=1,
+                        help='intra/inter op threads, 1 for the single core latency, 0 lets tensorflow choose')
+    parser.add_argument('--warmup_runs', type=int, default=10, help='runs before timing')
+    parser.add_argument('--num_runs', type=int, default=100, help='timed single image runs')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+latency-aware architecture search over the InvResBlock stages of MobileFaceNet (_CONV_DEFS).
+
+1. latency lookup table: the CPU latency of every Conv / DepthwiseConv / InvResBlock / GDConv configuration met by the
+   search (kernel, stride, input size and channels, expansion ratio, output depth) is measured alone on this host,
+   once, and kept in --lut_path. the latency of a whole network is predicted as the sum of its layers.
+2. regularized evolution over the kernel size, expansion ratio and repeat count of every InvResBlock stage, the
+   strides and depths of _CONV_DEFS are kept. a network within --latency_budget_ms is better the more multiply-adds
+   it has (capacity proxy), the ones over the budget are ranked by latency only.
+3. the --top_k best networks are measured as a whole to check the prediction and written as conv_defs json files,
+   train them with train_nets.py --conv_defs output/arch_search/conv_defs_0.json.
+
+eg: python search_arch.py --latency_budget_ms 15 --num_threads 1
+'''
+
+from nets.MobileFaceNet import _CONV_DEFS, Conv, DepthwiseConv, InvResBlock, conv_defs_to_json
+from nets.MobileFaceNet import inference, inverted_block, mobilenet_v2_arg_scope
+from collections import deque
+import tensorflow as tf
+import numpy as np
+import argparse
+import json
+import time
+import sys
+import os
+
+slim = tf.contrib.slim
+
+
+def conv_out_size(size, stride):
+    # SAME padding
+    return (size + stride - 1) // stride
+
+
+def layer_instances(conv_defs, input_size, embedding_size):
+    '''(key, multiply-adds) of every layer of mobilenet_v2 built from conv_defs, in network order.
+
+    a key is a tuple identifying the latency of the layer, the same as the arguments mobilenet_v2_base builds it with.
+    '''
+    size = input_size
+    channels = 3
+    layers = []
+    for conv_def in conv_defs:
+        k = conv_def.kernel[0]
+        if isinstance(conv_def, Conv):
+            out_size = conv_out_size(size, conv_def.stride)
+            layers.append((('Conv', k, conv_def.stride, size, channels, conv_def.depth),
+                           out_size * out_size * k * k * channels * conv_def.depth))
+        elif isinstance(conv_def, DepthwiseConv):
+            out_size = conv_out_size(size, conv_def.stride)
+            layers.append((('DepthwiseConv', k, conv_def.stride, size, channels, conv_def.depth),
+                           out_size * out_size * (k * k * channels + channels * conv_def.depth)))
+        elif isinstance(conv_def, InvResBlock):
+            # every block of the stage expands the stage input channels, see mobilenet_v2_base
+            input_filters = channels
+            for index in range(conv_def.repeate):
+                stride = conv_def.stride if index == 0 else 1
+                out_size = conv_out_size(size, stride)
+                expanded = input_filters * conv_def.ratio
+                macs = size * size * channels * expanded + out_size * out_size * expanded * (k * k + conv_def.depth)
+                if stride == 1 and input_filters != conv_def.depth:
+                    macs += size * size * channels * conv_def.depth
+                layers.append((('InvResBlock', k, stride, size, channels, input_filters, conv_def.ratio, conv_def.depth),
+                               macs))
+                size = out_size
+                channels = conv_def.depth
+            continue
+        size = out_size
+        channels = conv_def.depth
+    # GDConv, projection to 512 and embedding
+    kernel = min(size, 7)
+    layers.append((('GDConv', size, channels, embedding_size),
+                   kernel * kernel * channels + channels * 512 + 512 * embedding_size))
+    return layers
+
+
+class LatencyTable(object):
+    """Latency in ms of the layers of layer_instances, measured on first use and saved to a json file."""
+
+    def __init__(self, path, num_threads, warmup_runs, num_runs):
+        self.path = path
+        self.num_threads = num_threads
+        self.warmup_runs = warmup_runs
+        self.num_runs = num_runs
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                table = json.load(f)
+            if table['num_threads'] != num_threads:
+                raise ValueError('%s was measured with %d threads, not %d' % (path, table['num_threads'], num_threads))
+            self.entries = table['entries']
+        self._overhead = None
+
+    def _session_config(self):
+        config = tf.ConfigProto()
+        config.intra_op_parallelism_threads = self.num_threads
+        config.inter_op_parallelism_threads = self.num_threads
+        return config
+
+    def _time(self, sess, fetch, feed_dict):
+        for _ in range(self.warmup_runs):
+            sess.run(fetch, feed_dict=feed_dict)
+        times = []
+        for _ in range(self.num_runs):
+            start = time.time()
+            sess.run(fetch, feed_dict=feed_dict)
+            times.append(time.time() - start)
+        return np.median(times) * 1000.
+
+    def overhead(self):
+        '''ms of a session run of an identity, paid once per network and not by every layer.'''
+        if self._overhead is None:
+            with tf.Graph().as_default():
+                inputs = tf.placeholder(tf.float32, [1, 112, 112, 3])
+                with tf.Session(config=self._session_config()) as sess:
+                    self._overhead = self._time(sess, tf.identity(inputs), {inputs: np.zeros([1, 112, 112, 3])})
+        return self._overhead
+
+    def measure(self, key):
+        size, channels = (key[1], key[2]) if key[0] == 'GDConv' else (key[3], key[4])
+        with tf.Graph().as_default():
+            inputs = tf.placeholder(tf.float32, [1, size, size, channels])
+            with slim.arg_scope(mobilenet_v2_arg_scope(is_training=False)):
+                with slim.arg_scope([slim.conv2d, slim.separable_conv2d], padding='SAME'):
+                    if key[0] == 'Conv':
+                        _, k, stride, _, _, depth = key
+                        net = slim.conv2d(inputs, depth, [k, k], stride=stride, normalizer_fn=slim.batch_norm)
+                    elif key[0] == 'DepthwiseConv':
+                        _, k, stride, _, _, depth = key
+                        net = slim.separable_conv2d(inputs, num_outputs=None, kernel_size=[k, k], stride=stride,
+                                                    depth_multiplier=1.0, normalizer_fn=slim.batch_norm)
+                        net = slim.conv2d(net, num_outputs=depth, kernel_size=[1, 1], activation_fn=None)
+                    elif key[0] == 'InvResBlock':
+                        _, k, stride, _, _, input_filters, ratio, depth = key
+                        net = inverted_block(inputs, input_filters, depth, ratio, stride, 'block', kernel=[k, k])
+                    else:
+                        _, _, _, embedding_size = key
+                        kernel = min(size, 7)
+                        net = slim.separable_conv2d(inputs, num_outputs=None, kernel_size=[kernel, kernel], stride=1,
+                                                    depth_multiplier=1.0, activation_fn=None, padding='VALID')
+                        net = slim.conv2d(net, num_outputs=512, kernel_size=[1, 1], activation_fn=None, padding='VALID')
+                        net = slim.conv2d(net, embedding_size, kernel_size=[1, 1], activation_fn=None)
+            with tf.Session(config=self._session_config()) as sess:
+                sess.run(tf.global_variables_initializer())
+                feed_dict = {inputs: np.random.uniform(-1., 1., [1, size, size, channels])}
+                return max(self._time(sess, net, feed_dict) - self.overhead(), 0.)
+
+    def latency(self, key):
+        name = '|'.join(str(item) for item in key)
+        if name not in self.entries:
+            self.entries[name] = self.measure(key)
+            print('measured %s: %.3fms' % (name, self.entries[name]))
+        return self.entries[name]
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path, 'w') as f:
+            json.dump({'num_threads': self.num_threads, 'entries': self.entries}, f, indent=2, sort_keys=True)
+
+
+def genome_to_conv_defs(genome):
+    '''(kernel, ratio, repeate) of every InvResBlock stage of _CONV_DEFS -> conv_defs.'''
+    stages = iter(genome)
+    conv_defs = []
+    for conv_def in _CONV_DEFS:
+        if isinstance(conv_def, InvResBlock):
+            kernel, ratio, repeate = next(stages)
+            conv_def = conv_def._replace(kernel=[kernel, kernel], ratio=ratio, repeate=repeate)
+        conv_defs.append(conv_def)
+    return conv_defs
+
+
+def base_genome():
+    return tuple((conv_def.kernel[0], conv_def.ratio, conv_def.repeate) for conv_def in _CONV_DEFS
+                 if isinstance(conv_def, InvResBlock))
+
+
+def stage_choices(args):
+    '''kernel, ratio and repeat choices of every stage, the repeats are relative to the ones of _CONV_DEFS.'''
+    choices = []
+    for _, _, repeate in base_genome():
+        repeats = sorted(set(max(1, repeate + delta) for delta in args.repeat_deltas))
+        choices.append([(kernel, ratio, r) for kernel in args.kernels for ratio in args.ratios for r in repeats])
+    return choices
+
+
+def evaluate_genome(genome, table, args):
+    layers = layer_instances(genome_to_conv_defs(genome), args.input_size, args.embedding_size)
+    latency = table.overhead() + sum(table.latency(key) for key, _ in layers)
+    macs = sum(macs for _, macs in layers)
+    fitness = macs if latency <= args.latency_budget_ms else -latency
+    return {'genome': genome, 'latency_ms': latency, 'macs': macs, 'fitness': fitness}
+
+
+def evolve(table, args):
+    '''regularized evolution, the oldest network of the population dies every cycle.'''
+    rng = np.random.RandomState(args.seed)
+    choices = stage_choices(args)
+    history = {}
+
+    def evaluate(genome):
+        if genome not in history:
+            history[genome] = evaluate_genome(genome, table, args)
+        return history[genome]
+
+    population = deque([evaluate(base_genome())])
+    while len(population) < args.population_size:
+        population.append(evaluate(tuple(stage[rng.randint(len(stage))] for stage in choices)))
+    for cycle in range(args.cycles):
+        sample = [population[i] for i in rng.choice(len(population), args.sample_size, replace=False)]
+        parent = max(sample, key=lambda candidate: candidate['fitness'])
+        child = list(parent['genome'])
+        stage = rng.randint(len(choices))
+        child[stage] = choices[stage][rng.randint(len(choices[stage]))]
+        population.append(evaluate(tuple(child)))
+        population.popleft()
+        if (cycle + 1) % 100 == 0:
+            best = max(history.values(), key=lambda candidate: candidate['fitness'])
+            print('cycle %d, %d networks evaluated, best %.3fms %.1f MMACs' %
+                  (cycle + 1, len(history), best['latency_ms'], best['macs'] / 1e6))
+    return sorted(history.values(), key=lambda candidate: -candidate['fitness'])
+
+
+def measure_network(conv_defs, args):
+    '''measured latency in ms of the whole network, to check the lookup table prediction.'''
+    config = tf.ConfigProto()
+    config.intra_op_parallelism_threads = args.num_threads
+    config.inter_op_parallelism_threads = args.num_threads
+    with tf.Graph().as_default():
+        inputs = tf.placeholder(tf.float32, [1, args.input_size, args.input_size, 3])
+        prelogits, _ = inference(inputs, bottleneck_layer_size=args.embedding_size, phase_train=False,
+                                 conv_defs=conv_defs)
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            feed_dict = {inputs: np.random.uniform(-1., 1., [1, args.input_size, args.input_size, 3])}
+            for _ in range(args.warmup_runs):
+                sess.run(prelogits, feed_dict=feed_dict)
+            times = []
+            for _ in range(args.num_runs):
+                start = time.time()
+                sess.run(prelogits, feed_dict=feed_dict)
+                times.append(time.time() - start)
+    return np.median(times) * 1000.
+
+
+def main(args):
+    if not os.path.exists(args.search_path):
+        os.makedirs(args.search_path)
+    table = LatencyTable(args.lut_path, args.num_threads, args.warmup_runs, args.num_runs)
+    try:
+        baseline = evaluate_genome(base_genome(), table, args)
+        print('_CONV_DEFS: predicted %.3fms, %.1f MMACs' % (baseline['latency_ms'], baseline['macs'] / 1e6))
+        ranked = evolve(table, args)
+    finally:
+        table.save()
+
+    results = []
+    for rank, candidate in enumerate([baseline] + ranked[:args.top_k]):
+        conv_defs = genome_to_conv_defs(candidate['genome'])
+        result = {'name': 'conv_defs_%d' % (rank - 1) if rank else '_CONV_DEFS',
+                  'stages': [list(stage) for stage in candidate['genome']],
+                  'predicted_ms': candidate['latency_ms'], 'macs': candidate['macs'],
+                  'measured_ms': measure_network(conv_defs, args)}
+        if rank:
+            with open(os.path.join(args.search_path, result['name'] + '.json'), 'w') as f:
+                json.dump(conv_defs_to_json(conv_defs), f, indent=2)
+        results.append(result)
+        print(result)
+
+    print('\n| network | stages (kernel, ratio, repeats) | MMACs | predicted (ms) | measured (ms) |')
+    print('| ------- | ------------------------------- | ----- | -------------- | ------------- |')
+    for result in results:
+        stages = ' '.join('%d/%d/%d' % tuple(stage) for stage in result['stages'])
+        print('| %s | %s | %.1f | %.2f | %.2f |' % (result['name'], stages, result['macs'] / 1e6,
+                                                  result['predicted_ms'], result['measured_ms']))
+    with open(os.path.join(args.search_path, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def parse_arguments(argv):
+    '''search parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency_budget_ms', type=float, required=True,
+                        help='single image latency budget of the searched networks on this host')
+    parser.add_argument('--kernels', type=int, nargs='+', default=[3, 5], help='depthwise kernel sizes of the stages')
+    parser.add_argument('--ratios', type=int, nargs='+', default=[2, 4, 6], help='expansion ratios of the stages')
+    parser.add_argument('--repeat_deltas', type=int, nargs='+', default=[-2, -1, 0, 1, 2],
+                        help='block repeat changes of every stage relative to _CONV_DEFS, at least one block is kept')
+    parser.add_argument('--population_size', type=int, default=50, help='regularized evolution population')
+    parser.add_argument('--sample_size', type=int, default=10, help='networks sampled to choose every parent')
+    parser.add_argument('--cycles', type=int, default=2000, help='evolution cycles, one new network each')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the evolution')
+    parser.add_argument('--top_k', type=int, default=5, help='best networks measured as a whole and written as conv_defs')
+    parser.add_argument('--input_size', type=int, default=112, help='input image size')
+    parser.add_argument('--embedding_size', type=int, default=128, help='Dimensionality of the embedding.')
+    parser.add_argument('--num_threads', type=int, default=1,
+                        help='intra/inter op threads of the latency measurements, 1 for a single core device')
+    parser.add_argument('--warmup_runs', type=int, default=10, help='runs before timing')
+    parser.add_argument('--num_runs', type=int, default=50, help='timed runs, the median is kept')
+    parser.add_argument('--lut_path', default='./output/arch_search/latency_lut.json',
+                        help='latency lookup table, reused and extended by every search on the same host')
+    parser.add_argument('--search_path', default='./output/arch_search', help='conv_defs_<rank>.json and results.json')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+hyperparameter sweep of train_nets.py, K short trials run concurrently on one host.
+
+the evaluation sets and a training subset are decoded once into uint8 .npy files, every trial
+memory-maps them read-only, so the page cache holds a single copy for all the trials.
+every trial is pinned to its own core set, the results are collected into one table.
+
+eg: python sweep.py --class_number 85742 --parallel 4 --grid margin_s=32,64 margin_m=0.3,0.5 loss_type=insightface,cosine
+'''
+
+from utils.data_process import cache_data, cache_train_data
+import subprocess
+import itertools
+import argparse
+import json
+import time
+import sys
+import os
+
+
+def parse_grid(grid):
+    '''["margin_s=32,64", "loss_type=insightface,cosine"] -> list of {name: value} trials.'''
+    names = []
+    values = []
+    for item in grid:
+        name, choices = item.split('=', 1)
+        names.append(name)
+        values.append(choices.split(','))
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def core_sets(parallel, cores_per_trial):
+    '''split the cores this process may use into parallel disjoint sets.'''
+    cores = sorted(os.sched_getaffinity(0))
+    if not cores_per_trial:
+        cores_per_trial = max(1, len(cores) // parallel)
+    return [cores[i * cores_per_trial:(i + 1) * cores_per_trial] or cores for i in range(parallel)]
+
+
+def trial_command(trial, trial_dir, args, num_threads):
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train_nets.py'),
+           '--class_number', str(args.class_number),
+           '--max_steps', str(args.max_steps),
+           '--validate_interval', str(args.max_steps),
+           '--ckpt_interval', str(args.max_steps + 1),
+           '--train_cache_path', args.cache_path,
+           '--eval_cache_path', args.cache_path,
+           '--eval_datasets', *args.eval_datasets,
+           '--num_threads', str(num_threads),
+           '--summary_path', os.path.join(trial_dir, 'summary'),
+           '--ckpt_path', os.path.join(trial_dir, 'ckpt'),
+           '--ckpt_best_path', os.path.join(trial_dir, 'ckpt_best'),
+           '--backbone_ckpt_path', '',
+           '--log_file_path', os.path.join(trial_dir, 'logs'),
+           '--arch_txt_path', os.path.join(trial_dir, 'arch')]
+    for name, value in sorted(trial.items()):
+        cmd += ['--' + name] + value.split()
+    return cmd + args.train_args.split()
+
+
+def collect_result(trial_dir, eval_datasets):
+    '''last accuracy and VAL written by train_nets.py for every evaluation set of the trial.'''
+    result = {}
+    logs_dir = os.path.join(trial_dir, 'logs')
+    for subdir in sorted(os.listdir(logs_dir)) if os.path.isdir(logs_dir) else []:
+        for db in eval_datasets:
+            path = os.path.join(logs_dir, subdir, '{}_result.txt'.format(db))
+            if os.path.exists(path):
+                lines = [line.split() for line in open(path) if line.strip()]
+                if lines:
+                    result[db + '_acc'] = float(lines[-1][1])
+                    result[db + '_val'] = float(lines[-1][2])
+    return result
+
+
+def main(args):
+    # decode the shared data once
+    for db in args.eval_datasets:
+        print('caching %s' % db)
+        cache_data(db, [112, 112], args, args.cache_path)
+    print('caching %d training images' % args.train_images)
+    cache_train_data(args.tfrecords_file_path, args.cache_path, args.train_images)
+
+    trials = parse_grid(args.grid)
+    free_cores = core_sets(args.parallel, args.cores_per_trial)
+    pending = list(enumerate(trials))
+    running = []
+    results = [None] * len(trials)
+    while pending or running:
+        while pending and free_cores:
+            index, trial = pending.pop(0)
+            cores = free_cores.pop(0)
+            trial_dir = os.path.join(args.sweep_path, 'trial_%d' % index)
+            os.makedirs(trial_dir, exist_ok=True)
+            env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), CUDA_VISIBLE_DEVICES='')
+            log = open(os.path.join(trial_dir, 'stdout.txt'), 'w')
+            process = subprocess.Popen(trial_command(trial, trial_dir, args, len(cores)), stdout=log,
+                                       stderr=subprocess.STDOUT, env=env,
+                                       preexec_fn=lambda cores=cores: os.sched_setaffinity(0, cores))
+            print('trial %d %s on cores %s' % (index, trial, cores))
+            running.append((index, trial, trial_dir, cores, process, log, time.time()))
+
+        time.sleep(1)
+        for item in list(running):
+            index, trial, trial_dir, cores, process, log, start = item
+            if process.poll() is None:
+                continue
+            running.remove(item)
+            log.close()
+            free_cores.append(cores)
+            result = dict(trial)
+            result['returncode'] = process.returncode
+            result['minutes'] = (time.time() - start) / 60.
+            result.update(collect_result(trial_dir, args.eval_datasets))
+            results[index] = result
+            print('trial %d finished: %s' % (index, result))
+
+    columns = list(parse_grid(args.grid)[0].keys()) + ['returncode', 'minutes']
+    columns += [db + suffix for db in args.eval_datasets for suffix in ['_acc', '_val']]
+    print('\n| ' + ' | '.join(columns) + ' |')
+    print('| ' + ' | '.join(['---'] * len(columns)) + ' |')
+    for result in results:
+        print('| ' + ' | '.join(('%.4f' % result[c]) if isinstance(result.get(c), float) else str(result.get(c, ''))
+                                for c in columns) + ' |')
+    with open(os.path.join(args.sweep_path, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def parse_arguments(argv):
+    '''sweep parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--class_number', type=int, required=True, help='class number of the training datasets')
+    parser.add_argument('--grid', nargs='+', required=True,
+                        help='train_nets.py arguments to sweep, name=value1,value2, a value with spaces is '
+                             'split into several arguments, eg: "lr_schedule=2 3 4 5,4 7 9 11"')
+    parser.add_argument('--parallel', type=int, default=2, help='number of concurrent trials')
+    parser.add_argument('--cores_per_trial', type=int, default=0, help='cores pinned to every trial, 0 splits the cores evenly')
+    parser.add_argument('--max_steps', type=int, default=2000, help='training steps of every trial')
+    parser.add_argument('--train_images', type=int, default=200000, help='training images decoded into the shared cache')
+    parser.add_argument('--train_args', type=str, default='', help='extra arguments for every train_nets.py trial')
+    parser.add_argument('--eval_datasets', nargs='+', default=['lfw'], help='evluation datasets')
+    parser.add_argument('--eval_db_path', default='./datasets/faces_ms1m_112x112', help='evluate datasets base path')
+    parser.add_argument('--tfrecords_file_path', default='./datasets/faces_ms1m_112x112/tfrecords', type=str,
+                        help='path to the output of tfrecords file path')
+    parser.add_argument('--cache_path', default='./output/sweep_cache', help='shared decoded data of the trials')
+    parser.add_argument('--sweep_path', default='./output/sweep', help='output of the trials and results.json')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
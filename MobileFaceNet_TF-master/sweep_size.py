@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# /usr/bin/env/python3
+
+'''
+size sweep of MobileFaceNet, every depth (width) multiplier x resolution multiplier variant is trained (--train)
+or taken from its existing backbone checkpoint, then measured: parameters, FLOPs, CPU latency and LFW accuracy.
+
+every variant is measured in its own process (utils/benchmark.run_config_process), one after the other, so the
+latencies do not disturb each other.
+the variants without a checkpoint are still measured, with random weights and no accuracy.
+
+eg: python sweep_size.py --depth_multipliers 0.5 0.75 1.0 --resolution_multipliers 0.75 1.0 --train --class_number 85742
+'''
+
+from utils.benchmark import add_benchmark_arguments, session_config, time_runs, median_ms, run_config_process
+from utils.data_process import cache_data, cache_train_data
+import subprocess
+import argparse
+import json
+import sys
+import os
+
+import numpy as np
+
+
+def variant_dir(args, depth_multiplier, resolution_multiplier):
+    return os.path.join(args.sweep_path, 'dm%g_rm%g' % (depth_multiplier, resolution_multiplier))
+
+
+def train_command(args, depth_multiplier, resolution_multiplier):
+    output_dir = variant_dir(args, depth_multiplier, resolution_multiplier)
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train_nets.py'),
+           '--class_number', str(args.class_number),
+           '--depth_multiplier', str(depth_multiplier),
+           '--resolution_multiplier', str(resolution_multiplier),
+           '--max_steps', str(args.max_steps),
+           '--validate_interval', str(args.max_steps),
+           '--ckpt_interval', str(args.max_steps),
+           '--train_cache_path', args.cache_path,
+           '--eval_cache_path', args.cache_path,
+           '--eval_datasets', 'lfw',
+           '--summary_path', os.path.join(output_dir, 'summary'),
+           '--ckpt_path', os.path.join(output_dir, 'ckpt'),
+           '--ckpt_best_path', os.path.join(output_dir, 'ckpt_best'),
+           '--backbone_ckpt_path', os.path.join(output_dir, 'ckpt_backbone'),
+           '--log_file_path', os.path.join(output_dir, 'logs'),
+           '--arch_txt_path', os.path.join(output_dir, 'arch')]
+    return cmd + args.train_args.split()
+
+
+def run_config(args):
+    '''measure one variant and print a json result line.'''
+    import tensorflow as tf
+    from nets.MobileFaceNet import inference
+    from utils.checkpoint import backbone_variables
+    from utils.data_process import load_data_cache, normalize_images
+    from verification import evaluate
+
+    result = {'depth_multiplier': args.depth_multiplier, 'resolution_multiplier': args.resolution_multiplier,
+              'input_size': int(round(112 * args.resolution_multiplier))}
+
+    # parameters and FLOPs of a single image, the batch norm moving statistics are not parameters
+    with tf.Graph().as_default() as graph:
+        inputs = tf.placeholder(name='input', shape=[1, 112, 112, 3], dtype=tf.float32)
+        inference(inputs, bottleneck_layer_size=args.embedding_size, phase_train=False,
+                  depth_multiplier=args.depth_multiplier, resolution_multiplier=args.resolution_multiplier)
+        result['params'] = int(sum(np.prod(v.get_shape().as_list()) for v in backbone_variables()
+                                   if 'moving_' not in v.op.name))
+        flops = tf.profiler.profile(graph, options=tf.profiler.ProfileOptionBuilder.float_operation(),
+                                    cmd='op')
+        result['flops'] = int(flops.total_float_ops)
+
+    ckpt = tf.train.latest_checkpoint(os.path.join(variant_dir(args, args.depth_multiplier, args.resolution_multiplier),
+                                                   'ckpt_backbone'))
+    with tf.Graph().as_default():
+        inputs = tf.placeholder(name='input', shape=[None, 112, 112, 3], dtype=tf.float32)
+        prelogits, _ = inference(inputs, bottleneck_layer_size=args.embedding_size, phase_train=False,
+                                 depth_multiplier=args.depth_multiplier, resolution_multiplier=args.resolution_multiplier)
+        embeddings = tf.nn.l2_normalize(prelogits, 1, 1e-10, name='embeddings')
+        with tf.Session(config=session_config(args.num_threads)) as sess:
+            if ckpt:
+                print('Restoring %s' % ckpt)
+                tf.train.Saver(backbone_variables()).restore(sess, ckpt)
+            else:
+                sess.run(tf.global_variables_initializer())
+
+            feed_dict = {inputs: np.random.uniform(-1., 1., [1, 112, 112, 3]).astype(np.float32)}
+            times = time_runs(lambda: sess.run(embeddings, feed_dict=feed_dict), args.warmup_runs, args.num_runs)
+            result['latency_ms'] = median_ms(times)
+            result['latency_p99_ms'] = np.percentile(times, 99) * 1000.
+
+            result['lfw_acc'] = None
+            if ckpt and os.path.exists(os.path.join(args.cache_path, 'lfw_images.npy')):
+                data_sets, issame_list = load_data_cache('lfw', args.cache_path)
+                emb_array = np.zeros((data_sets.shape[0], args.embedding_size))
+                for start_index in range(0, data_sets.shape[0], args.test_batch_size):
+                    end_index = min(start_index + args.test_batch_size, data_sets.shape[0])
+                    feed_dict = {inputs: normalize_images(data_sets[start_index:end_index])}
+                    emb_array[start_index:end_index, :] = sess.run(embeddings, feed_dict=feed_dict)
+                _, _, accuracy, _, _, _ = evaluate(emb_array, issame_list, nrof_folds=args.eval_nrof_folds)
+                result['lfw_acc'] = float(np.mean(accuracy))
+    print(json.dumps(result))
+
+
+def main(args):
+    if not os.path.exists(args.sweep_path):
+        os.makedirs(args.sweep_path)
+    if args.train:
+        # decoded once, shared with sweep.py
+        cache_data('lfw', [112, 112], args, args.cache_path)
+        cache_train_data(args.tfrecords_file_path, args.cache_path, args.train_images)
+
+    results = []
+    for depth_multiplier in args.depth_multipliers:
+        for resolution_multiplier in args.resolution_multipliers:
+            if args.train:
+                output_dir = variant_dir(args, depth_multiplier, resolution_multiplier)
+                if not os.path.exists(output_dir):
+                    os.makedirs(output_dir)
+                print('training depth_multiplier %g resolution_multiplier %g' % (depth_multiplier, resolution_multiplier))
+                with open(os.path.join(output_dir, 'stdout.txt'), 'w') as log:
+                    subprocess.run(train_command(args, depth_multiplier, resolution_multiplier), stdout=log,
+                                   stderr=subprocess.STDOUT)
+            result = run_config_process(__file__, {'depth_multiplier': depth_multiplier,
+                                                   'resolution_multiplier': resolution_multiplier}, [
+                '--embedding_size', str(args.embedding_size), '--num_threads', str(args.num_threads),
+                '--warmup_runs', str(args.warmup_runs), '--num_runs', str(args.num_runs),
+                '--test_batch_size', str(args.test_batch_size), '--eval_nrof_folds', str(args.eval_nrof_folds),
+                '--cache_path', args.cache_path, '--sweep_path', args.sweep_path])
+            if 'failed' not in result:
+                results.append(result)
+
+    print('\n| depth multiplier | resolution | params (M) | MFLOPs | latency p50 (ms) | latency p99 (ms) | LFW acc |')
+    print('| ---------------- | ---------- | ---------- | ------ | ---------------- | ---------------- | ------- |')
+    for result in results:
+        acc = '%.4f' % result['lfw_acc'] if result['lfw_acc'] is not None else '-'
+        print('| %g | %d | %.3f | %.1f | %.2f | %.2f | %s |' %
+              (result['depth_multiplier'], result['input_size'], result['params'] / 1e6, result['flops'] / 1e6,
+               result['latency_ms'], result['latency_p99_ms'], acc))
+    with open(os.path.join(args.sweep_path, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def parse_arguments(argv):
+    '''size sweep parameters'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth_multipliers', type=float, nargs='+', default=[0.5, 0.75, 1.0],
+                        help='width multipliers of the variants')
+    parser.add_argument('--resolution_multipliers', type=float, nargs='+', default=[0.75, 1.0],
+                        help='input resolution multipliers of the variants, 1.0 is 112x112')
+    parser.add_argument('--embedding_size', type=int, default=128, help='Dimensionality of the embedding.')
+    parser.add_argument('--train', action='store_true',
+                        help='train every variant with train_nets.py for max_steps first, else measure the existing '
+                             'checkpoints of sweep_path')
+    parser.add_argument('--class_number', type=int, default=85742, help='class number of the training datasets')
+    parser.add_argument('--max_steps', type=int, default=20000, help='training steps of every variant')
+    parser.add_argument('--train_images', type=int, default=200000, help='training images decoded into the cache')
+    parser.add_argument('--train_args', type=str, default='', help='extra arguments for every train_nets.py run')
+    parser.add_argument('--eval_db_path', default='./datasets/faces_ms1m_112x112', help='evluate datasets base path')
+    parser.add_argument('--eval_nrof_folds', type=int, default=10, help='Number of folds to use for cross validation.')
+    parser.add_argument('--tfrecords_file_path', default='./datasets/faces_ms1m_112x112/tfrecords', type=str,
+                        help='path to the output of tfrecords file path')
+    parser.add_argument('--cache_path', default='./output/sweep_cache', help='decoded lfw and training images')
+    parser.add_argument('--sweep_path', default='./output/size_sweep',
+                        help='output of the variants, dm<depth>_rm<resolution>/ckpt_backbone, and results.json')
+    parser.add_argument('--test_batch_size', type=int, default=100, help='batch size of the lfw evaluation')
+    # a single intra/inter op thread for the latency of a single core device
+    add_benchmark_arguments(parser, warmup_runs=10, num_runs=100, num_threads=1)
+    parser.add_argument('--depth_multiplier', type=float, default=1.0, help='internal, width of the single variant')
+    parser.add_argument('--resolution_multiplier', type=float, default=1.0, help='internal, resolution of the single variant')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+    if args.run_config:
+        run_config(args)
+    else:
+        main(args)
@@ -11,10 +11,9 @@ from __future__ import division
 from __future__ import print_function
 
 from utils.data_process import load_data
-from verification import evaluate
-from scipy.optimize import brentq
-from scipy import interpolate
-from sklearn import metrics
+from utils.metrics import MetricsExporter, add_metrics_arguments
+from utils.common import enable_xla_jit
+from verification import evaluate, calculate_auc_eer
 import tensorflow as tf
 import numpy as np
 import argparse
@@ -70,8 +69,12 @@ def get_model_filenames(model_dir):
     return meta_file, ckpt_file
 
 def main(args):
+    metrics_exporter = MetricsExporter(args.metrics_prom_path, args.metrics_jsonl_path, args.metrics_port, job='test')
+    config = tf.ConfigProto()
+    if args.xla:
+        enable_xla_jit(config)
     with tf.Graph().as_default():
-        with tf.Session() as sess:
+        with tf.Session(config=config) as sess:
             # prepare validate datasets
             ver_list = []
             ver_name_list = []
@@ -113,10 +116,11 @@ def main(args):
                 print('Validation rate: %2.5f+-%2.5f @ FAR=%2.5f' % (val, val_std, far))
                 print('fpr and tpr: %1.3f %1.3f' % (np.mean(fpr, 0), np.mean(tpr, 0)))
 
-                auc = metrics.auc(fpr, tpr)
+                auc, eer = calculate_auc_eer(fpr, tpr)
                 print('Area Under Curve (AUC): %1.3f' % auc)
-                eer = brentq(lambda x: 1. - x - interpolate.interp1d(fpr, tpr)(x), 0., 1.)
                 print('Equal Error Rate (EER): %1.3f' % eer)
+                metrics_exporter.evaluation(ver_name_list[db_index], duration, data_sets.shape[0], np.mean(accuracy), val)
+    metrics_exporter.close()
 
 def parse_arguments(argv):
     '''test parameters'''
@@ -132,6 +136,8 @@ def parse_arguments(argv):
     parser.add_argument('--eval_db_path', default='./datasets/faces_ms1m_112x112', help='evluate datasets base path')
     parser.add_argument('--eval_nrof_folds', type=int,
                         help='Number of folds to use for cross validation. Mainly used for testing.', default=10)
+    parser.add_argument('--xla', action='store_true', help='run the model with XLA JIT')
+    add_metrics_arguments(parser)
 
     return parser.parse_args(argv)
 
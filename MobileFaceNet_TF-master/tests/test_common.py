@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+from utils.common import train
+
+
+class AccumulateGradientsTest(tf.test.TestCase):
+
+    def build(self, accumulation_steps):
+        inputs = tf.placeholder(tf.float32, [None, 3], name='inputs')
+        weights = tf.Variable(np.ones([3, 1], np.float32), name='weights')
+        total_loss = tf.reduce_mean(tf.square(tf.matmul(inputs, weights)), name='total_loss')
+        global_step = tf.Variable(0, trainable=False, name='global_step')
+        train_op, accumulate_op = train(total_loss, global_step, 'MOM', 0.1, 0.999, [weights], [],
+                                        log_histograms=False, accumulation_steps=accumulation_steps)
+        loss_average = [v for v in tf.global_variables() if v.op.name == 'total_loss/avg'][0]
+        return inputs, weights, global_step, loss_average, train_op, accumulate_op
+
+    def test_initializers_need_no_feed(self):
+        with tf.Graph().as_default():
+            self.build(accumulation_steps=2)
+            with self.test_session() as sess:
+                sess.run(tf.global_variables_initializer())
+                sess.run(tf.local_variables_initializer())
+
+    def test_one_update_per_accumulation(self):
+        batches = [np.array([[1., 0., 0.]], np.float32), np.array([[0., 2., 0.]], np.float32)]
+        with tf.Graph().as_default():
+            inputs, weights, global_step, loss_average, train_op, accumulate_op = self.build(accumulation_steps=2)
+            with self.test_session() as sess:
+                sess.run(tf.global_variables_initializer())
+                sess.run(tf.local_variables_initializer())
+                sess.run(accumulate_op, feed_dict={inputs: batches[0]})
+                self.assertAllClose(sess.run(weights), np.ones([3, 1]))
+                self.assertEqual(sess.run(global_step), 0)
+                self.assertEqual(sess.run(loss_average), 0.)
+                sess.run(train_op, feed_dict={inputs: batches[1]})
+                self.assertEqual(sess.run(global_step), 1)
+                self.assertNotEqual(sess.run(loss_average), 0.)
+                # gradients 2 * (x . w) * x: [2, 0, 0] and [0, 8, 0], the first nesterov momentum step
+                # is learning_rate * (1 + momentum) * their mean
+                expected = np.ones([3, 1]) - 0.1 * 1.9 * np.array([[1.], [4.], [0.]])
+                self.assertAllClose(sess.run(weights), expected)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -6,20 +6,26 @@ Tensorflow implementation for MobileFaceNet.
 Author: aiboy.wei@outlook.com .
 '''
 
-from losses.face_losses import insightface_loss, cosineface_loss, combine_loss
-from utils.data_process import parse_function, load_data
-from nets.MobileFaceNet import inference
+from losses.face_losses import insightface_loss, cosineface_loss, combine_loss, sample_classes, sharded_margin_loss
+from utils.data_process import parse_function, load_data, load_data_cache, cached_train_dataset, normalize_images, \
+    get_train_dataset
+from nets.MobileFaceNet import inference, conv_defs_from_json
+from nets.MobileNetV3 import inference as mobilenetv3_inference
 # from losses.face_losses import cos_loss
-from verification import evaluate
-from scipy.optimize import brentq
-from utils.common import train
-from scipy import interpolate
+from verification import evaluate, calculate_auc_eer
+from utils.checkpoint import AsyncCheckpointSaver, backbone_variables
+from utils.allreduce import RingAllreduce, parse_worker_hosts, broadcast_variables
+from utils.metrics import MetricsExporter, add_metrics_arguments
+from utils.common import train, enable_xla_jit
 from datetime import datetime
-from sklearn import metrics
 import tensorflow as tf
 import numpy as np
+import subprocess
 import argparse
+import resource
+import json
 import time
+import sys
 import os
 
 slim = tf.contrib.slim
@@ -28,36 +34,78 @@ def get_parser():
     parser = argparse.ArgumentParser(description='parameters to train net')
     parser.add_argument('--max_epoch', default=12, help='epoch to train the network')
     parser.add_argument('--image_size', default=[112, 112], help='the image size')
+    parser.add_argument('--resolution_schedule', type=int, nargs='+', default=[],
+                        help='progressive resolution training, square training image size of every phase, eg: 64 96 112, '
+                             'empty to always train at image_size')
+    parser.add_argument('--resolution_boundaries', type=int, nargs='+', default=[],
+                        help='epochs at which the next resolution of resolution_schedule starts, eg: 3 6')
     parser.add_argument('--class_number', type=int, required=True,
                         help='class number depend on your training datasets, MS1M-V1: 85164, MS1M-V2: 85742')
     parser.add_argument('--embedding_size', type=int,
                         help='Dimensionality of the embedding.', default=128)
+    parser.add_argument('--network', default='mobilefacenet', choices=['mobilefacenet', 'mobilenetv3_small', 'mobilenetv3_large'],
+                        help='backbone, the MobileNetV3 ones are the 112x112 face variants with a GDConv embedding head')
+    parser.add_argument('--depth_multiplier', type=float, default=1.0,
+                        help='backbone width multiplier, scales the channels of every layer, eg: 0.5 0.75')
+    parser.add_argument('--resolution_multiplier', type=float, default=1.0,
+                        help='MobileFaceNet resolution multiplier, the input images are resized by it in the graph')
+    parser.add_argument('--conv_defs', type=str, default='',
+                        help='json file of the MobileFaceNet architecture, eg: written by search_arch.py, empty for _CONV_DEFS')
     parser.add_argument('--weight_decay', default=5e-5, help='L2 weight regularization.')
-    parser.add_argument('--lr_schedule', help='Number of epochs for learning rate piecewise.', default=[4, 7, 9, 11])
+    parser.add_argument('--lr_schedule', type=int, nargs=4, help='Number of epochs for learning rate piecewise.', default=[4, 7, 9, 11])
+    parser.add_argument('--max_steps', type=int, default=0, help='stop training after this many steps, 0 trains max_epoch epochs')
     parser.add_argument('--train_batch_size', default=90, help='batch size to train network')
+    parser.add_argument('--accumulation_steps', type=int, default=1,
+                        help='sum the gradients of this many train_batch_size micro-batches before every optimizer update, '
+                             'the effective batch size is train_batch_size * accumulation_steps')
     parser.add_argument('--test_batch_size', type=int,
                         help='Number of images to process in a batch in the test set.', default=100)
-    parser.add_argument('--eval_datasets', default=['lfw', 'cfp_ff', 'cfp_fp', 'agedb_30'], help='evluation datasets')
+    parser.add_argument('--eval_datasets', nargs='+', default=['lfw', 'cfp_ff', 'cfp_fp', 'agedb_30'], help='evluation datasets')
     # parser.add_argument('--eval_datasets', default=['lfw'], help='evluation datasets')
     parser.add_argument('--eval_db_path', default='./datasets/faces_ms1m_112x112', help='evluate datasets base path')
+    parser.add_argument('--eval_cache_path', default='', help='read the evaluation sets from the memory-mapped uint8 cache '
+                                                              'written by utils.data_process.cache_data instead of eval_db_path')
     parser.add_argument('--eval_nrof_folds', type=int,
                         help='Number of folds to use for cross validation. Mainly used for testing.', default=10)
     parser.add_argument('--tfrecords_file_path', default='./datasets/faces_ms1m_112x112/tfrecords', type=str,
                         help='path to the output of tfrecords file path')
+    parser.add_argument('--train_cache_path', default='', type=str,
+                        help='train from the memory-mapped images written by utils.data_process.cache_train_data '
+                             'instead of tfrecords_file_path')
     parser.add_argument('--summary_path', default='./output/summary', help='the summary file save path')
     parser.add_argument('--ckpt_path', default='./output/ckpt', help='the ckpt file save path')
     parser.add_argument('--ckpt_best_path', default='./output/ckpt_best', help='the best ckpt file save path')
+    parser.add_argument('--backbone_ckpt_path', default='./output/ckpt_backbone',
+                        help='the backbone-only (MobileFaceNet or MobileNetV3 scope) ckpt file save path, empty to disable')
     parser.add_argument('--log_file_path', default='./output/logs', help='the ckpt file save path')
+    parser.add_argument('--arch_txt_path', default='./arch/txt',
+                        help='directory of the network architecture and trainable variable listings')
     parser.add_argument('--saver_maxkeep', default=50, help='tf.train.Saver max keep ckpt files')
     #parser.add_argument('--buffer_size', default=10000, help='tf dataset api buffer size')
-    parser.add_argument('--summary_interval', default=400, help='interval to save summary')
-    parser.add_argument('--ckpt_interval', default=2000, help='intervals to save ckpt file')
-    parser.add_argument('--validate_interval', default=2000, help='intervals to save ckpt file')
-    parser.add_argument('--show_info_interval', default=50, help='intervals to save ckpt file')
+    parser.add_argument('--summary_interval', type=int, default=400, help='interval to save summary')
+    parser.add_argument('--ckpt_interval', type=int, default=2000, help='intervals to save ckpt file')
+    parser.add_argument('--validate_interval', type=int, default=2000, help='intervals to save ckpt file')
+    parser.add_argument('--show_info_interval', type=int, default=50, help='intervals to save ckpt file')
     parser.add_argument('--pretrained_model', type=str, default='', help='Load a pretrained model before training starts.')
     parser.add_argument('--optimizer', type=str, choices=['ADAGRAD', 'ADADELTA', 'ADAM', 'RMSPROP', 'MOM'],
                         help='The optimization algorithm to use', default='ADAM')
     parser.add_argument('--log_device_mapping', default=False, help='show device placement log')
+    parser.add_argument('--xla', action='store_true',
+                        help='compile the training graph with XLA JIT, see benchmark_xla.py to compare with the default executor')
+    parser.add_argument('--num_threads', type=int, default=0, help='intra/inter op threads of the session, 0 lets tensorflow choose')
+    parser.add_argument('--train_devices', type=str, default='',
+                        help='comma separated devices to replicate the training tower on, eg: /cpu:0,/cpu:1, '
+                             'empty for a single tower. train_batch_size is split evenly between the towers')
+    parser.add_argument('--sparse_class_updates', action='store_true',
+                        help='with sample_rate < 1, update only the sampled columns of the classifier weights and of their '
+                             'optimizer slots, the backbone keeps the dense optimizer')
+    parser.add_argument('--classifier_devices', type=str, default='',
+                        help='comma separated devices to split the margin loss classifier weights across by class ranges '
+                             '(model parallel), eg: /cpu:0,/cpu:1, empty keeps them on the tower device')
+    parser.add_argument('--worker_hosts', type=str, default='',
+                        help='comma separated host:port of every training process for synchronous data parallel '
+                             'training, eg: 127.0.0.1:29500,127.0.0.1:29501, empty for a single process')
+    parser.add_argument('--task_index', type=int, default=0, help='index of this process in worker_hosts, 0 writes logs and ckpt')
     parser.add_argument('--moving_average_decay', type=float,
                         help='Exponential decay for tracking of training parameters.', default=0.999)
     parser.add_argument('--log_histograms',
@@ -68,53 +116,326 @@ def get_parser():
                         help='Norm to use for prelogits norm loss.', default=1.0)
     parser.add_argument('--loss_type', default='insightface', help='loss type, choice type are insightface/cosine/combine')
     parser.add_argument('--margin_s', type=float,
-                        help='insightface_loss/cosineface_losses/combine_loss loss scale.', default=64.)
+                        help='insightface_loss/cosineface_losses/combine_loss loss scale, default is the one of the loss.', default=None)
     parser.add_argument('--margin_m', type=float,
-                        help='insightface_loss/cosineface_losses/combine_loss loss margin.', default=0.5)
+                        help='insightface_loss/cosineface_losses/combine_loss loss margin, default is the one of the loss.', default=None)
     parser.add_argument('--margin_a', type=float,
                         help='combine_loss loss margin a.', default=1.0)
     parser.add_argument('--margin_b', type=float,
                         help='combine_loss loss margin b.', default=0.2)
+    parser.add_argument('--sample_rate', type=float, default=1.0,
+                        help='Partial-FC, fraction of the classes the margin loss is computed for on every step, the classes '
+                             'of the batch plus random negatives, 1.0 computes all of them')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='measure training throughput on random in-graph images and labels instead of training, '
+                             'no dataset is read. every combination of the benchmark_* lists runs in its own process')
+    parser.add_argument('--benchmark_loss_types', nargs='+', default=['insightface', 'cosine', 'combine'],
+                        help='loss heads to benchmark')
+    parser.add_argument('--benchmark_optimizers', nargs='+', default=['ADAM'], help='optimizers to benchmark')
+    parser.add_argument('--benchmark_batch_sizes', type=int, nargs='+', default=[90], help='batch sizes to benchmark')
+    parser.add_argument('--benchmark_threads', type=int, nargs='+', default=[0],
+                        help='intra/inter op thread counts to benchmark, 0 lets tensorflow choose')
+    parser.add_argument('--benchmark_warmup_steps', type=int, default=5, help='steps run before timing')
+    parser.add_argument('--benchmark_steps', type=int, default=50, help='timed steps of every benchmark')
+    parser.add_argument('--benchmark_output', type=str, default='', help='json file of the results, empty to print only')
+    parser.add_argument('--benchmark_config', type=str, default='', help=argparse.SUPPRESS)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
     return args
 
+def get_train_devices(train_devices):
+    '''parse the --train_devices value, a single tower on the default device when empty.'''
+    if not train_devices:
+        return [None]
+    return [device.strip() for device in train_devices.split(',') if device.strip()]
+
+def get_classifier_devices(classifier_devices):
+    '''parse the --classifier_devices value, None keeps the classifier weights unsharded.'''
+    if not classifier_devices:
+        return None
+    return get_train_devices(classifier_devices)
+
+def get_session_config(devices, log_device_placement=False, xla=False):
+    '''session config that exposes as many cpu devices as the towers reference, optionally with XLA JIT.'''
+    gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.9)
+    config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=log_device_placement, gpu_options=gpu_options)
+    config.gpu_options.allow_growth = True
+    cpu_devices = set(d.lower() for d in devices if d is not None and 'cpu' in d.lower())
+    if len(cpu_devices) > 1:
+        config.device_count['CPU'] = len(cpu_devices)
+    if xla:
+        enable_xla_jit(config)
+    return config
+
+def get_next_batch(sess, next_element, comm=None):
+    '''fetch the next training batch.
+
+    the workers have to run the same number of steps, so every one of them ends
+    the epoch with tf.errors.OutOfRangeError as soon as one shard is exhausted.
+    '''
+    try:
+        batch = sess.run(next_element)
+    except tf.errors.OutOfRangeError:
+        if comm is not None:
+            comm.all_true(False)
+        raise
+    if comm is not None and not comm.all_true(True):
+        raise tf.errors.OutOfRangeError(None, None, 'the shard of another worker is exhausted')
+    return batch
+
+def get_resolution(epoch, resolution_schedule, resolution_boundaries):
+    '''training image size of the epoch, piecewise constant over resolution_boundaries like lr_schedule.'''
+    for boundary, resolution in zip(resolution_boundaries, resolution_schedule):
+        if epoch < boundary:
+            return resolution
+    return resolution_schedule[len(resolution_boundaries)]
+
+def build_network(inputs, network, embedding_size, phase_train, weight_decay, reuse=False, depth_multiplier=1.0,
+                  resolution_multiplier=1.0, conv_defs=None):
+    '''prelogits and end points of the backbone chosen by --network, depth_multiplier is the width of both of them.'''
+    if network == 'mobilefacenet':
+        return inference(inputs, bottleneck_layer_size=embedding_size, phase_train=phase_train, weight_decay=weight_decay,
+                         reuse=reuse, depth_multiplier=depth_multiplier, resolution_multiplier=resolution_multiplier,
+                         conv_defs=conv_defs)
+    assert resolution_multiplier == 1.0 and conv_defs is None, 'resolution_multiplier and conv_defs are MobileFaceNet options'
+    return mobilenetv3_inference(inputs, bottleneck_layer_size=embedding_size, phase_train=phase_train,
+                                 weight_decay=weight_decay, reuse=reuse, type=network.split('_')[1] + '_face',
+                                 width_multiplier=depth_multiplier)
+
+def backbone_scope(network):
+    '''name scope of the backbone variables of --network.'''
+    if network == 'mobilefacenet':
+        return 'MobileFaceNet'
+    return 'MobileNetV3_%s_face' % network.split('_')[1]
+
+def build_tower(inputs, labels, batch_size, class_number, embedding_size, weight_decay, loss_type, w_init,
+                phase_train, prelogits_norm_p=1.0, reuse=False, margin_s=None, margin_m=None, margin_a=1.0, margin_b=0.2,
+                sample_rate=1.0, classifier_devices=None, depth_multiplier=1.0, resolution_multiplier=1.0,
+                conv_defs=None, network='mobilefacenet'):
+    '''build a backbone tower and its margin loss head, margin_s/margin_m None keep the defaults of the loss.
+
+    with sample_rate < 1 the logits are only computed for the classes of the batch plus random negative classes
+    (Partial-FC), logit_labels are the labels as indices into the logit columns that predictions (the argmax of
+    the logits, for the training accuracy) refer to.
+    with classifier_devices the class weights are split by class ranges across these devices.
+    network is mobilefacenet, mobilenetv3_small or mobilenetv3_large, see build_network.
+    depth_multiplier and resolution_multiplier scale the channels and the input resolution of MobileFaceNet,
+    conv_defs replaces its architecture.
+
+    Returns:
+        prelogits, embeddings, net_points, prelogits_norm, inference_loss, predictions, logit_labels
+    '''
+    with tf.variable_scope(tf.get_variable_scope(), reuse=reuse):
+        prelogits, net_points = build_network(inputs, network, embedding_size, phase_train, weight_decay, reuse=reuse,
+                                              depth_multiplier=depth_multiplier, resolution_multiplier=resolution_multiplier,
+                                              conv_defs=conv_defs)
+        embeddings = tf.nn.l2_normalize(prelogits, 1, 1e-10, name='embeddings')
+
+        # Norm for the prelogits
+        eps = 1e-5
+        prelogits_norm = tf.reduce_mean(tf.norm(tf.abs(prelogits) + eps, ord=prelogits_norm_p, axis=1))
+
+        # inference_loss, logit = cos_loss(prelogits, labels, class_number)
+        margins = {}
+        if margin_s is not None:
+            margins['s'] = margin_s
+        if margin_m is not None:
+            margins['margin_m' if loss_type == 'combine' else 'm'] = margin_m
+        logit_labels = labels
+        if classifier_devices:
+            assert sample_rate == 1.0, 'sample_rate is not supported with classifier_devices'
+            inference_loss, predictions = sharded_margin_loss(embeddings, labels, class_number, classifier_devices,
+                                                              w_init, loss_type, s=margin_s, m=margin_m,
+                                                              margin_a=margin_a, margin_b=margin_b)
+            return prelogits, embeddings, net_points, prelogits_norm, inference_loss, predictions, logit_labels
+        if sample_rate < 1.0:
+            # every class of the batch has to be sampled
+            num_sample = max(int(class_number * sample_rate), batch_size)
+            margins['class_indices'], logit_labels = sample_classes(labels, class_number, num_sample)
+        if loss_type == 'insightface':
+            inference_loss, logit = insightface_loss(embeddings, logit_labels, class_number, w_init, **margins)
+        elif loss_type == 'cosine':
+            inference_loss, logit = cosineface_loss(embeddings, logit_labels, class_number, w_init, **margins)
+        elif loss_type == 'combine':
+            inference_loss, logit = combine_loss(embeddings, logit_labels, batch_size, class_number, w_init,
+                                                 margin_a=margin_a, margin_b=margin_b, **margins)
+        else:
+            assert 0, 'loss type error, choice item just one of [insightface, cosine, combine], please check!'
+        predictions = tf.argmax(logit, 1)
+
+    return prelogits, embeddings, net_points, prelogits_norm, inference_loss, predictions, logit_labels
+
+def build_benchmark_train_op(devices, batch_size, class_number, embedding_size, loss_type, optimizer, sample_rate=1.0,
+                             classifier_devices=None, sparse_class_updates=False, network='mobilefacenet'):
+    '''training graph of random in-graph images and labels with one tower per device.'''
+    num_towers = len(devices)
+    global_step = tf.Variable(name='global_step', initial_value=0, trainable=False)
+    inputs = tf.random_uniform([batch_size, 112, 112, 3], minval=-1., maxval=1.)
+    labels = tf.random_uniform([batch_size], maxval=class_number, dtype=tf.int64)
+    tower_inputs = tf.split(inputs, num_towers) if num_towers > 1 else [inputs]
+    tower_labels = tf.split(labels, num_towers) if num_towers > 1 else [labels]
+    w_init_method = slim.initializers.xavier_initializer()
+    towers = []
+    for i, device in enumerate(devices):
+        with tf.device(device), tf.name_scope('tower_%d' % i if num_towers > 1 else ''):
+            towers.append(build_tower(tower_inputs[i], tower_labels[i], batch_size // num_towers, class_number,
+                                      embedding_size, 5e-5, loss_type, w_init_method, True, reuse=i > 0,
+                                      sample_rate=sample_rate, classifier_devices=classifier_devices, network=network))
+    regularization_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
+    tower_losses = [tf.add_n([tower[4]] + regularization_losses) for tower in towers]
+    total_loss = tf.add_n(tower_losses) / num_towers
+    tf.add_to_collection('losses', total_loss)
+    train_op, _ = train(total_loss, global_step, optimizer, 0.01, 0.999, tf.trainable_variables(), [],
+                        log_histograms=False, tower_losses=tower_losses if num_towers > 1 else None,
+                        sparse_class_updates=sparse_class_updates)
+    return train_op
+
+def run_benchmark_config(args, config):
+    '''time one benchmark configuration in this process, return its result dict.'''
+    devices = get_train_devices(args.train_devices)
+    classifier_devices = get_classifier_devices(args.classifier_devices)
+    with tf.Graph().as_default():
+        train_op = build_benchmark_train_op(devices, config['batch_size'], args.class_number, args.embedding_size,
+                                            config['loss_type'], config['optimizer'], args.sample_rate, classifier_devices,
+                                            args.sparse_class_updates, args.network)
+        session_config = get_session_config(devices + (classifier_devices or []), xla=args.xla)
+        session_config.intra_op_parallelism_threads = config['num_threads']
+        session_config.inter_op_parallelism_threads = config['num_threads']
+        with tf.Session(config=session_config) as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(args.benchmark_warmup_steps):
+                sess.run(train_op)
+            start = time.time()
+            for _ in range(args.benchmark_steps):
+                sess.run(train_op)
+            duration = time.time() - start
+
+    result = dict(config)
+    result['network'] = args.network
+    result['num_towers'] = len(devices)
+    result['xla'] = args.xla
+    result['sample_rate'] = args.sample_rate
+    result['classifier_shards'] = len(classifier_devices or [None])
+    result['sparse_class_updates'] = args.sparse_class_updates
+    result['class_number'] = args.class_number
+    result['steps_per_sec'] = args.benchmark_steps / duration
+    result['images_per_sec'] = args.benchmark_steps * config['batch_size'] / duration
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return result
+
+def benchmark(args):
+    '''run every benchmark configuration in a fresh process, so the peak memory is the one of the configuration.'''
+    if args.benchmark_config:
+        print(json.dumps(run_benchmark_config(args, json.loads(args.benchmark_config))))
+        return
+
+    results = []
+    for loss_type in args.benchmark_loss_types:
+        for optimizer in args.benchmark_optimizers:
+            for batch_size in args.benchmark_batch_sizes:
+                for num_threads in args.benchmark_threads:
+                    config = {'loss_type': loss_type, 'optimizer': optimizer, 'batch_size': batch_size,
+                              'num_threads': num_threads}
+                    cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--benchmark_config', json.dumps(config)]
+                    output = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+                    if output.returncode != 0:
+                        print('benchmark %s failed with code %d' % (config, output.returncode))
+                        continue
+                    results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+                    print('%(loss_type)s %(optimizer)s batch %(batch_size)d threads %(num_threads)d: '
+                          '%(steps_per_sec).3f steps/sec, %(images_per_sec).3f images/sec, peak rss %(peak_rss_mb).1f MB' % results[-1])
+
+    print(json.dumps(results, indent=2))
+    if args.benchmark_output:
+        with open(args.benchmark_output, 'w') as f:
+            json.dump(results, f, indent=2)
+
 if __name__ == '__main__':
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
+    args = get_parser()
+    if args.benchmark:
+        benchmark(args)
+        sys.exit(0)
+
     with tf.Graph().as_default():
-        os.environ["CUDA_VISIBLE_DEVICES"] = "0"
-        args = get_parser()
+        devices = get_train_devices(args.train_devices)
+        classifier_devices = get_classifier_devices(args.classifier_devices)
+        conv_defs = None
+        if args.conv_defs:
+            with open(args.conv_defs) as f:
+                conv_defs = conv_defs_from_json(json.load(f))
+        num_towers = len(devices)
+        assert args.train_batch_size % num_towers == 0, 'train_batch_size must be divisible by the number of train_devices'
+
+        # synchronous data parallel workers, only the chief (task 0) writes logs, summaries and ckpt
+        comm = None
+        if args.worker_hosts:
+            comm = RingAllreduce(parse_worker_hosts(args.worker_hosts), args.task_index)
+            print('worker %d of %d' % (comm.rank, comm.size))
+        num_workers = comm.size if comm is not None else 1
+        is_chief = comm is None or comm.rank == 0
 
         # create log dir
         subdir = datetime.strftime(datetime.now(), '%Y%m%d-%H%M%S')
         log_dir = os.path.join(os.path.expanduser(args.log_file_path), subdir)
-        if not os.path.isdir(log_dir):  # Create the log directory if it doesn't exist
+        if is_chief and not os.path.isdir(log_dir):  # Create the log directory if it doesn't exist
             os.makedirs(log_dir)
 
+        # throughput, latency and accuracy for the monitoring, the chief reports the global throughput
+        if is_chief:
+            metrics_exporter = MetricsExporter(args.metrics_prom_path, args.metrics_jsonl_path, args.metrics_port, job='train')
+        else:
+            metrics_exporter = MetricsExporter(job='train')
+
         # define global parameters
         global_step = tf.Variable(name='global_step', initial_value=0, trainable=False)
         epoch = tf.Variable(name='epoch', initial_value=-1, trainable=False)
         # define placeholder
-        inputs = tf.placeholder(name='img_inputs', shape=[None, *args.image_size, 3], dtype=tf.float32)
+        if args.resolution_schedule:
+            assert len(args.resolution_boundaries) == len(args.resolution_schedule) - 1, \
+                'resolution_boundaries must have one element less than resolution_schedule'
+            # the network is built for any input size, the variables are shared by every resolution
+            inputs = tf.placeholder(name='img_inputs', shape=[None, None, None, 3], dtype=tf.float32)
+        else:
+            inputs = tf.placeholder(name='img_inputs', shape=[None, *args.image_size, 3], dtype=tf.float32)
         labels = tf.placeholder(name='img_labels', shape=[None, ], dtype=tf.int64)
         phase_train_placeholder = tf.placeholder_with_default(tf.constant(False, dtype=tf.bool), shape=None, name='phase_train')
 
         # prepare train dataset
         # the image is substracted 127.5 and multiplied 1/128.
         # random flip left right
-        tfrecords_f = os.path.join(args.tfrecords_file_path, 'tran.tfrecords')
-        dataset = tf.data.TFRecordDataset(tfrecords_f)
-        dataset = dataset.map(parse_function)
+        if args.train_cache_path:
+            dataset = cached_train_dataset(args.train_cache_path)
+            if num_workers > 1:
+                dataset = dataset.shard(num_workers, args.task_index)
+        else:
+            dataset = get_train_dataset(args.tfrecords_file_path, num_workers, args.task_index)
+            dataset = dataset.map(parse_function)
+        resolution_placeholder = None
+        if args.resolution_schedule:
+            # resize to the resolution of the current phase, fed when the iterator is initialized every epoch
+            resolution_placeholder = tf.placeholder(name='train_resolution', shape=[], dtype=tf.int32)
+            dataset = dataset.map(lambda img, label: (tf.image.resize_images(img, [resolution_placeholder, resolution_placeholder]), label))
         #dataset = dataset.shuffle(buffer_size=args.buffer_size)
-        dataset = dataset.batch(args.train_batch_size)
+        if num_towers > 1 or args.accumulation_steps > 1 or args.loss_type == 'combine':
+            # every tower needs the same fixed share of the batch, combine_loss is built for a fixed batch size
+            # and accumulated micro-batches must weigh the same in the mean gradient
+            dataset = dataset.apply(tf.contrib.data.batch_and_drop_remainder(args.train_batch_size))
+        else:
+            dataset = dataset.batch(args.train_batch_size)
         iterator = dataset.make_initializable_iterator()
         next_element = iterator.get_next()
 
         # prepare validate datasets
         ver_list = []
         ver_name_list = []
-        for db in args.eval_datasets:
+        for db in (args.eval_datasets if is_chief else []):
             print('begin db %s convert.' % db)
-            data_set = load_data(db, args.image_size, args)
+            if args.eval_cache_path:
+                data_set = load_data_cache(db, args.eval_cache_path)
+            else:
+                data_set = load_data(db, args.image_size, args)
             ver_list.append(data_set)
             ver_name_list.append(db)
 
@@ -127,55 +448,81 @@ if __name__ == '__main__':
         # identity the input, for inference
         inputs = tf.identity(inputs, 'input')
 
-        prelogits, net_points = inference(inputs, bottleneck_layer_size=args.embedding_size, phase_train=phase_train_placeholder, weight_decay=args.weight_decay)
+        # replicate the tower across devices, each one gets an even slice of the batch
+        w_init_method = slim.initializers.xavier_initializer()
+        tower_batch_size = args.train_batch_size // num_towers
+        tower_inputs = tf.split(inputs, num_towers) if num_towers > 1 else [inputs]
+        tower_labels = tf.split(labels, num_towers) if num_towers > 1 else [labels]
+        towers = []
+        for i, device in enumerate(devices):
+            with tf.device(device), tf.name_scope('tower_%d' % i if num_towers > 1 else ''):
+                towers.append(build_tower(tower_inputs[i], tower_labels[i], tower_batch_size, args.class_number,
+                                          args.embedding_size, args.weight_decay, args.loss_type, w_init_method,
+                                          phase_train_placeholder, args.prelogits_norm_p, reuse=i > 0,
+                                          margin_s=args.margin_s, margin_m=args.margin_m, margin_a=args.margin_a,
+                                          margin_b=args.margin_b, sample_rate=args.sample_rate,
+                                          classifier_devices=classifier_devices, depth_multiplier=args.depth_multiplier,
+                                          resolution_multiplier=args.resolution_multiplier, conv_defs=conv_defs,
+                                          network=args.network))
+        prelogits, embeddings, net_points, _, _, _, _ = towers[0]
+        if num_towers > 1:
+            # unsplit tower for validation and for the frozen graph, sharing the variables
+            with tf.device(devices[0]), tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                prelogits, _ = build_network(inputs, args.network, args.embedding_size, phase_train_placeholder,
+                                             args.weight_decay, reuse=True, depth_multiplier=args.depth_multiplier,
+                                             resolution_multiplier=args.resolution_multiplier, conv_defs=conv_defs)
+                embeddings = tf.nn.l2_normalize(prelogits, 1, 1e-10, name='embeddings')
 
         # record the network architecture
-        hd = open("./arch/txt/MobileFaceNet_Arch.txt", 'w')
-        for key in net_points.keys():
-            info = '{}:{}\n'.format(key, net_points[key].get_shape().as_list())
-            hd.write(info)
-        hd.close()
-
-        embeddings = tf.nn.l2_normalize(prelogits, 1, 1e-10, name='embeddings')
-
-        # Norm for the prelogits
-        eps = 1e-5
-        prelogits_norm = tf.reduce_mean(tf.norm(tf.abs(prelogits) + eps, ord=args.prelogits_norm_p, axis=1))
+        if is_chief:
+            if not os.path.exists(args.arch_txt_path):
+                os.makedirs(args.arch_txt_path)
+            hd = open(os.path.join(args.arch_txt_path, 'MobileFaceNet_Arch.txt'), 'w')
+            for key in net_points.keys():
+                info = '{}:{}\n'.format(key, net_points[key].get_shape().as_list())
+                hd.write(info)
+            hd.close()
+
+        # weight decay terms are shared by the towers, the prelogits norm is averaged over them
+        weight_regularization_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
+        prelogits_norm = tf.add_n([tower[3] for tower in towers]) / num_towers
         tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, prelogits_norm * args.prelogits_norm_loss_factor)
 
-        # inference_loss, logit = cos_loss(prelogits, labels, args.class_number)
-        w_init_method = slim.initializers.xavier_initializer()
-        if args.loss_type == 'insightface':
-            inference_loss, logit = insightface_loss(embeddings, labels, args.class_number, w_init_method)
-        elif args.loss_type == 'cosine':
-            inference_loss, logit = cosineface_loss(embeddings, labels, args.class_number, w_init_method)
-        elif args.loss_type == 'combine':
-            inference_loss, logit = combine_loss(embeddings, labels, args.train_batch_size, args.class_number, w_init_method)
+        if num_towers > 1:
+            inference_loss = tf.reduce_mean(tf.stack([tower[4] for tower in towers]), name='inference_loss')
+            predictions = tf.concat([tower[5] for tower in towers], axis=0)
+            logit_labels = tf.concat([tower[6] for tower in towers], axis=0)
         else:
-            assert 0, 'loss type error, choice item just one of [insightface, cosine, combine], please check!'
+            inference_loss, predictions, logit_labels = towers[0][4], towers[0][5], towers[0][6]
         tf.add_to_collection('losses', inference_loss)
 
         # total losses
         regularization_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
         total_loss = tf.add_n([inference_loss] + regularization_losses, name='total_loss')
+        # per tower losses, their gradients average to the gradient of total_loss
+        tower_losses = None
+        if num_towers > 1:
+            tower_losses = [tf.add_n([tower[4], tower[3] * args.prelogits_norm_loss_factor] + weight_regularization_losses)
+                            for tower in towers]
 
         # define the learning rate schedule
         learning_rate = tf.train.piecewise_constant(epoch, boundaries=args.lr_schedule, values=[0.1, 0.01, 0.001, 0.0001, 0.00001],
                                          name='lr_schedule')
         
         # define sess
-        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.9)
-        config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=args.log_device_mapping, gpu_options=gpu_options)
-        config.gpu_options.allow_growth = True
+        config = get_session_config(devices + (classifier_devices or []), log_device_placement=args.log_device_mapping,
+                                    xla=args.xla)
+        if args.num_threads:
+            config.intra_op_parallelism_threads = args.num_threads
+            config.inter_op_parallelism_threads = args.num_threads
         sess = tf.Session(config=config)
 
         # calculate accuracy
-        pred = tf.nn.softmax(logit)
-        correct_prediction = tf.cast(tf.equal(tf.argmax(pred, 1), tf.cast(labels, tf.int64)), tf.float32)
+        correct_prediction = tf.cast(tf.equal(predictions, tf.cast(logit_labels, tf.int64)), tf.float32)
         Accuracy_Op = tf.reduce_mean(correct_prediction)
 
         # summary writer
-        summary = tf.summary.FileWriter(args.summary_path, sess.graph)
+        summary = tf.summary.FileWriter(args.summary_path, sess.graph) if is_chief else None
         summaries = []
         # add train info to tensorboard summary
         summaries.append(tf.summary.scalar('inference_loss', inference_loss))
@@ -184,21 +531,37 @@ if __name__ == '__main__':
         summary_op = tf.summary.merge(summaries)
 
         # train op
-        train_op = train(total_loss, global_step, args.optimizer, learning_rate, args.moving_average_decay,
-                         tf.global_variables(), summaries, args.log_histograms)
+        train_op, accumulate_op = train(total_loss, global_step, args.optimizer, learning_rate,
+                                        args.moving_average_decay, tf.global_variables(), summaries,
+                                        args.log_histograms, tower_losses=tower_losses, comm=comm,
+                                        accumulation_steps=args.accumulation_steps,
+                                        sparse_class_updates=args.sparse_class_updates)
         inc_global_step_op = tf.assign_add(global_step, 1, name='increment_global_step')
         inc_epoch_op = tf.assign_add(epoch, 1, name='increment_epoch')
 
         # record trainable variable
-        hd = open("./arch/txt/trainable_var.txt", "w")
-        for var in tf.trainable_variables():
-            hd.write(str(var))
-            hd.write('\n')
-        hd.close()
+        if is_chief:
+            hd = open(os.path.join(args.arch_txt_path, 'trainable_var.txt'), "w")
+            for var in tf.trainable_variables():
+                hd.write(str(var))
+                hd.write('\n')
+            hd.close()
 
         # saver to load pretrained model or save model
         # MobileFaceNet_vars = [v for v in tf.trainable_variables() if v.name.startswith('MobileFaceNet')]
         saver = tf.train.Saver(tf.trainable_variables(), max_to_keep=args.saver_maxkeep)
+        # checkpoints are written from a background thread, the training step only pays the snapshot copy
+        async_saver = None
+        async_best_saver = None
+        if is_chief:
+            async_saver = AsyncCheckpointSaver(tf.trainable_variables(), max_to_keep=args.saver_maxkeep, meta_saver=saver)
+            async_best_saver = AsyncCheckpointSaver(tf.trainable_variables(), max_to_keep=args.saver_maxkeep, meta_saver=saver)
+        # backbone-only snapshot without the classifier weights, for evaluation and serving
+        backbone_saver = None
+        if is_chief and args.backbone_ckpt_path:
+            backbone_vars = backbone_variables(scope=backbone_scope(args.network))
+            backbone_saver = AsyncCheckpointSaver(backbone_vars, max_to_keep=args.saver_maxkeep,
+                                                  meta_saver=tf.train.Saver(backbone_vars))
 
         # init all variables
         sess.run(tf.global_variables_initializer())
@@ -211,49 +574,96 @@ if __name__ == '__main__':
             print(ckpt)
             saver.restore(sess, ckpt.model_checkpoint_path)
 
+        # every worker starts from the variables of the chief
+        if comm is not None:
+            sess.run(broadcast_variables(tf.global_variables(), comm))
+
         # output file path
-        if not os.path.exists(args.log_file_path):
-            os.makedirs(args.log_file_path)
-        if not os.path.exists(args.ckpt_best_path):
-            os.makedirs(args.ckpt_best_path)
+        if is_chief:
+            if not os.path.exists(args.log_file_path):
+                os.makedirs(args.log_file_path)
+            if not os.path.exists(args.ckpt_path):
+                os.makedirs(args.ckpt_path)
+            if not os.path.exists(args.ckpt_best_path):
+                os.makedirs(args.ckpt_best_path)
+            if args.backbone_ckpt_path and not os.path.exists(args.backbone_ckpt_path):
+                os.makedirs(args.backbone_ckpt_path)
 
         count = 0
+        micro_step = 0
         total_accuracy = {}
         for i in range(args.max_epoch):
-            sess.run(iterator.initializer)
+            if resolution_placeholder is not None:
+                resolution = get_resolution(i, args.resolution_schedule, args.resolution_boundaries)
+                print('epoch %d trains at %dx%d' % (i, resolution, resolution))
+                sess.run(iterator.initializer, feed_dict={resolution_placeholder: resolution})
+            else:
+                sess.run(iterator.initializer)
             _ = sess.run(inc_epoch_op)
+            epoch_samples = 0
+            epoch_time = 0.0
             while True:
                 try:
-                    images_train, labels_train = sess.run(next_element)
+                    input_start = time.time()
+                    images_train, labels_train = get_next_batch(sess, next_element, comm)
+                    # time the step waits for the input pipeline, grows when the input can not keep up
+                    metrics_exporter.observe('train_input_wait_seconds', time.time() - input_start,
+                                    'Time a training step waits for its batch.')
 
                     feed_dict = {inputs: images_train, labels: labels_train, phase_train_placeholder: True}
                     start = time.time()
+                    # accumulate the micro-batches, the optimizer update runs with the last one.
+                    # the accumulation carries over the epoch end, so every update sees the same number of samples
+                    micro_step += 1
+                    if accumulate_op is not None and micro_step % args.accumulation_steps != 0:
+                        sess.run(accumulate_op, feed_dict=feed_dict)
+                        epoch_samples += args.train_batch_size * num_workers
+                        epoch_time += time.time() - start
+                        continue
                     _, total_loss_val, inference_loss_val, reg_loss_val, _, acc_val = \
                     sess.run([train_op, total_loss, inference_loss, regularization_losses, inc_global_step_op, Accuracy_Op],
                              feed_dict=feed_dict)
                     end = time.time()
-                    pre_sec = args.train_batch_size/(end - start)
+                    pre_sec = args.train_batch_size * num_workers/(end - start)
+                    epoch_samples += args.train_batch_size * num_workers
+                    epoch_time += end - start
+                    metrics_exporter.observe('train_step_seconds', end - start, 'Latency of a training step.')
+                    metrics_exporter.set('train_images_per_second', pre_sec, 'Training images per second of the last step.')
 
                     count += 1
+                    metrics_exporter.set('train_global_step', count, 'Training steps done.')
                     # print training information
-                    if count > 0 and count % args.show_info_interval == 0:
-                        print('epoch %d, total_step %d, total loss is %.2f , inference loss is %.2f, reg_loss is %.2f, training accuracy is %.6f, time %.3f samples/sec' %
-                              (i, count, total_loss_val, inference_loss_val, np.sum(reg_loss_val), acc_val, pre_sec))
+                    if is_chief and count > 0 and count % args.show_info_interval == 0:
+                        print('epoch %d, total_step %d, total loss is %.2f , inference loss is %.2f, reg_loss is %.2f, training accuracy is %.6f, time %.3f samples/sec, %.3f samples/sec per device' %
+                              (i, count, total_loss_val, inference_loss_val, np.sum(reg_loss_val), acc_val, pre_sec, pre_sec / (num_towers * num_workers)))
+                        metrics_exporter.set('train_total_loss', total_loss_val, 'Total loss of the last step.')
+                        metrics_exporter.set('train_accuracy', acc_val, 'Training accuracy of the last step.')
+                        step_quantiles = metrics_exporter.quantiles('train_step_seconds')
+                        metrics_exporter.log('train', epoch=i, step=count, total_loss=total_loss_val,
+                                             inference_loss=inference_loss_val, accuracy=acc_val, images_per_sec=pre_sec,
+                                             step_seconds_p50=step_quantiles[0.5], step_seconds_p90=step_quantiles[0.9],
+                                             step_seconds_p99=step_quantiles[0.99],
+                                             input_wait_seconds_p50=metrics_exporter.quantiles('train_input_wait_seconds')[0.5])
+                        metrics_exporter.flush()
 
                     # save summary
-                    if count > 0 and count % args.summary_interval == 0:
+                    if is_chief and count > 0 and count % args.summary_interval == 0:
                         feed_dict = {inputs: images_train, labels: labels_train, phase_train_placeholder: True}
                         summary_op_val = sess.run(summary_op, feed_dict=feed_dict)
                         summary.add_summary(summary_op_val, count)
 
                     # save ckpt files
-                    if count > 0 and count % args.ckpt_interval == 0:
+                    if is_chief and count > 0 and count % args.ckpt_interval == 0:
                         filename = 'MobileFaceNet_iter_{:d}'.format(count) + '.ckpt'
                         filename = os.path.join(args.ckpt_path, filename)
-                        saver.save(sess, filename)
+                        async_saver.save(sess, filename)
+                        if backbone_saver is not None:
+                            filename = 'MobileFaceNet_backbone_iter_{:d}'.format(count) + '.ckpt'
+                            filename = os.path.join(args.backbone_ckpt_path, filename)
+                            backbone_saver.save(sess, filename)
 
                     # validate
-                    if count > 0 and count % args.validate_interval == 0:
+                    if is_chief and count > 0 and count % args.validate_interval == 0:
                         print('\nIteration', count, 'testing...')
                         for db_index in range(len(ver_list)):
                             start_time = time.time()
@@ -264,7 +674,7 @@ if __name__ == '__main__':
                                 start_index = index * args.test_batch_size
                                 end_index = min((index + 1) * args.test_batch_size, data_sets.shape[0])
 
-                                feed_dict = {inputs: data_sets[start_index:end_index, ...], phase_train_placeholder: False}
+                                feed_dict = {inputs: normalize_images(data_sets[start_index:end_index, ...]), phase_train_placeholder: False}
                                 emb_array[start_index:end_index, :] = sess.run(embeddings, feed_dict=feed_dict)
 
                             tpr, fpr, accuracy, val, val_std, far = evaluate(emb_array, issame_list, nrof_folds=args.eval_nrof_folds)
@@ -275,11 +685,13 @@ if __name__ == '__main__':
                             print('Validation rate: %2.5f+-%2.5f @ FAR=%2.5f' % (val, val_std, far))
                             print('fpr and tpr: %1.3f %1.3f' % (np.mean(fpr, 0), np.mean(tpr, 0)))
 
-                            auc = metrics.auc(fpr, tpr)
+                            auc, eer = calculate_auc_eer(fpr, tpr)
                             print('Area Under Curve (AUC): %1.3f' % auc)
-                            eer = brentq(lambda x: 1. - x - interpolate.interp1d(fpr, tpr)(x), 0., 1.)
                             print('Equal Error Rate (EER): %1.3f\n' % eer)
 
+                            metrics_exporter.evaluation(ver_name_list[db_index], duration, data_sets.shape[0],
+                                                        np.mean(accuracy), val, step=count)
+
                             with open(os.path.join(log_dir, '{}_result.txt'.format(ver_name_list[db_index])), 'at') as f:
                                 f.write('%d\t%.5f\t%.5f\n' % (count, np.mean(accuracy), val))
 
@@ -287,8 +699,32 @@ if __name__ == '__main__':
                                 print('best accuracy is %.5f' % np.mean(accuracy))
                                 filename = 'MobileFaceNet_iter_best_{:d}'.format(count) + '.ckpt'
                                 filename = os.path.join(args.ckpt_best_path, filename)
-                                saver.save(sess, filename)
+                                async_best_saver.save(sess, filename)
+
+                    if args.max_steps and count >= args.max_steps:
+                        break
 
                 except tf.errors.OutOfRangeError:
-                    print("End of epoch %d" % i)
+                    if is_chief:
+                        print("End of epoch %d" % i)
+                        if epoch_time > 0:
+                            print('epoch %d throughput %.3f samples/sec on %d towers x %d workers, %.3f samples/sec per device' %
+                                  (i, epoch_samples / epoch_time, num_towers, num_workers, epoch_samples / epoch_time / (num_towers * num_workers)))
+                            metrics_exporter.set('train_epoch_images_per_second', epoch_samples / epoch_time,
+                                                 'Training images per second of the last epoch.')
+                            metrics_exporter.log('epoch', epoch=i, step=count, images_per_sec=epoch_samples / epoch_time)
+                            metrics_exporter.flush()
                     break
+            if args.max_steps and count >= args.max_steps:
+                print('reach max_steps %d' % args.max_steps)
+                break
+
+        # wait for the pending checkpoints
+        if is_chief:
+            async_saver.close()
+            async_best_saver.close()
+        if backbone_saver is not None:
+            backbone_saver.close()
+        if comm is not None:
+            comm.close()
+        metrics_exporter.close()
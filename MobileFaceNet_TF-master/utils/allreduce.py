@@ -0,0 +1,201 @@
+'''
+synchronous data parallel training across processes with a ring allreduce over plain TCP sockets.
+
+every worker listens on its own host:port of the worker list, connects to the next worker of the ring
+and accepts the connection of the previous one, no cluster service is needed, several processes on one
+box work with 127.0.0.1 and different ports.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import socket
+import struct
+import time
+
+import tensorflow as tf
+import numpy as np
+
+
+def parse_worker_hosts(worker_hosts):
+    '''parse "host0:port0,host1:port1" into a list of (host, port).'''
+    addresses = []
+    for host in worker_hosts.split(','):
+        host = host.strip()
+        if not host:
+            continue
+        name, port = host.rsplit(':', 1)
+        addresses.append((name, int(port)))
+    return addresses
+
+
+def _recv_into(sock, buf):
+    view = memoryview(buf).cast('B')
+    while len(view):
+        nbytes = sock.recv_into(view)
+        if nbytes == 0:
+            raise ConnectionError('allreduce peer closed the connection')
+        view = view[nbytes:]
+
+
+class RingAllreduce(object):
+    """Ring allreduce between the processes listed in worker_hosts.
+
+    The payload is split in `size` chunks, a reduce-scatter pass followed by an
+    allgather pass moves 2 * (size - 1) / size of the payload through every link,
+    independent of the number of workers.
+    """
+
+    def __init__(self, worker_hosts, rank, timeout=300.):
+        """
+        Args:
+          worker_hosts: list of (host, port), one per worker, the same on every worker.
+          rank: index of this worker in worker_hosts.
+          timeout: seconds to wait for the other workers to come up.
+        """
+        self.size = len(worker_hosts)
+        self.rank = rank
+        self._send_sock = None
+        self._recv_sock = None
+        if self.size == 1:
+            return
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('', worker_hosts[rank][1]))
+        listener.listen(1)
+
+        # the listener is up before connecting, so connect only waits for the next worker to start
+        deadline = time.time() + timeout
+        next_host = worker_hosts[(rank + 1) % self.size]
+        while True:
+            try:
+                self._send_sock = socket.create_connection(next_host, timeout=timeout)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.5)
+        self._send_sock.sendall(struct.pack('!i', rank))
+
+        listener.settimeout(max(deadline - time.time(), 1.))
+        self._recv_sock, _ = listener.accept()
+        listener.close()
+        peer = np.empty(1, dtype='>i4')
+        _recv_into(self._recv_sock, peer)
+        if int(peer[0]) != (rank - 1) % self.size:
+            raise ValueError('worker %d expected a connection from worker %d, got worker %d' %
+                             (rank, (rank - 1) % self.size, int(peer[0])))
+
+        for sock in (self._send_sock, self._recv_sock):
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _send_recv(self, send_buf, recv_buf):
+        # send from a thread so two neighbours sending large chunks can not block each other
+        error = []
+
+        def send():
+            try:
+                self._send_sock.sendall(memoryview(send_buf).cast('B'))
+            except Exception as e:
+                error.append(e)
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        _recv_into(self._recv_sock, recv_buf)
+        sender.join()
+        if error:
+            raise error[0]
+
+    def allreduce(self, array, average=True):
+        """Sum (or average) a float32 array over all the workers.
+
+        Args:
+          array: numpy array, the same shape on every worker.
+          average: divide the sum by the number of workers.
+        Returns:
+          float32 numpy array with the shape of array.
+        """
+        data = np.array(array, dtype=np.float32).ravel()
+        if self.size == 1:
+            return data.reshape(np.shape(array))
+
+        chunks = np.array_split(data, self.size)
+        buf = np.empty(max(c.size for c in chunks), dtype=np.float32)
+        # reduce-scatter: after size - 1 steps, chunk (rank + 1) % size holds the full sum
+        for step in range(self.size - 1):
+            send_index = (self.rank - step) % self.size
+            recv_index = (self.rank - step - 1) % self.size
+            recv_buf = buf[:chunks[recv_index].size]
+            self._send_recv(chunks[send_index], recv_buf)
+            chunks[recv_index] += recv_buf
+        # allgather: pass the reduced chunks around the ring
+        for step in range(self.size - 1):
+            send_index = (self.rank + 1 - step) % self.size
+            recv_index = (self.rank - step) % self.size
+            self._send_recv(chunks[send_index], chunks[recv_index])
+
+        if average:
+            data /= self.size
+        return data.reshape(np.shape(array))
+
+    def broadcast(self, array, root=0):
+        """Return the array of worker root on every worker."""
+        array = np.asarray(array, dtype=np.float32)
+        if self.rank != root:
+            array = np.zeros_like(array)
+        return self.allreduce(array, average=False)
+
+    def all_true(self, flag):
+        """True when flag is True on every worker, every worker must call it."""
+        return int(self.allreduce(np.array([1. if flag else 0.]), average=False)[0]) == self.size
+
+    def close(self):
+        for sock in (self._send_sock, self._recv_sock):
+            if sock is not None:
+                sock.close()
+
+
+def allreduce_gradients(grads_and_vars, comm):
+    '''average the gradients over the workers, with one fused allreduce per step.
+
+    Args:
+        grads_and_vars: list of (gradient, variable) tuples, as returned by Optimizer.compute_gradients.
+        comm: RingAllreduce.
+
+    Returns:
+        list of (gradient, variable) tuples with the averaged gradients.
+    '''
+    indices = [i for i, (grad, _) in enumerate(grads_and_vars) if grad is not None]
+    if comm.size == 1 or not indices:
+        return grads_and_vars
+
+    grads = [tf.convert_to_tensor(grads_and_vars[i][0]) for i in indices]
+    variables = [grads_and_vars[i][1] for i in indices]
+    flat = tf.concat([tf.reshape(tf.cast(grad, tf.float32), [-1]) for grad in grads], axis=0)
+    reduced = tf.py_func(comm.allreduce, [flat], tf.float32, stateful=True, name='allreduce_gradients')
+    sizes = [var.get_shape().num_elements() for var in variables]
+    reduced = tf.split(tf.reshape(reduced, [sum(sizes)]), sizes)
+
+    averaged = list(grads_and_vars)
+    for i, grad, var, value in zip(indices, grads, variables, reduced):
+        averaged[i] = (tf.cast(tf.reshape(value, var.get_shape()), grad.dtype), var)
+    return averaged
+
+
+def broadcast_variables(var_list, comm, root=0):
+    '''op that overwrites the float variables of every worker with the values of worker root.'''
+    var_list = [var for var in var_list if var.dtype.base_dtype.is_floating]
+    if comm.size == 1 or not var_list:
+        return tf.no_op(name='broadcast_variables')
+
+    flat = tf.concat([tf.reshape(tf.cast(var, tf.float32), [-1]) for var in var_list], axis=0)
+    values = tf.py_func(lambda x: comm.broadcast(x, root=root), [flat], tf.float32, stateful=True)
+    sizes = [var.get_shape().num_elements() for var in var_list]
+    values = tf.split(tf.reshape(values, [sum(sizes)]), sizes)
+    assign_ops = [tf.assign(var, tf.cast(tf.reshape(value, var.get_shape()), var.dtype.base_dtype))
+                  for var, value in zip(var_list, values)]
+    return tf.group(*assign_ops, name='broadcast_variables')
@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import subprocess
+import resource
+import json
+import time
+import sys
+
+import numpy as np
+
+
+def add_benchmark_arguments(parser, warmup_runs=3, num_runs=20, num_threads=0):
+    """Add the arguments shared by the benchmark scripts.
+
+    --warmup_runs and --num_runs of time_runs, --num_threads of session_config
+    and the internal --run_config of run_config_process.
+    """
+    parser.add_argument('--warmup_runs', type=int, default=warmup_runs, help='runs before timing')
+    parser.add_argument('--num_runs', type=int, default=num_runs, help='timed runs')
+    parser.add_argument('--num_threads', type=int, default=num_threads,
+                        help='intra/inter op threads, 0 lets tensorflow choose')
+    parser.add_argument('--run_config', action='store_true', help='internal, run a single configuration')
+
+
+def session_config(num_threads=0):
+    """tf.ConfigProto with num_threads intra and inter op threads, 0 lets tensorflow choose."""
+    import tensorflow as tf
+    config = tf.ConfigProto()
+    if num_threads:
+        config.intra_op_parallelism_threads = num_threads
+        config.inter_op_parallelism_threads = num_threads
+    return config
+
+
+def time_runs(run, warmup_runs, num_runs):
+    """Seconds of num_runs calls of run, after warmup_runs calls that are not timed."""
+    for _ in range(warmup_runs):
+        run()
+    times = []
+    for _ in range(num_runs):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    return times
+
+
+def median_ms(times):
+    return float(np.median(times)) * 1000.
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def config_arguments(config):
+    """Command line arguments of a configuration dict, True is a flag, False is left out, lists are nargs."""
+    argv = []
+    for key, value in config.items():
+        if value is True:
+            argv.append('--' + key)
+        elif value is False:
+            continue
+        elif isinstance(value, (list, tuple)):
+            argv += ['--' + key] + [str(v) for v in value]
+        else:
+            argv += ['--' + key, str(value)]
+    return argv
+
+
+def run_config_process(script, config, extra_args=()):
+    """Run one configuration of a benchmark script in a fresh interpreter.
+
+    The script is run with --run_config, the arguments of config and extra_args, and
+    prints its result as the last json line of its output. A configuration per
+    process keeps the peak resident memory and the process wide state (thread
+    pools, XLA flags) to that configuration.
+    Returns:
+      the result dict, or config with 'failed': the exit code (usually out of memory).
+    """
+    cmd = [sys.executable, script, '--run_config'] + config_arguments(config) + list(extra_args)
+    output = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    if output.returncode != 0:
+        print('%s failed with code %d' % (' '.join(config_arguments(config)), output.returncode))
+        return dict(config, failed=output.returncode)
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    print(result)
+    return result
+
+
+def write_results(results, output):
+    """Dump the results to the json file output, nothing when output is empty."""
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+CRITERIA = ('l1', 'bn')
+
+
+def unit_names(units):
+    """Names of the residual units of a resnet of units per stage (nets.L_Resnet_E_IR.resnet_config)."""
+    return ['stage%d_unit%d' % (i + 1, j + 1) for i in range(len(units)) for j in range(units[i])]
+
+
+def unit_variables(unit, scope='ResNet'):
+    """{variable name: channel axis} of the variables of a residual unit that hold its inner channels,
+    the outputs of conv1 that conv2 reads."""
+    prefix = '%s/%s_' % (scope, unit)
+    variables = {prefix + 'conv1_weight': 3, prefix + 'conv2_weight': 2, prefix + 'relu1_gamma': 0}
+    for suffix in ['mean', 'var', 'bias', 'scale']:
+        variables[prefix + 'bn2_' + suffix] = 0
+    return variables
+
+
+def inner_widths(values, units, scope='ResNet'):
+    """{unit name: inner channels} of the checkpoint values ({variable name: numpy value})."""
+    return dict((unit, values['%s/%s_conv1_weight' % (scope, unit)].shape[3]) for unit in unit_names(units))
+
+
+def filter_importance(values, unit, criterion='l1', scope='ResNet', epsilon=2e-5):
+    """Importance of every inner channel of a unit.
+
+    Args:
+      values: {variable name: numpy value} of a checkpoint.
+      unit: residual unit name, eg: stage2_unit3.
+      criterion: 'l1', L1 norm of the conv1 filters, or 'bn', the batch norm gain
+        |scale| / sqrt(moving variance + epsilon) that follows conv1.
+    Returns:
+      numpy array of one importance per inner channel.
+    """
+    prefix = '%s/%s_' % (scope, unit)
+    if criterion == 'l1':
+        return np.sum(np.abs(values[prefix + 'conv1_weight']), axis=(0, 1, 2))
+    if criterion == 'bn':
+        return np.abs(values[prefix + 'bn2_scale']) / np.sqrt(values[prefix + 'bn2_var'] + epsilon)
+    raise ValueError('criterion must be one of %s' % ', '.join(CRITERIA))
+
+
+def select_channels(values, units, widths, criterion='l1', scope='ResNet'):
+    """{unit name: sorted indices of the widths[unit] most important inner channels}."""
+    keep = {}
+    for unit in unit_names(units):
+        importance = filter_importance(values, unit, criterion, scope)
+        keep[unit] = np.sort(np.argsort(-importance, kind='stable')[:widths[unit]])
+    return keep
+
+
+def prune_channels(values, keep, scope='ResNet'):
+    """Checkpoint values of the narrower network that only has the kept inner channels.
+
+    The variables derived from a pruned one (pruning masks, optimizer slots, moving
+    averages: name/...) with the same shape are sliced the same way, everything else
+    is copied.
+    """
+    axes = {}
+    for unit, indices in keep.items():
+        for name, axis in unit_variables(unit, scope).items():
+            axes[name] = (axis, indices)
+    pruned = {}
+    for name, value in values.items():
+        base = name
+        while base not in axes and '/' in base[len(scope) + 1:]:
+            base = base.rsplit('/', 1)[0]
+        if base in axes and base in values and value.shape == values[base].shape:
+            axis, indices = axes[base]
+            value = np.take(value, indices, axis=axis)
+        pruned[name] = value
+    return pruned
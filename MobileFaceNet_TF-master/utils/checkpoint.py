@@ -0,0 +1,138 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import queue
+
+import tensorflow as tf
+
+
+def backbone_variables(var_list=None, scope='MobileFaceNet'):
+    """Select the variables that belong to the backbone scope.
+
+    Args:
+      var_list: variables to filter, default is tf.trainable_variables(). The batch
+        norm moving statistics live in the trainable collection, so they are kept.
+      scope: name prefix of the backbone variables.
+    Returns:
+      list of variables whose name starts with scope.
+    """
+    if var_list is None:
+        var_list = tf.trainable_variables()
+    return [v for v in var_list if v.op.name.startswith(scope + '/')]
+
+
+def read_checkpoint(ckpt_path):
+    """{variable name: numpy value} of every variable of the checkpoint ckpt_path."""
+    reader = tf.train.NewCheckpointReader(ckpt_path)
+    return dict((name, reader.get_tensor(name)) for name in reader.get_variable_to_shape_map())
+
+
+def write_checkpoint(values, save_path, global_step=None):
+    """Write a regular tf.train.Saver checkpoint of {variable name: numpy value}.
+
+    The values are fed through placeholders, so they are not embedded in the graph
+    (no 2GB graph limit). Returns the checkpoint path.
+    """
+    with tf.Graph().as_default():
+        placeholders = {}
+        variables = {}
+        for name, value in values.items():
+            placeholders[name] = tf.placeholder(tf.as_dtype(value.dtype), shape=value.shape)
+            variables[name] = tf.Variable(placeholders[name], name=name, trainable=False)
+        saver = tf.train.Saver(variables)
+        with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+            sess.run(tf.global_variables_initializer(),
+                     feed_dict=dict((placeholders[name], values[name]) for name in values))
+            return saver.save(sess, save_path, global_step=global_step, write_meta_graph=False)
+
+class AsyncCheckpointSaver(object):
+    """Save checkpoints from a background thread.
+
+    save() only fetches the current variable values (an in-memory copy) and returns,
+    the serialization to disk is done by a worker thread through a shadow graph that
+    holds one variable per saved variable under the same name. The files written are
+    regular tf.train.Saver checkpoints, so they are restored with tf.train.Saver,
+    test_nets.py or utils/freeze_graph.py exactly as before.
+
+    At most one snapshot waits for the writer, a further save() blocks until the
+    previous write has been handed to the worker, this bounds the host memory to two
+    copies of var_list.
+    """
+
+    def __init__(self, var_list, max_to_keep=5, meta_saver=None):
+        """
+        Args:
+          var_list: list of variables to snapshot.
+          max_to_keep: tf.train.Saver max keep ckpt files.
+          meta_saver: optional tf.train.Saver of the training graph, when given its
+            meta graph is written next to every checkpoint as `<filename>.meta`.
+            Create it after the whole graph is built.
+        """
+        self._var_list = list(var_list)
+        self._meta_graph_def = meta_saver.export_meta_graph() if meta_saver is not None else None
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._placeholders = []
+            assign_ops = []
+            shadow_vars = {}
+            for var in self._var_list:
+                dtype = var.dtype.base_dtype
+                shape = var.get_shape()
+                placeholder = tf.placeholder(dtype, shape=shape)
+                shadow = tf.Variable(tf.zeros(shape, dtype=dtype), name=var.op.name, trainable=False)
+                assign_ops.append(tf.assign(shadow, placeholder))
+                self._placeholders.append(placeholder)
+                shadow_vars[var.op.name] = shadow
+            self._assign_op = tf.group(*assign_ops)
+            self._saver = tf.train.Saver(shadow_vars, max_to_keep=max_to_keep)
+        self._sess = tf.Session(graph=self._graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='AsyncCheckpointSaver')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                values, filename, global_step = item
+                feed_dict = dict(zip(self._placeholders, values))
+                self._sess.run(self._assign_op, feed_dict=feed_dict)
+                path = self._saver.save(self._sess, filename, global_step=global_step, write_meta_graph=False)
+                if self._meta_graph_def is not None:
+                    with tf.gfile.GFile(path + '.meta', 'wb') as f:
+                        f.write(self._meta_graph_def.SerializeToString())
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, sess, filename, global_step=None):
+        """Snapshot var_list from sess and queue it to be written to filename."""
+        self._raise_error()
+        values = sess.run(self._var_list)
+        self._queue.put((values, filename, global_step))
+
+    def flush(self):
+        """Block until every queued checkpoint is on disk."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Flush the pending checkpoints and stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+        self._sess.close()
+        self._raise_error()
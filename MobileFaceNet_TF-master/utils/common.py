@@ -2,7 +2,27 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from losses.face_losses import SAMPLED_WEIGHTS, SAMPLED_WEIGHTS_VARIABLES, SAMPLED_WEIGHTS_INDICES
+from utils.allreduce import allreduce_gradients
 import tensorflow as tf
+import os
+
+def enable_xla_jit(config):
+    """Turn on XLA JIT compilation of the whole graph for the sessions created with config.
+
+    On CPU the global jit level only applies with --tf_xla_cpu_global_jit, it is added
+    to TF_XLA_FLAGS, which tensorflow reads once, so call this before the first session.
+
+    Args:
+      config: tf.ConfigProto.
+    Returns:
+      config.
+    """
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    xla_flags = os.environ.get('TF_XLA_FLAGS', '')
+    if '--tf_xla_cpu_global_jit' not in xla_flags:
+        os.environ['TF_XLA_FLAGS'] = (xla_flags + ' --tf_xla_cpu_global_jit').strip()
+    return config
 
 def _add_loss_summaries(total_loss, summaries):
     """Add summaries for losses.
@@ -31,13 +51,200 @@ def _add_loss_summaries(total_loss, summaries):
     return loss_averages_op
 
 
+def average_gradients(tower_grads):
+    """Average the gradients of every variable over the towers.
+
+    Args:
+      tower_grads: list over towers of lists of (gradient, variable) tuples, as
+        returned by Optimizer.compute_gradients for the same variable list.
+    Returns:
+      list of (gradient, variable) tuples where the gradient is averaged across
+      all towers, None when no tower has a gradient for the variable.
+    """
+    average_grads = []
+    for grad_and_vars in zip(*tower_grads):
+        var = grad_and_vars[0][1]
+        grads = [g for g, _ in grad_and_vars if g is not None]
+        if not grads:
+            average_grads.append((None, var))
+            continue
+        grad = tf.add_n([tf.convert_to_tensor(g) for g in grads]) / len(grad_and_vars)
+        average_grads.append((grad, var))
+    return average_grads
+
+
+def accumulate_gradients(grads, accumulation_steps):
+    """Sum the gradients of several micro-batches into local accumulators.
+
+    Args:
+      grads: list of (gradient, variable) tuples of one micro-batch.
+      accumulation_steps: number of micro-batches per optimizer update.
+    Returns:
+      accumulate_op: op that adds the gradients of the current micro-batch.
+      mean_grads: list of (gradient, variable) tuples, the accumulated sum divided
+        by accumulation_steps, read after accumulate_op.
+      reset_op_fn: function returning the op that zeroes the accumulators, it takes
+        the ops the reset has to wait for.
+    """
+    accumulators = []
+    accumulate_ops = []
+    for grad, var in grads:
+        if grad is None:
+            accumulators.append(None)
+            continue
+        # no control inputs of the caller, the initializer must run without the inputs of the loss
+        with tf.control_dependencies(None):
+            accumulator = tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                      name=var.op.name.replace('/', '_') + '_accumulator',
+                                      collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        accumulators.append(accumulator)
+        accumulate_ops.append(tf.assign_add(accumulator, tf.convert_to_tensor(grad)))
+    accumulate_op = tf.group(*accumulate_ops, name='accumulate_gradients')
+
+    mean_grads = []
+    with tf.control_dependencies([accumulate_op]):
+        for (grad, var), accumulator in zip(grads, accumulators):
+            if accumulator is None:
+                mean_grads.append((None, var))
+            else:
+                mean_grads.append((accumulator.read_value() / accumulation_steps, var))
+
+    def reset_op_fn(dependencies):
+        with tf.control_dependencies(dependencies):
+            return tf.group(*[tf.assign(a, tf.zeros_like(a)) for a in accumulators if a is not None],
+                            name='reset_accumulators')
+
+    return accumulate_op, mean_grads, reset_op_fn
+
+
+def sparse_column_update(var, indices, grad, optimizer, learning_rate):
+    """Lazy optimizer update of the columns `indices` of var.
+
+    Only these columns of the variable and of its optimizer slots are read and
+    written, the other columns keep their values, as with the lazy Adam of
+    embeddings. The hyper parameters are the ones of the dense optimizers of train.
+    The Adam bias correction keeps its own beta1_power and beta2_power under
+    <var>/Lazy, as tf.train.AdamOptimizer does, they advance once per update.
+
+    Args:
+      var: variable of shape (embedding_size, out_num), the class weights of a margin loss.
+      indices: int column indices, a column can repeat, its gradients are summed.
+      grad: gradient of the gathered columns, shape (embedding_size, len(indices)).
+      optimizer: ADAGRAD, ADADELTA, ADAM, RMSPROP or MOM.
+      learning_rate: learning rate tensor.
+    Returns:
+      the update op.
+    """
+    indices, positions = tf.unique(tf.cast(indices, tf.int64))
+    num_columns = tf.size(indices, out_type=tf.int64)
+    grad = tf.transpose(tf.unsorted_segment_sum(tf.transpose(grad), positions, num_columns))
+    # (embedding_size, num_columns, 2) element indices of the columns
+    rows = tf.range(var.get_shape().as_list()[0], dtype=tf.int64)
+    element_indices = tf.stack(tf.meshgrid(rows, indices, indexing='ij'), axis=2)
+
+    def slot(name, value, shape=var.get_shape()):
+        # train calls this under the loss average dependency, the initializers must not inherit it
+        with tf.control_dependencies(None), tf.variable_scope(var.op.name + '/Lazy'):
+            return tf.get_variable(name, shape=shape, dtype=var.dtype.base_dtype, trainable=False,
+                                   initializer=tf.constant_initializer(value))
+
+    def column_slot(name, value):
+        slot_var = slot(name, value)
+        return slot_var, tf.gather(slot_var, indices, axis=1)
+
+    var_cols = tf.gather(var, indices, axis=1)
+    updates = []
+    # (variable, its next value), assigned after the columns
+    scalar_updates = []
+    if optimizer == 'ADAM':
+        beta1, beta2, epsilon = 0.9, 0.999, 0.1
+        m, m_cols = column_slot('m', 0.)
+        v, v_cols = column_slot('v', 0.)
+        beta1_power = slot('beta1_power', beta1, shape=[])
+        beta2_power = slot('beta2_power', beta2, shape=[])
+        m_cols = beta1 * m_cols + (1. - beta1) * grad
+        v_cols = beta2 * v_cols + (1. - beta2) * tf.square(grad)
+        lr = learning_rate * tf.sqrt(1. - beta2_power) / (1. - beta1_power)
+        new_cols = var_cols - lr * m_cols / (tf.sqrt(v_cols) + epsilon)
+        updates += [(m, m_cols), (v, v_cols)]
+        scalar_updates += [(beta1_power, beta1_power * beta1), (beta2_power, beta2_power * beta2)]
+    elif optimizer == 'MOM':
+        momentum = 0.9
+        accum, accum_cols = column_slot('momentum', 0.)
+        accum_cols = momentum * accum_cols + grad
+        # nesterov
+        new_cols = var_cols - learning_rate * (grad + momentum * accum_cols)
+        updates += [(accum, accum_cols)]
+    elif optimizer == 'ADAGRAD':
+        accum, accum_cols = column_slot('accumulator', 0.1)
+        accum_cols = accum_cols + tf.square(grad)
+        new_cols = var_cols - learning_rate * grad / tf.sqrt(accum_cols)
+        updates += [(accum, accum_cols)]
+    elif optimizer == 'RMSPROP':
+        decay, momentum, epsilon = 0.9, 0.9, 1.0
+        ms, ms_cols = column_slot('rms', 1.)
+        mom, mom_cols = column_slot('momentum', 0.)
+        ms_cols = decay * ms_cols + (1. - decay) * tf.square(grad)
+        mom_cols = momentum * mom_cols + learning_rate * grad / tf.sqrt(ms_cols + epsilon)
+        new_cols = var_cols - mom_cols
+        updates += [(ms, ms_cols), (mom, mom_cols)]
+    elif optimizer == 'ADADELTA':
+        rho, epsilon = 0.9, 1e-6
+        accum, accum_cols = column_slot('accum', 0.)
+        accum_update, accum_update_cols = column_slot('accum_update', 0.)
+        accum_cols = rho * accum_cols + (1. - rho) * tf.square(grad)
+        update = tf.sqrt(accum_update_cols + epsilon) / tf.sqrt(accum_cols + epsilon) * grad
+        accum_update_cols = rho * accum_update_cols + (1. - rho) * tf.square(update)
+        new_cols = var_cols - learning_rate * update
+        updates += [(accum, accum_cols), (accum_update, accum_update_cols)]
+    else:
+        raise ValueError('Invalid optimization algorithm')
+
+    updates.append((var, new_cols))
+    column_updates = [tf.scatter_nd_update(ref, element_indices, value) for ref, value in updates]
+    with tf.control_dependencies(column_updates):
+        scalar_ops = [tf.assign(ref, value) for ref, value in scalar_updates]
+    return tf.group(*(column_updates + scalar_ops), name=var.op.name.replace('/', '_') + '_sparse_update')
+
+
 def train(total_loss, global_step, optimizer, learning_rate, moving_average_decay, update_gradient_vars, summaries,
-          log_histograms=True):
+          log_histograms=True, tower_losses=None, comm=None, accumulation_steps=1, sparse_class_updates=False):
+    """Build the op for one optimizer update.
+
+    Returns (train_op, accumulate_op), accumulate_op is None unless accumulation_steps > 1.
+
+    With sparse_class_updates the class weights of the sampled margin losses
+    (Partial-FC, losses.face_losses.select_classes) are updated by
+    sparse_column_update, only the sampled columns and their slots are touched,
+    they are left out of the dense optimizer and of the variable moving averages.
+
+    With accumulation_steps > 1 the gradients of accumulation_steps micro-batches are
+    summed before the update: run accumulate_op for the first accumulation_steps - 1
+    micro-batches and train_op for the last one, it adds that micro-batch, applies the
+    mean of the accumulated gradients and clears the accumulators. The learning rate is
+    read when train_op runs, global_step and the loss and variable moving averages
+    advance once per update. Batch norm statistics are still computed per micro-batch.
+    """
     # Generate moving averages of all losses and associated summaries.
     loss_averages_op = _add_loss_summaries(total_loss, summaries)
 
-    # Compute gradients.
-    with tf.control_dependencies([loss_averages_op]):
+    sparse_heads = []
+    if sparse_class_updates:
+        sparse_heads = list(zip(tf.get_collection(SAMPLED_WEIGHTS_VARIABLES), tf.get_collection(SAMPLED_WEIGHTS_INDICES),
+                                tf.get_collection(SAMPLED_WEIGHTS)))
+        if not sparse_heads:
+            raise ValueError('sparse_class_updates needs a sampled margin loss (class_indices)')
+        if comm is not None or accumulation_steps > 1:
+            raise ValueError('sparse_class_updates does not support worker_hosts or accumulation_steps')
+    sparse_vars = []
+    for var, _, _ in sparse_heads:
+        if var not in sparse_vars:
+            sparse_vars.append(var)
+    update_gradient_vars = [var for var in update_gradient_vars if var not in sparse_vars]
+
+    # Compute gradients. The accumulated micro-batches compute them without the loss
+    # averages, these advance with train_op, once per update.
+    with tf.control_dependencies([loss_averages_op] if accumulation_steps == 1 else []):
         if optimizer == 'ADAGRAD':
             opt = tf.train.AdagradOptimizer(learning_rate)
         elif optimizer == 'ADADELTA':
@@ -51,10 +258,41 @@ def train(total_loss, global_step, optimizer, learning_rate, moving_average_deca
         else:
             raise ValueError('Invalid optimization algorithm')
 
-        grads = opt.compute_gradients(total_loss, update_gradient_vars)
+        if tower_losses is None:
+            grads = opt.compute_gradients(total_loss, update_gradient_vars)
+        else:
+            # data parallel towers, each gradient stays on the device of its tower before the average
+            tower_grads = [opt.compute_gradients(loss, update_gradient_vars, colocate_gradients_with_ops=True)
+                           for loss in tower_losses]
+            grads = average_gradients(tower_grads)
+
+        accumulate_op = None
+        if accumulation_steps > 1:
+            accumulate_op, grads, reset_op_fn = accumulate_gradients(grads, accumulation_steps)
+            update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+            with tf.control_dependencies(update_ops):
+                accumulate_op = tf.group(accumulate_op, name='accumulate')
+
+        if comm is not None:
+            # synchronous data parallel workers, average the gradients over the processes
+            grads = allreduce_gradients(grads, comm)
+
+        # gradients of the gathered class weights, never of the whole variables
+        sparse_update_ops = []
+        if sparse_heads:
+            sampled_grads = tf.gradients(total_loss, [sampled for _, _, sampled in sparse_heads],
+                                         colocate_gradients_with_ops=tower_losses is not None)
+            for var in sparse_vars:
+                heads = [(indices, grad) for (head_var, indices, _), grad in zip(sparse_heads, sampled_grads)
+                         if head_var is var and grad is not None]
+                with tf.device(var.device):
+                    sparse_update_ops.append(sparse_column_update(
+                        var, tf.concat([indices for indices, _ in heads], axis=0),
+                        tf.concat([grad for _, grad in heads], axis=1), optimizer, learning_rate))
 
     # Apply gradients.
-    apply_gradient_op = opt.apply_gradients(grads, global_step=global_step)
+    with tf.control_dependencies(sparse_update_ops):
+        apply_gradient_op = opt.apply_gradients(grads, global_step=global_step)
 
     # Add histograms for trainable variables.
     if log_histograms:
@@ -70,11 +308,13 @@ def train(total_loss, global_step, optimizer, learning_rate, moving_average_deca
     # Track the moving averages of all trainable variables.
     variable_averages = tf.train.ExponentialMovingAverage(
         moving_average_decay, global_step)
-    variables_averages_op = variable_averages.apply(tf.trainable_variables())
+    variables_averages_op = variable_averages.apply([var for var in tf.trainable_variables() if var not in sparse_vars])
 
     update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
 
     with tf.control_dependencies([apply_gradient_op, variables_averages_op] + update_ops):
         train_op = tf.no_op(name='train')
 
-    return train_op
\ No newline at end of file
+    if accumulate_op is not None:
+        train_op = reset_op_fn([train_op, loss_averages_op])
+    return train_op, accumulate_op
\ No newline at end of file
@@ -1,11 +1,11 @@
+# mxnet, cv2 and scipy.misc are imported by the functions using them,
+# so importing this module for the tf.data functions stays cheap
 import tensorflow as tf
-from scipy import misc
 import numpy as np
-import mxnet as mx
 import argparse
 import random
 import pickle
-import cv2
+import glob
 import os
 
 
@@ -24,6 +24,7 @@ def parse_args():
     return args
 
 def mx2tfrecords(imgidx, imgrec, args):
+    import mxnet as mx
     output_path = os.path.join(args.tfrecords_file_path, 'tran.tfrecords')
     if not os.path.exists(args.tfrecords_file_path):
         os.makedirs(args.tfrecords_file_path)
@@ -44,10 +45,11 @@ def mx2tfrecords(imgidx, imgrec, args):
     writer.close()
 
 def random_rotate_image(image):
+    from scipy import misc
     angle = np.random.uniform(low=-10.0, high=10.0)
     return misc.imrotate(image, angle, 'bicubic')
 
-def parse_function(example_proto):
+def parse_function(example_proto, random_flip=True):
     features = {'image_raw': tf.FixedLenFeature([], tf.string),
                 'label': tf.FixedLenFeature([], tf.int64)}
     features = tf.parse_single_example(example_proto, features)
@@ -59,12 +61,14 @@ def parse_function(example_proto):
     img = tf.cast(img, dtype=tf.float32)
     img = tf.subtract(img, 127.5)
     img = tf.multiply(img,  0.0078125)
-    img = tf.image.random_flip_left_right(img)
+    if random_flip:
+        img = tf.image.random_flip_left_right(img)
     label = tf.cast(features['label'], tf.int64)
     return img, label
 
 def create_tfrecords():
     '''convert mxnet data to tfrecords.'''
+    import mxnet as mx
     id2range = {}
     args = parse_args()
 
@@ -86,6 +90,7 @@ def create_tfrecords():
     mx2tfrecords(imgidx, imgrec, args)
 
 def load_bin(db_name, image_size, args):
+    import mxnet as mx
     bins, issame_list = pickle.load(open(os.path.join(args.eval_db_path, db_name+'.bin'), 'rb'), encoding='bytes')
     data_list = []
     for _ in [0,1]:
@@ -107,6 +112,7 @@ def load_bin(db_name, image_size, args):
     return data_list, issame_list
 
 def load_data(db_name, image_size, args):
+    import mxnet as mx
     bins, issame_list = pickle.load(open(os.path.join(args.eval_db_path, db_name+'.bin'), 'rb'), encoding='bytes')
     datasets = np.empty((len(issame_list)*2, image_size[0], image_size[1], 3))
 
@@ -126,7 +132,126 @@ def load_data(db_name, image_size, args):
 
     return datasets, issame_list
 
+def train_tfrecords_files(tfrecords_file_path):
+    '''the tran*.tfrecords shards of the directory, tran.tfrecords when there is none.'''
+    tfrecords_files = sorted(glob.glob(os.path.join(tfrecords_file_path, 'tran*.tfrecords')))
+    return tfrecords_files or [os.path.join(tfrecords_file_path, 'tran.tfrecords')]
+
+def get_train_dataset(tfrecords_file_path, num_workers=1, worker_index=0):
+    '''training records of this worker.
+
+    with several tran*.tfrecords files every worker reads its own subset of files,
+    with a single file every worker reads every num_workers-th record.
+    '''
+    tfrecords_files = train_tfrecords_files(tfrecords_file_path)
+    if num_workers > 1 and len(tfrecords_files) >= num_workers:
+        return tf.data.TFRecordDataset(tfrecords_files[worker_index::num_workers])
+    dataset = tf.data.TFRecordDataset(tfrecords_files)
+    if num_workers > 1:
+        dataset = dataset.shard(num_workers, worker_index)
+    return dataset
+
+def normalize_images(images):
+    '''subtract 127.5 then multiply 1/128, uint8 images of the caches are normalized batch by batch.'''
+    if images.dtype == np.uint8:
+        return (images.astype(np.float32) - 127.5) * 0.0078125
+    return images
+
+def cache_data(db_name, image_size, args, cache_path):
+    '''decode an evaluation set once into uint8 .npy files that every process can memory-map read-only.'''
+    images_path = os.path.join(cache_path, db_name + '_images.npy')
+    issame_path = os.path.join(cache_path, db_name + '_issame.npy')
+    if os.path.exists(images_path) and os.path.exists(issame_path):
+        return images_path, issame_path
+    import mxnet as mx
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    bins, issame_list = pickle.load(open(os.path.join(args.eval_db_path, db_name+'.bin'), 'rb'), encoding='bytes')
+    images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                       shape=(len(issame_list)*2, image_size[0], image_size[1], 3))
+    for i in range(len(issame_list)*2):
+        images[i, ...] = mx.image.imdecode(bins[i]).asnumpy()
+        if (i + 1) % 1000 == 0:
+            print('caching bin', i + 1)
+    images.flush()
+    del images
+    os.rename(images_path + '.tmp', images_path)
+    np.save(issame_path, np.asarray(issame_list, dtype=np.bool_))
+    return images_path, issame_path
+
+def load_data_cache(db_name, cache_path):
+    '''memory-mapped uint8 images and issame list of an evaluation set written by cache_data.'''
+    datasets = np.load(os.path.join(cache_path, db_name + '_images.npy'), mmap_mode='r')
+    issame_list = np.load(os.path.join(cache_path, db_name + '_issame.npy')).tolist()
+    return datasets, issame_list
+
+def cache_train_data(tfrecords_file_path, cache_path, max_images):
+    '''decode max_images training records once into memory-mappable uint8 images and int64 labels.
+
+    the records are read from the tran*.tfrecords shards like get_train_dataset, every
+    (number of records // max_images)-th one, so the subset spans all of the classes of a class ordered dataset.
+    '''
+    images_path = os.path.join(cache_path, 'train_images.npy')
+    labels_path = os.path.join(cache_path, 'train_labels.npy')
+    if os.path.exists(images_path) and os.path.exists(labels_path):
+        return images_path, labels_path
+    import mxnet as mx
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8, shape=(max_images, 112, 112, 3))
+    labels = np.zeros(max_images, dtype=np.int64)
+    tfrecords_files = train_tfrecords_files(tfrecords_file_path)
+    # counting only reads the records, decoding them is the slow part
+    num_records = sum(1 for tfrecords_file in tfrecords_files for _ in tf.python_io.tf_record_iterator(tfrecords_file))
+    stride = max(num_records // max_images, 1)
+    records = (record for tfrecords_file in tfrecords_files for record in tf.python_io.tf_record_iterator(tfrecords_file))
+    count = 0
+    for index, record in enumerate(records):
+        if count >= max_images:
+            break
+        if index % stride:
+            continue
+        example = tf.train.Example.FromString(record)
+        images[count, ...] = mx.image.imdecode(example.features.feature['image_raw'].bytes_list.value[0]).asnumpy()
+        labels[count] = example.features.feature['label'].int64_list.value[0]
+        count += 1
+        if count % 10000 == 0:
+            print('%d num image cached' % count)
+    images.flush()
+    del images
+    if count < max_images:
+        # fewer records than requested, keep only the decoded ones
+        images = np.load(images_path + '.tmp', mmap_mode='r')[:count]
+        np.save(images_path, images)
+        del images
+        os.remove(images_path + '.tmp')
+    else:
+        os.rename(images_path + '.tmp', images_path)
+    np.save(labels_path, labels[:count])
+    return images_path, labels_path
+
+def cached_train_dataset(cache_path):
+    '''training dataset read from the memory-mapped cache of cache_train_data, same output as parse_function.'''
+    images = np.load(os.path.join(cache_path, 'train_images.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(cache_path, 'train_labels.npy'), mmap_mode='r')
+
+    def generator():
+        for index in np.random.permutation(labels.shape[0]):
+            yield images[index], labels[index]
+
+    dataset = tf.data.Dataset.from_generator(generator, (tf.uint8, tf.int64), (tf.TensorShape([112, 112, 3]), tf.TensorShape([])))
+
+    def preprocess(img, label):
+        img = tf.cast(img, dtype=tf.float32)
+        img = tf.subtract(img, 127.5)
+        img = tf.multiply(img,  0.0078125)
+        img = tf.image.random_flip_left_right(img)
+        return img, label
+
+    return dataset.map(preprocess)
+
 def test_tfrecords():
+    import cv2
     args = parse_args()
 
     config = tf.ConfigProto(allow_soft_placement=True)
@@ -103,7 +103,7 @@ def freeze_graph_def(sess, input_graph_def, output_node_names):
     # Get the list of important nodes
     whitelist_names = []
     for node in input_graph_def.node:
-        if (node.name.startswith('MobileFaceNet') or node.name.startswith('embeddings')):
+        if (node.name.startswith('MobileFaceNet') or node.name.startswith('MobileNetV3') or node.name.startswith('ResNet') or node.name.startswith('embeddings')):
             whitelist_names.append(node.name)
 
     # Replace all the variables in the graph with constants of the same values
@@ -0,0 +1,208 @@
+'''
+machine-readable metrics of training and evaluation, for monitoring systems that can not read the
+print lines or the tensorboard summaries.
+
+every metric is written in the prometheus text format, to a file (for the node exporter textfile
+collector) and/or served on a local http endpoint, every event is also appended to a jsonl log.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import deque
+import threading
+import resource
+import json
+import time
+import os
+
+import numpy as np
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def process_rss_bytes():
+    '''current resident memory of the process, the peak one where /proc is not available.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in sorted(labels)) + '}'
+
+
+class MetricsExporter(object):
+    """Gauges and latency summaries exported as prometheus text and a jsonl log.
+
+    All the outputs are optional, an exporter without any of them only keeps the values,
+    so the training code can feed it unconditionally.
+    """
+
+    def __init__(self, prom_path='', jsonl_path='', http_port=0, job='train', window=1000):
+        """
+        Args:
+          prom_path: prometheus text file, rewritten atomically by flush(), empty to disable.
+          jsonl_path: jsonl log, one line per event, empty to disable.
+          http_port: serve the prometheus text on http://0.0.0.0:http_port/metrics, 0 to disable.
+          job: value of the job label of every metric, eg: train, test.
+          window: number of the latest observations the latency quantiles are computed on.
+        """
+        self.prom_path = prom_path
+        self.job = job
+        self.window = window
+        self._gauges = {}
+        self._summaries = {}
+        self._help = {}
+        self._lock = threading.Lock()
+        self._jsonl = None
+        if jsonl_path:
+            directory = os.path.dirname(jsonl_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._jsonl = open(jsonl_path, 'a')
+        self._server = None
+        if http_port:
+            self._serve(http_port)
+
+    def set(self, name, value, help='', **labels):
+        """Set the gauge name{labels} to value."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = float(value)
+            self._help.setdefault(name, help)
+
+    def observe(self, name, value, help='', **labels):
+        """Add an observation to the summary name{labels}, eg: a step latency in seconds."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._summaries:
+                self._summaries[key] = [deque(maxlen=self.window), 0, 0.]
+            summary = self._summaries[key]
+            summary[0].append(float(value))
+            summary[1] += 1
+            summary[2] += float(value)
+            self._help.setdefault(name, help)
+
+    def quantiles(self, name, **labels):
+        """{quantile: value} of the latest observations of name{labels}."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            values = list(self._summaries[key][0]) if key in self._summaries else []
+        if not values:
+            return {}
+        return dict(zip(QUANTILES, np.percentile(values, [q * 100 for q in QUANTILES])))
+
+    def log(self, event, **fields):
+        """Append an event to the jsonl log."""
+        if self._jsonl is None:
+            return
+        record = {'time': time.time(), 'job': self.job, 'event': event}
+        record.update(fields)
+        with self._lock:
+            self._jsonl.write(json.dumps(record, default=float) + '\n')
+            self._jsonl.flush()
+
+    def evaluation(self, dataset, duration, nrof_images, accuracy, val=None, step=None):
+        """Record the result of one evaluation set, the same for training, test_nets and ver_test."""
+        self.set('eval_duration_seconds', duration, 'Duration of the last evaluation.', dataset=dataset)
+        self.set('eval_images_per_second', nrof_images / duration if duration > 0 else 0.,
+                 'Images per second of the last evaluation.', dataset=dataset)
+        self.set('eval_accuracy', accuracy, 'Accuracy of the last evaluation.', dataset=dataset)
+        fields = {'dataset': dataset, 'duration': duration, 'images': nrof_images, 'accuracy': accuracy}
+        if val is not None:
+            self.set('eval_val', val, 'Validation rate of the last evaluation.', dataset=dataset)
+            fields['val'] = val
+        if step is not None:
+            fields['step'] = step
+        self.log('evaluation', **fields)
+        self.flush()
+
+    def render(self):
+        """All the metrics in the prometheus text exposition format."""
+        self.set('process_resident_memory_bytes', process_rss_bytes(), 'Resident memory of the process.')
+        job = ('job', self.job)
+        lines = []
+        with self._lock:
+            gauges = sorted(self._gauges.items())
+            summaries = sorted((key, list(s[0]), s[1], s[2]) for key, s in self._summaries.items())
+            helps = dict(self._help)
+        typed = set()
+        for (name, labels), value in gauges:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# HELP %s %s' % (name, helps.get(name) or name))
+                lines.append('# TYPE %s gauge' % name)
+            lines.append('%s%s %r' % (name, _format_labels(labels + (job,)), value))
+        for (name, labels), values, count, total in summaries:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# HELP %s %s' % (name, helps.get(name) or name))
+                lines.append('# TYPE %s summary' % name)
+            if values:
+                for q, value in zip(QUANTILES, np.percentile(values, [q * 100 for q in QUANTILES])):
+                    lines.append('%s%s %r' % (name, _format_labels(labels + (job, ('quantile', q))), float(value)))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels + (job,)), count))
+            lines.append('%s_sum%s %r' % (name, _format_labels(labels + (job,)), total))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """Rewrite the prometheus text file, a scraper never sees a partial file."""
+        if not self.prom_path:
+            return
+        directory = os.path.dirname(self.prom_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = self.prom_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.prom_path)
+
+    def _serve(self, port):
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer(('', port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print('metrics served on http://0.0.0.0:%d/metrics' % port)
+
+    def close(self):
+        self.flush()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+
+def add_metrics_arguments(parser):
+    '''the metrics output flags shared by train_nets.py and test_nets.py.'''
+    parser.add_argument('--metrics_prom_path', default='',
+                        help='prometheus text file of the throughput and accuracy metrics, empty to disable')
+    parser.add_argument('--metrics_jsonl_path', default='', help='jsonl log of the metrics, empty to disable')
+    parser.add_argument('--metrics_port', type=int, default=0,
+                        help='serve the prometheus metrics on this local http port, 0 to disable')
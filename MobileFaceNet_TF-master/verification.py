@@ -23,18 +23,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+# sklearn and scipy are imported by the functions using them, they only load when evaluating
 import tensorflow as tf
 import numpy as np
-from sklearn.model_selection import KFold
-from sklearn.decomposition import PCA
-import sklearn
-from scipy import interpolate
 import datetime
+import time
 
 max_threshold = 0
 min_threshold = 4
 
 def calculate_roc(thresholds, embeddings1, embeddings2, actual_issame, nrof_folds=10, pca=0):
+    from sklearn.model_selection import KFold
+    from sklearn.decomposition import PCA
+    import sklearn.preprocessing
     assert (embeddings1.shape[0] == embeddings2.shape[0])
     assert (embeddings1.shape[1] == embeddings2.shape[1])
     nrof_pairs = min(len(actual_issame), embeddings1.shape[0])
@@ -122,6 +123,8 @@ def calculate_val(thresholds, embeddings1, embeddings2, actual_issame, far_targe
     :param nrof_folds:
     :return:
     '''
+    from sklearn.model_selection import KFold
+    from scipy import interpolate
     assert (embeddings1.shape[0] == embeddings2.shape[0])
     assert (embeddings1.shape[1] == embeddings2.shape[1])
     nrof_pairs = min(len(actual_issame), embeddings1.shape[0])
@@ -180,6 +183,16 @@ def evaluate(embeddings, actual_issame, nrof_folds=10, pca=0):
     return tpr, fpr, accuracy, val, val_std, far
 
 
+def calculate_auc_eer(fpr, tpr):
+    '''area under the roc curve and equal error rate.'''
+    from sklearn import metrics
+    from scipy.optimize import brentq
+    from scipy import interpolate
+    auc = metrics.auc(fpr, tpr)
+    eer = brentq(lambda x: 1. - x - interpolate.interp1d(fpr, tpr)(x), 0., 1.)
+    return auc, eer
+
+
 def data_iter(datasets, batch_size):
     data_num = datasets.shape[0]
     for i in range(0, data_num, batch_size):
@@ -198,6 +211,7 @@ def test(data_set, sess, embedding_tensor, batch_size, label_shape=None, feed_di
     :param input_placeholder:
     :return:
     '''
+    import sklearn.preprocessing
     print('testing verification..')
     data_list = data_set[0]
     issame_list = data_set[1]
@@ -249,13 +263,19 @@ def test(data_set, sess, embedding_tensor, batch_size, label_shape=None, feed_di
     return acc1, std1, acc2, std2, _xnorm, embeddings_list
 
 
-def ver_test(ver_list, ver_name_list, nbatch, sess, embedding_tensor, batch_size, feed_dict, input_placeholder):
+def ver_test(ver_list, ver_name_list, nbatch, sess, embedding_tensor, batch_size, feed_dict, input_placeholder,
+             metrics=None):
     results = []
     for i in range(len(ver_list)):
+        start_time = time.time()
         acc1, std1, acc2, std2, xnorm, embeddings_list = test(data_set=ver_list[i], sess=sess, embedding_tensor=embedding_tensor,
                                                               batch_size=batch_size, feed_dict=feed_dict,
                                                               input_placeholder=input_placeholder)
         print('[%s][%d]XNorm: %f' % (ver_name_list[i], nbatch, xnorm))
         print('[%s][%d]Accuracy-Flip: %1.5f+-%1.5f' % (ver_name_list[i], nbatch, acc2, std2))
+        if metrics is not None:
+            # utils.metrics.MetricsExporter, every image is run with its flip
+            nrof_images = sum(data.shape[0] for data in ver_list[i][0])
+            metrics.evaluation(ver_name_list[i], time.time() - start_time, nrof_images, acc2, step=nbatch)
         results.append(acc2)
     return results